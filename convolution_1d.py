@@ -2,9 +2,9 @@ from __future__ import division
 import math
 import numpy as np
 from six import moves
-from chainer import cuda, Variable, Parameter, initializers, link, functions
-from chainer.functions.connection import convolution_nd
-from chainer.utils import conv_nd, type_check
+import chainer
+from chainer import cuda, Variable, Parameter, initializers, link, function, functions
+from chainer.utils import type_check
 
 def _get_norm(W):
 	xp = cuda.get_array_module(W)
@@ -12,129 +12,296 @@ def _get_norm(W):
 	norm = norm.reshape((-1, 1, 1))
 	return norm
 
-class Convolution1DFunction(convolution_nd.ConvolutionND):
-		
+class WeightNormalization(function.Function):
+
+	def check_type_forward(self, in_types):
+		type_check.expect(in_types.size() == 2)
+		v_type, g_type = in_types
+		type_check.expect(
+			v_type.dtype.kind == "f",
+			g_type.dtype == v_type.dtype,
+			v_type.ndim == 3,
+			g_type.ndim == 3,
+			g_type.shape[0] == v_type.shape[0],
+		)
+
+	def forward(self, inputs):
+		V, g = inputs
+		self.norm = _get_norm(V)
+		self.V_normalized = V / self.norm
+		return g * self.V_normalized,
+
+	def backward(self, inputs, grad_outputs):
+		V, g = inputs
+		gW = grad_outputs[0]
+		xp = cuda.get_array_module(V)
+		gg = xp.sum(gW * self.V_normalized, axis=(1, 2), keepdims=True)
+		gV = g * (gW - gg * self.V_normalized) / self.norm
+		return gV, gg
+
+def weight_normalization(V, g):
+	return WeightNormalization()(V, g)
+
+# causal 1d convolution computed as a single GEMM
+# x: (batchsize, in_channels, seq_length) or (seq_length, batchsize, in_channels) if time_major
+# W: (out_channels, in_channels, ksize)
+# the input is padded only on the left with `pad` zeros, so the output has seq_length + pad - ksize + 1 timesteps
+# e.g.
+# ksize = 3
+# pad = 2
+# [0, 0, x1, x2, x3]
+# |< y1 >|
+#     |< y2 >|
+#         |< y3 >|
+# the columns are built in time-major order, so a time-major input needs no transpose at all
+class CausalConvolution1DFunction(function.Function):
+	def __init__(self, pad, time_major=False):
+		self.pad = pad
+		self.time_major = time_major
+
 	def check_type_forward(self, in_types):
 		n_in = in_types.size()
-		type_check.expect(2 <= n_in, n_in <= 4)
+		type_check.expect(2 <= n_in, n_in <= 3)
 
 		x_type = in_types[0]
-		v_type = in_types[1]
-		g_type = in_types[1]
+		w_type = in_types[1]
 		type_check.expect(
 			x_type.dtype.kind == "f",
-			v_type.dtype.kind == "f",
-			g_type.dtype.kind == "f",
-			x_type.ndim == self.ndim + 2,
-			v_type.ndim == self.ndim + 2,
-			g_type.ndim == self.ndim + 2,
-			x_type.shape[1] == v_type.shape[1],
+			w_type.dtype == x_type.dtype,
+			x_type.ndim == 3,
+			w_type.ndim == 3,
+			x_type.shape[2 if self.time_major else 1] == w_type.shape[1],
 		)
 
-		if type_check.eval(n_in) == 4:
-			b_type = in_types[3]
+		if type_check.eval(n_in) == 3:
+			b_type = in_types[2]
 			type_check.expect(
 				b_type.dtype == x_type.dtype,
 				b_type.ndim == 1,
-				b_type.shape[0] == v_type.shape[0],
+				b_type.shape[0] == w_type.shape[0],
 			)
-			
+
+	# (out_channels, in_channels, ksize) -> (ksize * in_channels, out_channels)
+	def _get_matrix(self, W):
+		out_channels, in_channels, ksize = W.shape
+		return W.transpose(2, 1, 0).reshape((ksize * in_channels, out_channels))
+
+	# (seq_length, batchsize, in_channels) -> (out_length * batchsize, ksize * in_channels)
+	def _im2col(self, x, ksize):
+		xp = cuda.get_array_module(x)
+		seq_length, batchsize, in_channels = x.shape
+		out_length = seq_length + self.pad - ksize + 1
+		x_pad = xp.zeros((seq_length + self.pad, batchsize, in_channels), dtype=x.dtype)
+		x_pad[self.pad:] = x
+		col = xp.empty((out_length, batchsize, ksize, in_channels), dtype=x.dtype)
+		for j in moves.range(ksize):
+			col[:, :, j] = x_pad[j:j + out_length]
+		return col.reshape((out_length * batchsize, ksize * in_channels))
+
 	def forward(self, inputs):
-		x, V, g = inputs[:3]
-		b = inputs[3] if len(inputs) == 4 else None
-		
-		self.norm = _get_norm(V)
-		self.V_normalized = V / self.norm
-		self.W = g * self.V_normalized
+		x, W = inputs[:2]
+		b = inputs[2] if len(inputs) == 3 else None
+		if self.time_major == False:
+			x = x.transpose(2, 0, 1)
+		seq_length, batchsize, in_channels = x.shape
+		out_channels, _, ksize = W.shape
+		out_length = seq_length + self.pad - ksize + 1
 
-		if b is None:
-			return super(Convolution1DFunction, self).forward((x, self.W))
-		return super(Convolution1DFunction, self).forward((x, self.W, b))
+		self.col = self._im2col(x, ksize)
+		y = self.col.dot(self._get_matrix(W))
+		if b is not None:
+			y += b
+		y = y.reshape((out_length, batchsize, out_channels))
+		if self.time_major:
+			return y,
+		return y.transpose(1, 2, 0),
 
 	def backward(self, inputs, grad_outputs):
-		x, V, g = inputs[:3]
-		if hasattr(self, "W") == False:
-			self.norm = _get_norm(V)
-			self.V_normalized = V / self.norm
-			self.W = g * self.V_normalized
+		x, W = inputs[:2]
+		b = inputs[2] if len(inputs) == 3 else None
+		xp = cuda.get_array_module(x)
+		if self.time_major == False:
+			x = x.transpose(2, 0, 1)
+		seq_length, batchsize, in_channels = x.shape
+		out_channels, _, ksize = W.shape
+		out_length = seq_length + self.pad - ksize + 1
 
-		b = inputs[3] if len(inputs) == 4 else None
-		if b is None:
-			gx, gW = super(Convolution1DFunction, self).backward((x, self.W), grad_outputs)
-		else:
-			gx, gW, gb = super(Convolution1DFunction, self).backward((x, self.W, b), grad_outputs)
+		gy = grad_outputs[0]
+		if self.time_major == False:
+			gy = gy.transpose(2, 0, 1)
+		gy = gy.reshape((out_length * batchsize, out_channels))
+		gW = self.col.T.dot(gy).reshape((ksize, in_channels, out_channels)).transpose(2, 1, 0)
 
-		xp = cuda.get_array_module(x)
-		gg = xp.sum(gW * self.V_normalized, axis=(1, 2), keepdims=True)
-		gV = g * (gW - gg * self.V_normalized) / self.norm
+		# col2im
+		gcol = gy.dot(self._get_matrix(W).T).reshape((out_length, batchsize, ksize, in_channels))
+		gx_pad = xp.zeros((seq_length + self.pad, batchsize, in_channels), dtype=x.dtype)
+		for j in moves.range(ksize):
+			gx_pad[j:j + out_length] += gcol[:, :, j]
+		gx = gx_pad[self.pad:]
+		if self.time_major == False:
+			gx = gx.transpose(1, 2, 0)
 
 		if b is None:
-			return gx, gV, gg
-		else:
-			return gx, gV, gg, gb
-			
-def convolution_1d(x, V, g, b=None, stride=1, pad=0, cover_all=False):
-	func = Convolution1DFunction(1, stride=stride, pad=pad, cover_all=cover_all)
+			return gx, gW
+		return gx, gW, gy.sum(axis=0)
+
+def causal_convolution_1d(x, W, b=None, pad=None, time_major=False):
+	if pad is None:
+		pad = W.shape[2] - 1
+	func = CausalConvolution1DFunction(pad, time_major)
 	if b is None:
-		return func(x, V, g)
-	else:
-		return func(x, V, g, b)
+		return func(x, W)
+	return func(x, W, b)
+
+class CausalConvolution1D(link.Link):
+
+	def __init__(self, in_channels, out_channels, ksize, initialW=None, nobias=False, time_major=False):
+		super(CausalConvolution1D, self).__init__()
+		self.ksize = ksize
+		self.time_major = time_major
+		self.in_channels = in_channels
+		self.out_channels = out_channels
+
+		with self.init_scope():
+			W_shape = (out_channels, in_channels, ksize)
+			self.W = Parameter(initializers._get_initializer(initialW), W_shape)
+			if nobias:
+				self.b = None
+			else:
+				self.b = Parameter(initializers.Zero(), (out_channels,))
 
-class Convolution1D(link.Link):
+	def __call__(self, x):
+		return causal_convolution_1d(x, self.W, self.b, time_major=self.time_major)
 
-	def __init__(self, in_channels, out_channels, ksize, stride=1, pad=0, initialV=None, nobias=False, cover_all=False):
-		super(Convolution1D, self).__init__()
-		ksize = conv_nd.as_tuple(ksize, 1)
+	# X: the last ksize inputs (batchsize, in_channels, ksize) or (ksize, batchsize, in_channels) if time_major
+	def forward_one_step(self, X):
+		return causal_convolution_1d(X, self.W, self.b, pad=0, time_major=self.time_major)
+
+# W = g * V / ||V|| is cached until update_rule.t of V or the arrays of V and g change.
+# load_* and copyparams clear the cache. any other in-place write to V.data or g.data, by hand or by an
+# optimizer that does not advance update_rule.t, must be followed by clear_weightnorm_cache, or W is stale.
+class WeightnormCausalConvolution1D(link.Link):
+
+	def __init__(self, in_channels, out_channels, ksize, initialV=None, nobias=False, time_major=False):
+		super(WeightnormCausalConvolution1D, self).__init__()
 		self.ksize = ksize
+		self.time_major = time_major
 		self.nobias = nobias
-		self.stride = stride
-		self.pad = pad
 		self.out_channels = out_channels
 		self.in_channels = in_channels
-		self.cover_all = cover_all
 
 		self.initialV = initialV
 
 		with self.init_scope():
-			V_shape = (out_channels, in_channels) + ksize
+			V_shape = (out_channels, in_channels, ksize)
 			initialV = initializers._get_initializer(initialV)
 			self.V = Parameter(initialV, V_shape)
 
-		if nobias:
-			self.b = None
+			# g and b are initialized from the data on the first forward pass
+			# they are registered here so that the optimizer and the serializer can see them
+			self.g = Parameter()
+			if nobias:
+				self.b = None
+			else:
+				self.b = Parameter()
+
+		self._W_cache = None
+		self._W_key = None
 
 	@property
 	def W(self):
-		V = self.V.data
-		xp = cuda.get_array_module(V)
-		norm = _get_norm(V)
-		V = V / norm
-		return self.g.data * V
+		return self._get_W().data
+
+	# the normalized weight is computed once per parameter update and shared by every call
+	def _get_W(self):
+		update_rule = self.V.update_rule
+		t = 0 if update_rule is None else update_rule.t
+		key = (t, id(self.V.data), id(self.g.data), chainer.config.enable_backprop)
+		if self._W_cache is None or self._W_key != key:
+			self._W_cache = weight_normalization(self.V, self.g)
+			self._W_key = key
+		return self._W_cache
+
+	def _clear_W_cache(self):
+		self._W_cache = None
+		self._W_key = None
+
+	# V and g are changed in place by load_* and copyparams without a new update step
+	def serialize(self, serializer):
+		super(WeightnormCausalConvolution1D, self).serialize(serializer)
+		self._clear_W_cache()
+
+	def copyparams(self, link, copy_persistent=True):
+		super(WeightnormCausalConvolution1D, self).copyparams(link, copy_persistent)
+		self._clear_W_cache()
 
 	# data-dependent initialization of parameters
 	def _initialize_params(self, t):
 		xp = cuda.get_array_module(t)
 
-		self.mean_t = xp.mean(t, axis=(0, 2))			# calculate average for each channel
-		self.std_t = xp.sqrt(xp.var(t, axis=(0, 2)))	# calculate stddev for each channel
+		axis = (0, 1) if self.time_major else (0, 2)
+		self.mean_t = xp.mean(t, axis=axis)			# calculate average for each channel
+		self.std_t = xp.sqrt(xp.var(t, axis=axis))	# calculate stddev for each channel
 		g = 1 / self.std_t
 		b = -self.mean_t / self.std_t
-		
+
 		# print("g <- {}, b <- {}".format(g.reshape((-1,)), b.reshape((-1,))))
 
-		with self.init_scope():
-			if self.nobias == False:
-				self.b = Parameter(b, b.shape)
+		if self.nobias == False:
+			self.b.initialize(b.shape)
+			self.b.data[...] = b
+
+		g_shape = (self.out_channels, 1, 1)
+		self.g.initialize(g_shape)
+		self.g.data[...] = g.reshape(g_shape)
+		self._clear_W_cache()
+
+	def _forward(self, x, pad):
+		if self.g.data is None:
+			xp = cuda.get_array_module(x)
+			t = causal_convolution_1d(x, weight_normalization(self.V, Variable(xp.full((self.out_channels, 1, 1), 1.0).astype(x.dtype))), None, pad, self.time_major)	# compute output with g = 1 and without bias
+			self._initialize_params(t.data)
+			shape = (1, 1, -1) if self.time_major else (1, -1, 1)
+			return (t - self.mean_t.reshape(shape)) / self.std_t.reshape(shape)
 
-			g_shape = (self.out_channels, 1) + (1,) * len(self.ksize)
-			self.g = Parameter(g.reshape(g_shape), g_shape)
+		return causal_convolution_1d(x, self._get_W(), self.b, pad, self.time_major)
 
 	def __call__(self, x):
+		return self._forward(x, self.ksize - 1)
 
-		if hasattr(self, "b") == False or hasattr(self, "g") == False:
-			xp = cuda.get_array_module(x.data)
-			t = convolution_1d(x, self.V, Variable(xp.full((self.out_channels, 1, 1), 1.0).astype(x.dtype)), None, self.stride, self.pad)	# compute output with g = 1 and without bias
-			self._initialize_params(t.data)
-			return (t - self.mean_t.reshape(1, -1, 1)) / self.std_t.reshape((1, -1, 1))
+	# X: the last ksize inputs (batchsize, in_channels, ksize) or (ksize, batchsize, in_channels) if time_major
+	def forward_one_step(self, X):
+		return self._forward(X, 0)
+
+	# returns an equivalent CausalConvolution1D whose weight is g * V / ||V||
+	def fold(self):
+		assert self.g.data is not None, "weight normalization has not been initialized"
+		with chainer.no_backprop_mode():
+			W = cuda.to_cpu(self.W)
+		conv = CausalConvolution1D(self.in_channels, self.out_channels, self.ksize, initialW=W, nobias=self.b is None, time_major=self.time_major)
+		if self.b is not None:
+			conv.b.data[...] = cuda.to_cpu(self.b.data)
+		if self.xp is not np:
+			conv.to_gpu(cuda.get_device_from_array(self.V.data).id)
+		return conv
+
+# must be called after V or g of a link in the chain is changed in place, see WeightnormCausalConvolution1D
+def clear_weightnorm_cache(chain):
+	for child in chain.links():
+		if isinstance(child, WeightnormCausalConvolution1D):
+			child._clear_W_cache()
 
-		return convolution_1d(x, self.V, self.g, self.b, self.stride, self.pad, cover_all=self.cover_all)
\ No newline at end of file
+# replaces every WeightnormCausalConvolution1D in the chain with a plain CausalConvolution1D
+def fold_weightnorm(chain):
+	for parent in list(chain.links()):
+		if hasattr(parent, "weightnorm"):
+			parent.weightnorm = False
+		if isinstance(parent, link.Chain) == False:
+			continue
+		for name in list(parent._children):
+			child = getattr(parent, name)
+			if isinstance(child, WeightnormCausalConvolution1D):
+				delattr(parent, name)
+				with parent.init_scope():
+					setattr(parent, name, child.fold())
+	return chain
@@ -0,0 +1,694 @@
+from __future__ import division
+from __future__ import print_function
+import os, sys, io, pickle, hashlib, shutil, tempfile, itertools, threading, time
+from collections import Counter
+from six.moves import zip_longest, queue
+from multiprocessing import Pool
+import numpy as np
+
+CACHE_VERSION = 2
+
+# sentences of token ids stored as one flat int32 array
+# the i-th sentence is tokens[offsets[i]:offsets[i + 1]]
+# on disk: <name>.tokens.int32 and <name>.offsets.int64, raw little-endian arrays so that they can be written incrementally
+class Corpus(object):
+	def __init__(self, tokens, offsets):
+		assert offsets.ndim == 1 and offsets.size > 0
+		assert offsets[-1] == tokens.size
+		self.tokens = tokens
+		self.offsets = offsets
+
+	@classmethod
+	def from_list(cls, sequences):
+		lengths = np.fromiter((len(sequence) for sequence in sequences), dtype=np.int64, count=len(sequences))
+		offsets = np.zeros((len(sequences) + 1,), dtype=np.int64)
+		np.cumsum(lengths, out=offsets[1:])
+		tokens = np.fromiter(itertools.chain.from_iterable(sequences), dtype=np.int32, count=int(offsets[-1]))
+		return cls(tokens, offsets)
+
+	# mmap_mode=None reads the arrays into memory
+	@classmethod
+	def load(cls, dirname, name, mmap_mode="r"):
+		tokens = _load_array(os.path.join(dirname, name + ".tokens.int32"), "<i4", mmap_mode)
+		offsets = _load_array(os.path.join(dirname, name + ".offsets.int64"), "<i8", mmap_mode)
+		return cls(tokens, offsets)
+
+	def save(self, dirname, name):
+		with CorpusWriter(dirname, name) as writer:
+			writer.write(self.tokens, self.lengths())
+
+	def __len__(self):
+		return self.offsets.size - 1
+
+	def __getitem__(self, index):
+		return self.tokens[self.offsets[index]:self.offsets[index + 1]]
+
+	def __iter__(self):
+		for index in range(len(self)):
+			yield self[index]
+
+	def lengths(self):
+		return np.diff(self.offsets)
+
+	def tolist(self):
+		tokens = self.tokens.tolist()
+		offsets = self.offsets.tolist()
+		return [tokens[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+
+	def fingerprint(self):
+		h = hashlib.sha1()
+		h.update(np.ascontiguousarray(self.offsets, dtype=np.int64).tobytes())
+		h.update(np.ascontiguousarray(self.tokens, dtype=np.int32).tobytes())
+		return h.hexdigest()[:16]
+
+def _load_array(filename, dtype, mmap_mode):
+	if mmap_mode is None or os.path.getsize(filename) == 0:	# an empty file cannot be mapped
+		return np.fromfile(filename, dtype=dtype)
+	return np.memmap(filename, dtype=dtype, mode=mmap_mode)
+
+# appends sentences to <name>.tokens.int32 and <name>.offsets.int64
+class CorpusWriter(object):
+	def __init__(self, dirname, name):
+		self.tokens_file = open(os.path.join(dirname, name + ".tokens.int32"), "wb")
+		self.offsets_file = open(os.path.join(dirname, name + ".offsets.int64"), "wb")
+		self.num_tokens = 0
+		self.offsets_file.write(np.zeros((1,), dtype="<i8").tobytes())
+
+	def write(self, tokens, lengths):
+		offsets = np.cumsum(lengths, dtype=np.int64) + self.num_tokens
+		assert offsets.size == 0 or offsets[-1] == self.num_tokens + tokens.size
+		self.tokens_file.write(np.ascontiguousarray(tokens, dtype="<i4").tobytes())
+		self.offsets_file.write(offsets.astype("<i8").tobytes())
+		self.num_tokens += tokens.size
+
+	def close(self):
+		self.tokens_file.close()
+		self.offsets_file.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+# replaces hash(str(dataset)), which builds a string of the whole dataset
+def fingerprint(dataset):
+	if isinstance(dataset, Corpus) == False:
+		dataset = Corpus.from_list(dataset)
+	return dataset.fingerprint()
+
+# how the lines of one file of a (parallel) corpus are turned into token ids
+# grow_vocab: unseen words are appended to vocab in order of first occurrence, as the old line-by-line readers did
+# unknown_id: the id of unseen words if the vocabulary is frozen
+# max_length: longer sentences (including prefix and suffix) are dropped together with the other side of the pair
+class Field(object):
+	def __init__(self, vocab, grow_vocab=False, unknown_id=None, prefix=None, suffix=None, reverse=False, max_length=None):
+		assert grow_vocab or unknown_id is not None
+		self.vocab = vocab
+		self.grow_vocab = grow_vocab
+		self.unknown_id = unknown_id
+		self.prefix = prefix
+		self.suffix = suffix
+		self.reverse = reverse
+		self.max_length = max_length
+
+	def get_options(self):
+		return (self.grow_vocab, self.unknown_id, self.prefix, self.suffix, self.reverse, self.max_length)
+
+	def get_length(self, words):
+		return len(words) + (self.prefix is not None) + (self.suffix is not None)
+
+	# unseen words are added to vocab if grow_vocab
+	def convert(self, words):
+		vocab = self.vocab
+		if self.grow_vocab:
+			word_ids = [vocab.setdefault(word, len(vocab)) for word in words]
+		else:
+			word_ids = [vocab.get(word, self.unknown_id) for word in words]
+		if self.prefix is not None:
+			word_ids.insert(0, self.prefix)
+		if self.suffix is not None:
+			word_ids.append(self.suffix)
+		if self.reverse:
+			word_ids.reverse()
+		return word_ids
+
+# yields (first line number, lines) where lines holds one tuple per line number with a line of every file
+def read_chunks(filenames, chunk_size=10000):
+	files = [io.open(filename, "r", encoding="utf-8") for filename in filenames]
+	try:
+		chunk = []
+		line_number = 1
+		for lines in zip_longest(*files):
+			if None in lines:
+				raise Exception("{} do not have the same number of lines".format(" and ".join(filenames)))
+			chunk.append(lines)
+			if len(chunk) == chunk_size:
+				yield line_number, chunk
+				line_number += len(chunk)
+				chunk = []
+		if len(chunk) > 0:
+			yield line_number, chunk
+	finally:
+		for f in files:
+			f.close()
+
+# set in every worker process by the pool initializer
+_fields = None
+_skip_empty = True
+
+def _init_worker(fields, skip_empty):
+	global _fields, _skip_empty
+	_fields = fields
+	_skip_empty = skip_empty
+
+# returns the words of every line of the pair, or the reason why the pair is dropped
+def _split_pair(fields, lines, line_number, skip_empty):
+	pair = []
+	for field, line in zip(fields, lines):
+		line = line.strip()
+		if len(line) == 0:
+			if skip_empty:
+				return "empty"
+			raise Exception("empty line {}".format(line_number))
+		words = line.split(" ")
+		if field.max_length is not None and field.get_length(words) > field.max_length:
+			return "long"
+		pair.append(words)
+	return pair
+
+# pass 1: the words of the kept pairs and their counts, in order of first occurrence (dicts keep insertion order)
+def _count_chunk(args):
+	field_indices, (line_number, chunk) = args
+	fields = [_fields[index] for index in field_indices]
+	counts = [Counter() for _ in fields]
+	for offset, lines in enumerate(chunk):
+		pair = _split_pair(fields, lines, line_number + offset, _skip_empty)
+		if isinstance(pair, str):
+			continue
+		for count, words in zip(counts, pair):
+			count.update(words)
+	return counts
+
+# pass 2: token ids and lengths of the kept pairs and the number of dropped pairs
+def _convert_chunk(args):
+	field_indices, (line_number, chunk) = args
+	fields = [_fields[index] for index in field_indices]
+	word_ids = [[] for _ in fields]
+	lengths = [[] for _ in fields]
+	dropped = {"empty": 0, "long": 0}
+	for offset, lines in enumerate(chunk):
+		pair = _split_pair(fields, lines, line_number + offset, _skip_empty)
+		if isinstance(pair, str):
+			dropped[pair] += 1
+			continue
+		for field, ids, length, words in zip(fields, word_ids, lengths, pair):
+			sentence = field.convert(words)
+			ids.extend(sentence)
+			length.append(len(sentence))
+	return [(np.asarray(ids, dtype=np.int32), np.asarray(length, dtype=np.int64)) for ids, length in zip(word_ids, lengths)], dropped
+
+def _map(pool, func, iterable):
+	if pool is None:
+		return map(func, iterable)
+	return pool.imap(func, iterable)
+
+# files: one (filenames, names) per split in vocabulary order, e.g. ((source_train, target_train), ("source_train", "target_train"))
+# the i-th filename belongs to fields[i] and is None if the split has no such file
+# with num_workers > 0 the vocabularies are built with two passes: the pool counts the words of every chunk and the counts
+# are merged in file order, so ids are assigned in order of first occurrence. the second pass converts the chunks with
+# the frozen vocabularies. without a pool a single pass converts the lines and grows the vocabularies, which gives the same ids.
+# the chunks are appended to <name>.tokens.int32 and <name>.offsets.int64 in dirname.
+# memory usage does not depend on the size of the corpus apart from the vocabularies.
+def build_corpus(dirname, files, fields, num_workers=0, chunk_size=10000, skip_empty=True):
+	def iterate_chunks(filenames, field_indices):
+		if len(field_indices) == 0:
+			return iter([])
+		return ((field_indices, chunk) for chunk in read_chunks([filenames[index] for index in field_indices], chunk_size))
+
+	# pass 1
+	if num_workers > 0 and any(field.grow_vocab for field in fields):
+		pool = Pool(num_workers, _init_worker, (fields, skip_empty))
+		try:
+			for filenames, _ in files:
+				field_indices = [index for index, filename in enumerate(filenames) if filename is not None]
+				for counts in pool.imap(_count_chunk, iterate_chunks(filenames, field_indices)):
+					for index, count in zip(field_indices, counts):
+						field = fields[index]
+						if field.grow_vocab == False:
+							continue
+						for word in count:
+							if word not in field.vocab:
+								field.vocab[word] = len(field.vocab)
+		finally:
+			pool.close()
+			pool.join()
+
+	# pass 2
+	dropped = {"empty": 0, "long": 0}
+	pool = Pool(num_workers, _init_worker, (fields, skip_empty)) if num_workers > 0 else None
+	_init_worker(fields, skip_empty)
+	try:
+		for filenames, names in files:
+			writers = [CorpusWriter(dirname, name) for name in names]
+			try:
+				field_indices = [index for index, filename in enumerate(filenames) if filename is not None]
+				for arrays, dropped_chunk in _map(pool, _convert_chunk, iterate_chunks(filenames, field_indices)):
+					for index, (tokens, lengths) in zip(field_indices, arrays):
+						writers[index].write(tokens, lengths)
+					for reason, count in dropped_chunk.items():
+						dropped[reason] += count
+			finally:
+				for writer in writers:
+					writer.close()
+	finally:
+		_init_worker(None, True)
+		if pool is not None:
+			pool.close()
+			pool.join()
+
+	return dropped
+
+def as_corpus(dataset):
+	if isinstance(dataset, Corpus):
+		return dataset
+	return Corpus.from_list(dataset)
+
+# the bucket of a sentence is the first one that is not shorter, len(bucket_sizes) if none is long enough
+def get_bucket_indices(lengths, bucket_sizes):
+	return np.searchsorted(np.asarray(bucket_sizes), lengths, side="left")
+
+# copies the sentences given by indices into a (len(indices), size) int32 matrix filled with pad_id with a single scatter
+# the sentences are aligned to the right if left_padding. mask is True at the tokens
+def pad_sentences(dataset, indices, size, pad_id, left_padding=False):
+	lengths = dataset.lengths()[indices]
+	num_tokens = int(lengths.sum())
+	assert lengths.size == 0 or lengths.max() <= size
+	rows = np.repeat(np.arange(len(indices)), lengths)
+	positions = np.arange(num_tokens) - np.repeat(np.cumsum(lengths) - lengths, lengths)	# position in the sentence
+	columns = positions + np.repeat(size - lengths, lengths) if left_padding else positions
+	matrix = np.full((len(indices), size), pad_id, dtype=np.int32)
+	matrix[rows, columns] = dataset.tokens[np.repeat(dataset.offsets[indices], lengths) + positions]
+	mask = np.zeros((len(indices), size), dtype=bool)
+	mask[rows, columns] = True
+	return matrix, mask
+
+# datasets: one Corpus (or list of sentences) per side of the pairs, e.g. (source, target)
+# bucket_sizes: (num_buckets,) or (num_buckets, num_sides) in increasing order
+# a pair goes to the first bucket that fits every side and is dropped if none does
+# returns buckets[side] and masks[side], the padded matrices and their masks of every non-empty bucket
+# the sentences of a bucket keep their order. the datasets are not modified
+def make_buckets(datasets, bucket_sizes, pad_id, left_padding):
+	datasets = [as_corpus(dataset) for dataset in datasets]
+	num_sentences = len(datasets[0])
+	assert all(len(dataset) == num_sentences for dataset in datasets)
+	bucket_sizes = np.asarray(bucket_sizes).reshape((len(bucket_sizes), -1))
+	if bucket_sizes.shape[1] == 1:
+		bucket_sizes = np.repeat(bucket_sizes, len(datasets), axis=1)
+	assert bucket_sizes.shape[1] == len(datasets)
+
+	bucket_indices = np.zeros((num_sentences,), dtype=np.int64)
+	for side, dataset in enumerate(datasets):
+		bucket_indices = np.maximum(bucket_indices, get_bucket_indices(dataset.lengths(), bucket_sizes[:, side]))
+	order = np.argsort(bucket_indices, kind="mergesort")	# stable
+	boundaries = np.searchsorted(bucket_indices[order], np.arange(len(bucket_sizes) + 1))
+
+	buckets = [[] for _ in datasets]
+	masks = [[] for _ in datasets]
+	for bucket_index in range(len(bucket_sizes)):
+		indices = order[boundaries[bucket_index]:boundaries[bucket_index + 1]]
+		if indices.size == 0:
+			continue
+		for side, dataset in enumerate(datasets):
+			matrix, mask = pad_sentences(dataset, indices, int(bucket_sizes[bucket_index, side]), pad_id, left_padding[side])
+			buckets[side].append(matrix)
+			masks[side].append(mask)
+	return buckets, masks
+
+# lengths: (num_sentences,) or (num_sentences, num_sides) of the sentences (pairs) of one bucket
+# the sentences are sorted by length, ties in random order, and cut into consecutive batches of at most max_tokens
+# where a batch costs its number of sentences times its longest sentence of every side, so that every batch trimmed
+# to its longest sentence has about the same size. a sentence longer than max_tokens gets a batch of its own.
+# returns the indices of the sentences of every batch
+def make_token_batches(lengths, max_tokens, random_state=np.random):
+	lengths = np.asarray(lengths, dtype=np.int64)
+	if lengths.ndim == 1:
+		lengths = lengths[:, None]
+	order = np.lexsort((random_state.permutation(len(lengths)),) + tuple(lengths[:, side] for side in reversed(range(lengths.shape[1]))))
+	lengths = lengths[order]
+	batches = []
+	start = 0
+	while start < len(lengths):
+		limit = max(1, max_tokens // max(1, int(lengths[start].sum())))	# the lengths only grow on the first side
+		widths = np.maximum.accumulate(lengths[start:start + limit], axis=0).sum(axis=1)
+		cost = widths * np.arange(1, len(widths) + 1)
+		end = start + max(1, int(np.searchsorted(cost, max_tokens, side="right")))
+		batches.append(order[start:end])
+		start = end
+	return batches
+
+# the (bucket index, indices) of the token batches of every bucket in random order, one epoch
+def make_token_batches_buckets(lengths_buckets, max_tokens, random_state=np.random):
+	batches = [(bucket_idx, indices) for bucket_idx, lengths in enumerate(lengths_buckets) for indices in make_token_batches(lengths, max_tokens, random_state)]
+	return [batches[i] for i in random_state.permutation(len(batches))]
+
+# the (bucket index, indices) of the batches of batchsize sentences of every bucket in random order, one epoch
+def make_batches_buckets(bucket_lengths, batchsize, random_state=np.random):
+	batches = []
+	for bucket_idx, num_sentences in enumerate(bucket_lengths):
+		indices = random_state.permutation(num_sentences)
+		batches += [(bucket_idx, indices[start:start + batchsize]) for start in range(0, num_sentences, batchsize)]
+	return [batches[i] for i in random_state.permutation(len(batches))]
+
+# iterates over the batches of bucketed arrays, every sentence once per epoch
+# arrays: one list of buckets per side, e.g. [source_buckets, target_buckets, skip_masks]
+# batches of batchsize sentences, or of at most max_tokens tokens when lengths (the lengths of the sentences of every bucket) are given
+# the buckets are never shuffled or copied, a batch is gathered from its bucket by one fancy index.
+# the permutation of an epoch is drawn from the random state saved at its start, so that serialize
+# can store the position in the epoch and training can be resumed from the next batch.
+class BucketIterator(object):
+	def __init__(self, arrays, batchsize, lengths=None, max_tokens=0, seed=None):
+		assert max_tokens == 0 or lengths is not None
+		self.arrays = arrays
+		self.batchsize = batchsize
+		self.lengths = lengths
+		self.max_tokens = max_tokens
+		self.random_state = np.random.RandomState(np.random.randint(2 ** 31) if seed is None else seed)
+		self.epoch = 0		# number of completed epochs
+		self.position = 0	# number of batches of the current epoch that have been returned
+		self._epoch_state = None
+		self._batches = None
+		self.prefetcher = None
+
+	def _get_batches(self):
+		if self._batches is None:
+			if self._epoch_state is None:
+				self._epoch_state = self.random_state.get_state()
+			self.random_state.set_state(self._epoch_state)
+			if self.max_tokens > 0:
+				self._batches = make_token_batches_buckets(self.lengths, self.max_tokens, self.random_state)
+			else:
+				self._batches = make_batches_buckets([len(bucket) for bucket in self.arrays[0]], self.batchsize, self.random_state)
+		return self._batches
+
+	# number of batches of the current epoch
+	def __len__(self):
+		return len(self._get_batches())
+
+	def _gather(self, batches, prepare, shard):
+		for bucket_idx, indices in batches:
+			if shard is not None:
+				indices = np.array_split(indices, shard[1])[shard[0]]
+				if indices.size == 0:
+					yield None
+					continue
+			batch = bucket_idx, indices, [buckets[bucket_idx][indices] for buckets in self.arrays]
+			yield batch if prepare is None else prepare(batch)
+
+	def __iter__(self):
+		return self.iterate()
+
+	# the next batch, as iterate without prepare and shard would return it, without moving
+	def peek(self):
+		batches = self._get_batches()
+		if self.position >= len(batches):
+			return None
+		return next(self._gather(batches[self.position:self.position + 1], None, None))
+
+	# yields (bucket index, indices, [batch of every side]), or prepare of it, for the remaining batches of the current epoch
+	# with depth > 0 the batches are gathered and prepared by a Prefetcher in a background thread, self.prefetcher.
+	# position only counts the batches that have been returned, so that serialize never skips a prefetched batch.
+	# shard: (rank, num_shards) yields the rank-th of num_shards consecutive parts of every batch, None if it is empty
+	def iterate(self, prepare=None, depth=0, shard=None):
+		batches = self._get_batches()
+		items = self._gather(batches[self.position:], prepare, shard)
+		self.prefetcher = None
+		if depth > 0:
+			self.prefetcher = Prefetcher(items, depth)
+			items = iter(self.prefetcher)
+		try:
+			for item in items:
+				self.position += 1
+				yield item
+		finally:
+			if self.prefetcher is not None:
+				self.prefetcher.close()
+		self.epoch += 1
+		self.position = 0
+		self._epoch_state = None
+		self._batches = None
+
+	def serialize(self, serializer):
+		self.epoch = int(serializer("epoch", self.epoch))
+		self.position = int(serializer("position", self.position))
+		if self._epoch_state is None:
+			self._epoch_state = self.random_state.get_state()
+		name, keys, pos, has_gauss, cached_gaussian = self._epoch_state
+		keys = serializer("keys", keys)
+		pos = int(serializer("pos", pos))
+		has_gauss = int(serializer("has_gauss", has_gauss))
+		cached_gaussian = float(serializer("cached_gaussian", cached_gaussian))
+		self._epoch_state = (name, keys, pos, has_gauss, cached_gaussian)
+		self._batches = None
+
+# iterates over iterable in a background thread that runs up to depth items ahead of the consumer
+# the items keep their order. an exception of the thread is raised by the consumer
+# num_waits and wait_time: how often and how long the consumer found the queue empty
+class Prefetcher(object):
+	def __init__(self, iterable, depth=2):
+		self.queue = queue.Queue(maxsize=depth)
+		self.stop_event = threading.Event()
+		self.num_items = 0
+		self.num_waits = 0
+		self.wait_time = 0
+		self.thread = threading.Thread(target=self._produce, args=(iterable,))
+		self.thread.daemon = True
+		self.thread.start()
+
+	def _put(self, item):
+		while self.stop_event.is_set() == False:
+			try:
+				self.queue.put(item, timeout=0.1)
+				return True
+			except queue.Full:
+				pass
+		return False
+
+	def _produce(self, iterable):
+		end = (None, None)
+		try:
+			for item in iterable:
+				if self._put((True, item)) == False:
+					return
+		except BaseException as e:	# not only Exception, __iter__ would wait forever for the end of a thread that has died
+			end = (False, e)
+		finally:
+			self._put(end)
+
+	def __iter__(self):
+		while True:
+			if self.queue.empty():
+				start_time = time.time()
+				ok, item = self.queue.get()
+				self.num_waits += 1
+				self.wait_time += time.time() - start_time
+			else:
+				ok, item = self.queue.get()
+			if ok is None:
+				return
+			if ok == False:
+				raise item
+			self.num_items += 1
+			yield item
+
+	def close(self):
+		self.stop_event.set()
+		self.thread.join()
+
+# drops the columns of a batch that are padding in every row, width is the length of its longest sentence
+def trim_batch(matrix, width, left_padding=False):
+	return matrix[:, matrix.shape[1] - width:] if left_padding else matrix[:, :width]
+
+# candidate bucket sizes of one side: 0 (no bucket yet), the distinct lengths or max_candidates quantiles of them, and the longest length
+def _get_size_candidates(lengths, max_candidates):
+	candidates = np.unique(lengths)
+	if max_candidates is not None and candidates.size > max_candidates:
+		candidates = np.unique(np.sort(lengths)[np.linspace(0, lengths.size - 1, max_candidates).astype(np.int64)])	# quantiles
+	return np.concatenate(([0], candidates, [lengths.max()])) if candidates[-1] != lengths.max() else np.concatenate(([0], candidates))
+
+# bucket sizes that minimize the number of padded tokens over lengths (num_sentences,) or (num_sentences, num_sides)
+# the buckets form a chain, so a sentence (pair) goes to the first bucket that fits every side, as in make_buckets,
+# and the last bucket fits the longest sentences.
+# dynamic programming over the grid of candidate sizes: dp[k, i, j] is the smallest padding of the sentences that fit (S_i, T_j)
+# with k buckets whose last one is (S_i, T_j). with two sides every side has at most max_candidates candidates,
+# with one side all distinct lengths are used and the result is exact.
+def optimize_bucket_sizes(lengths, num_buckets, max_candidates=48):
+	lengths = np.asarray(lengths, dtype=np.int64)
+	if lengths.ndim == 1:
+		lengths = lengths[:, None]
+	num_sides = lengths.shape[1]
+	assert num_sides in (1, 2) and len(lengths) > 0 and num_buckets > 0
+	if num_sides == 1:
+		lengths = np.concatenate((lengths, np.zeros_like(lengths)), axis=1)
+		max_candidates = None
+	candidates = [_get_size_candidates(lengths[:, side], max_candidates) for side in range(2)]
+	S, T = candidates
+	shape = (S.size, T.size)
+
+	# count, sum of source lengths and sum of target lengths of the sentences that fit (S_i, T_j)
+	rows = np.searchsorted(S, lengths[:, 0], side="left")
+	columns = np.searchsorted(T, lengths[:, 1], side="left")
+	def integrate(weights):
+		grid = np.zeros(shape, dtype=np.float64)
+		np.add.at(grid, (rows, columns), weights)
+		return grid.cumsum(axis=0).cumsum(axis=1)
+	N = integrate(1)
+	L = integrate(lengths.sum(axis=1))
+	size = S[:, None] + T[None, :]
+
+	# padding of the sentences that fit (i, j) but not the previous bucket (a, b): size[i, j] * (N[i, j] - N[a, b]) - (L[i, j] - L[a, b])
+	dp = np.full(shape, np.inf)
+	dp[0, 0] = 0
+	backpointers = []
+	for k in range(num_buckets):
+		A = dp + L
+		new_dp = np.full(shape, np.inf)
+		pointer = np.zeros(shape, dtype=np.int64)
+		for i in range(1, shape[0]):
+			for j in range(shape[1] if num_sides == 2 else 1):
+				cost = A[:i + 1, :j + 1] - size[i, j] * N[:i + 1, :j + 1]
+				index = np.argmin(cost)
+				new_dp[i, j] = cost.flat[index] + size[i, j] * N[i, j] - L[i, j]
+				pointer[i, j] = np.ravel_multi_index(np.unravel_index(index, cost.shape), shape)
+		dp = new_dp
+		backpointers.append(pointer)
+
+	# backtrack from the bucket that fits every sentence
+	state = np.ravel_multi_index((shape[0] - 1, 0 if num_sides == 1 else shape[1] - 1), shape)
+	bucket_sizes = []
+	for pointer in reversed(backpointers):
+		i, j = np.unravel_index(state, shape)
+		if i == 0:
+			break
+		bucket_sizes.append((int(S[i]), int(T[j])))
+		state = pointer[i, j]
+	bucket_sizes = sorted(set(bucket_sizes))	# fewer buckets may be optimal
+	if num_sides == 1:
+		return [size for size, _ in bucket_sizes]
+	return bucket_sizes
+
+def hash_file(filename, h, chunk_size=1 << 20):
+	with open(filename, "rb") as f:
+		while True:
+			chunk = f.read(chunk_size)
+			if len(chunk) == 0:
+				break
+			h.update(chunk)
+
+# the key changes whenever the content of an input file, the initial vocabulary or an option changes
+def get_cache_key(filenames, vocabs, options):
+	h = hashlib.sha1()
+	h.update(repr((CACHE_VERSION, sorted(options.items()))).encode("utf-8"))
+	for filename in filenames:
+		if filename is None:
+			h.update(b"\0none\0")
+			continue
+		h.update(b"\0file\0")
+		hash_file(filename, h)
+	for vocab in vocabs:
+		if vocab is None:
+			h.update(b"\0none\0")
+			continue
+		h.update(b"\0vocab\0")
+		h.update(pickle.dumps(sorted(vocab.items()), protocol=2))
+	return h.hexdigest()
+
+# an entry is the directory cache_dir/key holding the arrays of every dataset and vocab.pickle
+def load_cache(cache_dir, key, names, mmap_mode="r"):
+	dirname = os.path.join(cache_dir, key)
+	vocab_filename = os.path.join(dirname, "vocab.pickle")
+	if os.path.isfile(vocab_filename) == False:
+		return None
+	try:
+		datasets = [Corpus.load(dirname, name, mmap_mode) for name in names]
+		with open(vocab_filename, "rb") as f:
+			vocabs = pickle.load(f)
+	except Exception as e:
+		print("could not load {} ({})".format(dirname, e), file=sys.stderr)
+		return None
+	return datasets, vocabs
+
+# write(dirname) writes the arrays and returns the vocabularies
+# the entry is written to a temporary directory and renamed, so readers never see a partial entry
+# read(dirname, mmap_mode) is called on the entry and its result returned, if the entry cannot be stored in cache_dir
+# it reads the temporary directory into memory before it is removed, so the corpus is never built twice
+def write_cache(cache_dir, key, write, read=None):
+	try:
+		os.makedirs(cache_dir)
+	except OSError:
+		pass
+	dirname = os.path.join(cache_dir, key)
+	try:
+		tmp_dirname = tempfile.mkdtemp(prefix=key + ".", dir=cache_dir)
+	except OSError:
+		tmp_dirname = tempfile.mkdtemp()	# the cache directory is not writable
+	try:
+		vocabs = write(tmp_dirname)
+		with open(os.path.join(tmp_dirname, "vocab.pickle"), "wb") as f:
+			pickle.dump(vocabs, f)
+		try:
+			os.rename(tmp_dirname, dirname)
+		except OSError as e:
+			if os.path.isdir(dirname) == False:	# otherwise another process has written the same entry
+				print("could not write {} ({})".format(dirname, e), file=sys.stderr)
+				return None if read is None else read(tmp_dirname, None)
+		return None if read is None else read(dirname, "r")
+	finally:
+		if os.path.isdir(tmp_dirname):
+			shutil.rmtree(tmp_dirname)
+
+def save_cache(cache_dir, key, names, datasets, vocabs):
+	assert len(names) == len(datasets)
+	def write(dirname):
+		for name, dataset in zip(names, datasets):
+			if isinstance(dataset, Corpus) == False:
+				dataset = Corpus.from_list(dataset)
+			dataset.save(dirname, name)
+		return vocabs
+	write_cache(cache_dir, key, write)
+
+# builds the corpus with build_corpus unless cache_dir already has it
+# the vocabularies of the fields are updated in place and the datasets are returned in the order of files
+# without cache_dir the corpus is built in a temporary directory and read into memory
+def load_or_build_corpus(cache_dir, key, files, fields, num_workers=0, chunk_size=10000, skip_empty=True):
+	names = [name for _, split_names in files for name in split_names]
+	if cache_dir is None:
+		dirname = tempfile.mkdtemp()
+		try:
+			dropped = build_corpus(dirname, files, fields, num_workers, chunk_size, skip_empty)
+			datasets = [Corpus.load(dirname, name, mmap_mode=None) for name in names]
+		finally:
+			shutil.rmtree(dirname)
+		_print_dropped(dropped)
+		return datasets
+
+	cached = load_cache(cache_dir, key, names)
+	if cached is None:
+		def write(dirname):
+			_print_dropped(build_corpus(dirname, files, fields, num_workers, chunk_size, skip_empty))
+			return [field.vocab for field in fields]
+		def read(dirname, mmap_mode):
+			return load_cache(os.path.dirname(dirname), os.path.basename(dirname), names, mmap_mode)
+		cached = write_cache(cache_dir, key, write, read)
+		if cached is None:
+			raise Exception("could not read the corpus built in {}".format(cache_dir))
+	datasets, vocabs = cached
+	for field, vocab in zip(fields, vocabs):
+		field.vocab.update(vocab)
+	return datasets
+
+def _print_dropped(dropped):
+	if dropped["empty"] > 0:
+		print("skipped {} sentences with an empty line".format(dropped["empty"]))
+	if dropped["long"] > 0:
+		print("skipped {} sentences longer than max_length".format(dropped["long"]))
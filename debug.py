@@ -17,8 +17,8 @@ def test_decoder():
 	skip_mask[:, :1] = 0
 	skip_mask[0, :2] = 0
 
-	encoder = QRNNEncoder(enc_shape[1], 4, kernel_size=4, pooling="fo", zoneout=False, zoneout_ratio=0.5)
-	decoder = QRNNDecoder(dec_shape[1], 4, kernel_size=4, pooling="fo", zoneout=False, zoneout_ratio=0.5)
+	encoder = QRNNEncoder(enc_shape[1], 4, kernel_size=4, pooling="fo", zoneout=False)
+	decoder = QRNNDecoder(dec_shape[1], 4, kernel_size=4, pooling="fo", zoneout=False)
 
 	np.random.seed(0)
 	H = encoder(enc_data, skip_mask)
@@ -28,8 +28,8 @@ def test_decoder():
 	np.random.seed(0)
 	decoder.reset_state()
 	for t in xrange(dec_shape[2]):
-		y = decoder.forward_one_step(dec_data[:, :, :t+1], ht)
-		assert np.sum((y.data - Y.data[:, :, :t+1]) ** 2) == 0
+		y = decoder.forward_one_step(dec_data[:, :, t], ht)
+		np.testing.assert_allclose(y.data, Y.data[:, :, t, None], atol=1e-6)
 		print("t = {} OK".format(t))
 
 
@@ -45,8 +45,8 @@ def test_attentive_decoder():
 	skip_mask[:, :1] = 0
 	skip_mask[0, :2] = 0
 
-	encoder = QRNNEncoder(enc_shape[1], 4, kernel_size=4, pooling="fo", zoneout=False, zoneout_ratio=0.5)
-	decoder = QRNNGlobalAttentiveDecoder(dec_shape[1], 4, kernel_size=4, zoneout=False, zoneout_ratio=0.5)
+	encoder = QRNNEncoder(enc_shape[1], 4, kernel_size=4, pooling="fo", zoneout=False)
+	decoder = QRNNGlobalAttentiveDecoder(dec_shape[1], 4, kernel_size=4, zoneout=False)
 
 	H = encoder(enc_data, skip_mask)
 	ht = encoder.get_last_hidden_state()
@@ -54,12 +54,681 @@ def test_attentive_decoder():
 
 	decoder.reset_state()
 	for t in xrange(dec_shape[2]):
-		y = decoder.forward_one_step(dec_data[:, :, :t+1], ht, H, skip_mask)
-		assert np.sum((y.data - Y.data[:, :, :t+1]) ** 2) == 0
+		y = decoder.forward_one_step(dec_data[:, :, t], ht, H, skip_mask)
+		np.testing.assert_allclose(y.data, Y.data[:, :, t, None], atol=1e-6)
 		print("t = {} OK".format(t))
 
+def test_time_major():
+	np.random.seed(0)
+	enc_shape = (2, 3, 5)
+	dec_shape = (2, 4, 7)
+	prod = enc_shape[0] * enc_shape[1] * enc_shape[2]
+	enc_data = np.arange(0, prod, dtype=np.float32).reshape(enc_shape) / prod
+	prod = dec_shape[0] * dec_shape[1] * dec_shape[2]
+	dec_data = np.arange(0, prod, dtype=np.float32).reshape(dec_shape) / prod
+	skip_mask = np.ones((enc_data.shape[0], enc_data.shape[2]), dtype=np.float32)
+	skip_mask[:, :1] = 0
+	skip_mask[0, :2] = 0
+
+	encoder = QRNNEncoder(enc_shape[1], 4, kernel_size=4, pooling="fo", zoneout=False)
+	decoder = QRNNGlobalAttentiveDecoder(dec_shape[1], 4, kernel_size=4, zoneout=False)
+	encoder_tm = QRNNEncoder(enc_shape[1], 4, kernel_size=4, pooling="fo", zoneout=False, time_major=True)
+	decoder_tm = QRNNGlobalAttentiveDecoder(dec_shape[1], 4, kernel_size=4, zoneout=False, time_major=True)
+	encoder_tm.copyparams(encoder)
+	decoder_tm.copyparams(decoder)
+
+	H = encoder(enc_data, skip_mask)
+	ht = encoder.get_last_hidden_state()
+	Y = decoder(dec_data, ht, H, skip_mask)
+
+	# (batchsize, channels, seq_length) -> (seq_length, batchsize, channels)
+	enc_data = enc_data.transpose((2, 0, 1))
+	dec_data = dec_data.transpose((2, 0, 1))
+	H_tm = encoder_tm(enc_data, skip_mask)
+	ht_tm = encoder_tm.get_last_hidden_state()
+	Y_tm = decoder_tm(dec_data, ht_tm, H_tm, skip_mask)
+	np.testing.assert_allclose(H.data.transpose((2, 0, 1)), H_tm.data, atol=1e-6)
+	np.testing.assert_allclose(Y.data.transpose((2, 0, 1)), Y_tm.data, atol=1e-6)
+
+	decoder_tm.reset_state()
+	for t in xrange(dec_shape[2]):
+		y = decoder_tm.forward_one_step(dec_data[t], ht_tm, H_tm, skip_mask)
+		np.testing.assert_allclose(y.data, Y_tm.data[t, None], atol=1e-6)
+		print("t = {} OK".format(t))
+
+# the per-step pooling of the original implementation
+def _reference_pooling(Z, F, O, I, c0, skip_mask):
+	import chainer.functions as functions
+	ct, H = c0, []
+	for t in xrange(Z.shape[2]):
+		zt, ft = Z[..., t], F[..., t]
+		ot = 1 if O is None else O[..., t]
+		it = 1 - ft if I is None else I[..., t]
+		xt = 1 if skip_mask is None else skip_mask[:, t, None]
+		if ct is None:
+			ct = (1 - ft) * zt * xt
+		else:
+			ct = ft * ct + it * zt * xt
+		H.append(ct if O is None else ot * ct)
+	return functions.stack(H, axis=2)
+
+def test_pooling_gradient():
+	import chainer
+	from chainer import gradient_check
+	from qrnn import QRNNPooling
+	shape = (3, 4, 6)
+	skip_mask = np.ones((shape[0], shape[2]), dtype=np.float64)
+	skip_mask[:, :1] = 0
+	skip_mask[0, :3] = 0
+	for pooling in ["f", "fo", "ifo"]:
+		for use_c0 in [False, True]:
+			for mask in [None, skip_mask]:
+				for time_major in [False, True]:
+					np.random.seed(0)
+					Z = np.random.uniform(-1, 1, shape)
+					gates = [np.random.uniform(0, 1, shape) for _ in pooling]
+					c0 = np.random.uniform(-1, 1, shape[:2])
+					inputs = [Z] + gates + ([c0] if use_c0 else [])
+					gH = np.random.uniform(-1, 1, shape)
+					gC = np.random.uniform(-1, 1, shape)
+					to_layout = (lambda x: np.ascontiguousarray(x.transpose(2, 0, 1)) if x.ndim == 3 else x) if time_major else (lambda x: x)
+
+					def f(*xs):
+						return QRNNPooling(pooling, use_c0, mask, time_major)(*xs)
+					y_grad = [to_layout(gH), to_layout(gC)] if len(pooling) > 1 else to_layout(gC)
+					gradient_check.check_backward(f, [to_layout(x) for x in inputs], y_grad, dtype=np.float64, atol=1e-5, rtol=1e-4)
+
+					# same outputs and gradients as the per-step pooling
+					xs = [chainer.Variable(x) for x in inputs]
+					Zv, Fv = xs[0], xs[1]
+					Ov = xs[2] if len(pooling) >= 2 else None
+					Iv = xs[3] if len(pooling) == 3 else None
+					c0v = xs[-1] if use_c0 else None
+					H_ref = _reference_pooling(Zv, Fv, Ov, Iv, c0v, mask)
+					chainer.functions.sum(H_ref * gH).backward()
+					ref_grads = [x.grad for x in xs]
+
+					xs = [chainer.Variable(to_layout(x)) for x in inputs]
+					outputs = f(*xs)
+					H = outputs[0] if len(pooling) > 1 else outputs
+					assert np.allclose(H.data, to_layout(H_ref.data), atol=1e-12)
+					chainer.functions.sum(H * to_layout(gH)).backward()
+					for x, ref_grad in zip(xs, ref_grads):
+						assert np.allclose(x.grad, to_layout(ref_grad), atol=1e-12)
+		print("pooling = {} OK".format(pooling))
+
+def test_hidden_state_buffer():
+	import chainer
+	import chainer.functions as F
+	from qrnn import HiddenStateBuffer, _time_slice
+	batchsize, channels, num_steps = 2, 3, 40
+	for time_major in [False, True]:
+		axis = 0 if time_major else 2
+		np.random.seed(0)
+		steps = [chainer.Variable(np.random.normal(size=(batchsize, channels))) for _ in xrange(num_steps)]
+		chunk = chainer.Variable(np.random.normal(size=(5, batchsize, channels) if time_major else (batchsize, channels, 5)))
+		buffer = HiddenStateBuffer(time_major=time_major)
+		views = []
+		for h in steps:
+			views.append(buffer.append(h))	# grows past the capacity of 16 and 32
+		H = buffer.append(chunk)
+		assert buffer.length == num_steps + 5 and buffer.data.shape[axis] == 64
+
+		reference = F.concat([F.expand_dims(h, axis) for h in steps] + [chunk], axis=axis)
+		assert np.all(H.data == reference.data)
+		for t, view in enumerate(views):
+			assert view.shape[axis] == t + 1
+			assert np.all(view.data == reference.data[_time_slice(0, t + 1, time_major)])	# not overwritten by later appends
+
+		# backward through the final variable and through a view of an earlier buffer
+		weights = np.random.normal(size=H.shape)
+		loss = F.sum(H * weights) + F.sum(views[10] * weights[_time_slice(0, 11, time_major)])
+		loss.backward()
+		grads = [h.grad.copy() for h in steps] + [chunk.grad.copy()]
+		for h in steps + [chunk]:
+			h.cleargrad()
+		loss = F.sum(reference * weights) + F.sum(reference[_time_slice(0, 11, time_major)] * weights[_time_slice(0, 11, time_major)])
+		loss.backward()
+		for h, grad in zip(steps + [chunk], grads):
+			assert np.allclose(h.grad, grad, atol=1e-12)
+		print("time_major = {} OK".format(time_major))
+
+def test_chunked_scan():
+	from multiprocessing.pool import ThreadPool
+	import qrnn
+	pool = ThreadPool(3)
+	for seq_length in [17, 33, 101]:
+		for num_chunks in [2, 3, 5]:
+			for use_c0 in [False, True]:
+				np.random.seed(0)
+				X = np.random.uniform(-1, 1, (seq_length, 2, 3)).astype(np.float32)
+				A = np.random.uniform(0, 1, (seq_length - 1, 2, 3)).astype(np.float32)
+				a0 = np.random.uniform(0, 1, (2, 3)).astype(np.float32) if use_c0 else None
+				c0 = np.random.uniform(-1, 1, (2, 3)).astype(np.float32) if use_c0 else None
+				expected = qrnn._serial_scan(X.copy(), A, a0, c0)
+				Y = qrnn._chunked_scan(X.copy(), A, a0, c0, num_chunks, pool)
+				assert np.allclose(Y, expected, atol=1e-6)
+	pool.close()
+	assert qrnn.set_pooling_threads(64) <= qrnn._get_num_cores()
+	qrnn.set_pooling_threads(0)
+	print("chunked scan OK")
+
+def test_convolution_gradient():
+	import chainer
+	from chainer import gradient_check
+	from convolution_1d import CausalConvolution1DFunction
+	batchsize, in_channels, out_channels, seq_length = 2, 3, 4, 7
+	for ksize in [1, 2, 4]:
+		for pad in sorted(set([0, 1, ksize - 1])):
+			for time_major in [False, True]:
+				for use_bias in [False, True]:
+					np.random.seed(0)
+					x = np.random.uniform(-1, 1, (seq_length, batchsize, in_channels) if time_major else (batchsize, in_channels, seq_length))
+					W = np.random.uniform(-1, 1, (out_channels, in_channels, ksize))
+					b = np.random.uniform(-1, 1, (out_channels,))
+					out_length = seq_length + pad - ksize + 1
+					gy = np.random.uniform(-1, 1, (out_length, batchsize, out_channels) if time_major else (batchsize, out_channels, out_length))
+					inputs = [x, W, b] if use_bias else [x, W]
+					gradient_check.check_backward(CausalConvolution1DFunction(pad, time_major), inputs, gy, dtype=np.float64, atol=1e-5, rtol=1e-4)
+
+					# same output as chainer's convolution with the input padded on the left
+					x_bm = x.transpose(1, 2, 0) if time_major else x
+					x_pad = np.concatenate((np.zeros((batchsize, in_channels, pad)), x_bm), axis=2)
+					y_ref = chainer.functions.convolution_nd(x_pad, W, b if use_bias else None).data
+					y, = CausalConvolution1DFunction(pad, time_major).forward(inputs)
+					assert np.allclose(y.transpose(1, 2, 0) if time_major else y, y_ref, atol=1e-12)
+		print("ksize = {} OK".format(ksize))
+
+def test_weightnorm_cache():
+	import os, tempfile, chainer
+	from chainer import serializers
+	from convolution_1d import WeightnormCausalConvolution1D, clear_weightnorm_cache, fold_weightnorm
+	from qrnn import QRNN
+
+	def expected_W(conv):
+		V = conv.V.data
+		return conv.g.data * V / np.sqrt(np.sum(V ** 2, axis=(1, 2), keepdims=True))
+
+	np.random.seed(0)
+	x = np.random.normal(size=(2, 3, 6)).astype(np.float32)
+	conv = WeightnormCausalConvolution1D(3, 4, 2)
+	conv(x)	# initializes g and b
+	assert conv._get_W() is conv._get_W()
+	assert np.allclose(conv.W, expected_W(conv))
+
+	# an optimizer step
+	optimizer = chainer.optimizers.SGD(lr=0.1)
+	optimizer.setup(conv)
+	W = conv.W.copy()
+	optimizer.update(lambda: chainer.functions.sum(conv(x) ** 2))
+	assert np.allclose(conv.W, expected_W(conv)) and np.any(conv.W != W)
+
+	# copyparams, load_npz and hand edits change V and g in place
+	other = WeightnormCausalConvolution1D(3, 4, 2)
+	other(x)
+	conv.copyparams(other)
+	assert np.allclose(conv.W, other.W)
+	filename = os.path.join(tempfile.mkdtemp(), "conv.npz")
+	serializers.save_npz(filename, conv)
+	conv.V.data *= 3
+	conv.g.data *= 2
+	clear_weightnorm_cache(conv)
+	assert np.allclose(conv.W, expected_W(conv)) and np.allclose(conv.W, other.W * 2)
+	serializers.load_npz(filename, conv)
+	assert np.allclose(conv.W, other.W)
+
+	# a folded layer computes the same outputs
+	layer = QRNN(3, 4, kernel_size=2, pooling="fo", weightnorm=True)
+	with chainer.using_config("train", False):
+		layer(x)
+		layer.reset_state()
+		y = layer(x).data
+		fold_weightnorm(layer)
+		assert not any(isinstance(child, WeightnormCausalConvolution1D) for child in layer.links())
+		layer.reset_state()
+		assert np.allclose(layer(x).data, y, atol=1e-6)
+	print("weightnorm cache OK")
+
+def test_dense_feature_buffer():
+	import chainer
+	import chainer.functions as F
+	from convolution_1d import CausalConvolution1D
+	from qrnn import DenseFeatureBuffer, forward_layers, _channel_slice
+	num_layers, in_channels, width = 4, 3, 5
+	for time_major in [False, True]:
+		channel_axis = 2 if time_major else 1
+		np.random.seed(0)
+		layers = [CausalConvolution1D(in_channels if i == 0 else width * i, width, 2, time_major=time_major) for i in xrange(num_layers)]
+		x = np.random.normal(size=(7, 2, in_channels) if time_major else (2, in_channels, 7)).astype(np.float32)
+		weights = np.random.normal(size=(7, 2, width * num_layers) if time_major else (2, width * num_layers, 7)).astype(np.float32)
+
+		outputs = []
+
+		def forward_layer(i, h):
+			outputs.append(F.tanh(layers[i](h)))
+			return outputs[-1]
+
+		# the loss reads all features, or only the last layer so that the last reader never runs backward
+		for use_all_features in [True, False]:
+			results = []
+			for use_buffer in [True, False]:
+				for layer in layers:
+					layer.cleargrads()
+				del outputs[:]
+				x_var = chainer.Variable(x)
+				if use_buffer:
+					y = forward_layers(layers, forward_layer, x_var, densely_connected=True, time_major=time_major)
+				else:
+					# every layer reads the concatenated outputs of all previous layers
+					h = x_var
+					for i in xrange(num_layers):
+						forward_layer(i, h)
+						h = F.concat(outputs, axis=channel_axis)
+					y = h
+				if use_all_features:
+					F.sum(y * weights).backward()
+				else:
+					F.sum(outputs[-1] * weights[_channel_slice(0, width, time_major)]).backward()
+				results.append([y.data, x_var.grad] + [param.grad for layer in layers for param in layer.params()])
+			for a, b in zip(*results):
+				assert np.allclose(a, b, atol=1e-5)
+
+	# a reader that runs backward before a later one is detected
+	features = DenseFeatureBuffer(2)
+	h1 = F.tanh(chainer.Variable(np.ones((2, 3, 4), dtype=np.float32)))
+	h2 = chainer.Variable(np.ones((2, 3, 4), dtype=np.float32))	# does not depend on the first reader
+	y = F.sum(features.append(h1)) + F.sum(features.append(h2))
+	try:
+		y.backward()
+		assert False
+	except AssertionError as e:
+		assert "DenseFeatureBuffer" in str(e)
+	print("dense feature buffer OK")
+
+def test_batched_attention():
+	import chainer
+	import chainer.functions as F
+	batchsize, enc_length, dec_length, channels = 3, 5, 6, 4
+	skip_mask = np.ones((batchsize, enc_length), dtype=np.float32)
+	skip_mask[0, :2] = 0
+	skip_mask[2, :1] = 0
+	for time_major in [False, True]:
+		for mask in [None, skip_mask]:
+			np.random.seed(0)
+			decoder = QRNNGlobalAttentiveDecoder(3, channels, kernel_size=3, zoneout=False, time_major=time_major)
+			X = np.random.normal(size=(dec_length, batchsize, 3) if time_major else (batchsize, 3, dec_length)).astype(np.float32)
+			H_enc = np.random.normal(size=(enc_length, batchsize, channels) if time_major else (batchsize, channels, enc_length)).astype(np.float32)
+			ht = np.random.normal(size=(batchsize, channels)).astype(np.float32)
+			weights = np.random.normal(size=(dec_length, batchsize, channels) if time_major else (batchsize, channels, dec_length)).astype(np.float32)
+
+			results = []
+			for batched in [True, False]:
+				decoder.cleargrads()
+				decoder.reset_state()
+				H_var = chainer.Variable(H_enc)
+				if batched:
+					Y = decoder(X, ht, H_var, mask)
+				else:
+					# one timestep at a time, every step attends with its own context
+					steps = [decoder.forward_one_step(X[t] if time_major else X[..., t], ht, H_var, mask) for t in xrange(dec_length)]
+					Y = F.concat(steps, axis=0 if time_major else 2)
+				F.sum(Y * weights).backward()
+				results.append([Y.data, H_var.grad, decoder.context.data] + [param.grad for _, param in sorted(decoder.namedparams())])
+			for a, b in zip(*results):
+				np.testing.assert_allclose(a, b, atol=1e-5)
+		print("time_major = {} OK".format(time_major))
+
+def test_corpus():
+	import os, tempfile, corpus
+	sequences = [[0, 5, 3, 1], [], [0, 7, 1], [2] * 40]
+	cache_dir = tempfile.mkdtemp()
+	filename = os.path.join(cache_dir, "train.txt")
+	with open(filename, "w") as f:
+		f.write("a b c\n")
+
+	key = corpus.get_cache_key((filename, None), ({"<eos>": 1},), {"reader": "test"})
+	assert key != corpus.get_cache_key((filename, None), ({"<eos>": 2},), {"reader": "test"})
+	assert corpus.load_cache(cache_dir, key, ("train", "dev")) is None
+	corpus.save_cache(cache_dir, key, ("train", "dev"), (sequences, []), {"a": 3})
+	(train, dev), vocab = corpus.load_cache(cache_dir, key, ("train", "dev"))
+	assert isinstance(train.tokens, np.memmap)
+	assert train.tolist() == sequences and dev.tolist() == [] and vocab == {"a": 3}
+	assert list(train[2]) == [0, 7, 1] and list(train.lengths()) == [4, 0, 3, 40]
+	assert train.fingerprint() == corpus.fingerprint(sequences)
+
+	with open(filename, "a") as f:
+		f.write("d\n")
+	assert key != corpus.get_cache_key((filename, None), ({"<eos>": 1},), {"reader": "test"})
+	print("corpus OK")
+
+def test_build_corpus():
+	import os, tempfile, corpus
+	dirname = tempfile.mkdtemp()
+	lines_source = ["a b c", "b d", "", "e a f f", "c"] * 7
+	lines_target = ["x y", "y", "z", "x w v u", "w"] * 7
+	for name, lines in (("source", lines_source), ("target", lines_target)):
+		with open(os.path.join(dirname, name + ".txt"), "w") as f:
+			f.write("\n".join(lines) + "\n")
+	files = [((os.path.join(dirname, "source.txt"), os.path.join(dirname, "target.txt")), ("source", "target"))]
+
+	results = []
+	for num_workers, chunk_size in ((0, 10000), (2, 3)):
+		fields = [corpus.Field({"<unk>": 0}, grow_vocab=True, reverse=True), corpus.Field({"<unk>": 0, "<go>": 1, "<eos>": 2}, grow_vocab=True, prefix=1, suffix=2, max_length=5)]
+		dropped = corpus.build_corpus(dirname, files, fields, num_workers=num_workers, chunk_size=chunk_size)
+		source, target = corpus.Corpus.load(dirname, "source"), corpus.Corpus.load(dirname, "target")
+		results.append((source.tolist(), target.tolist(), fields[0].vocab, fields[1].vocab))
+		assert dropped == {"empty": 7, "long": 7}
+	assert results[0] == results[1]
+	source, target, vocab_source, vocab_target = results[0]
+	assert source[:3] == [[3, 2, 1], [4, 2], [3]] and target[:3] == [[1, 3, 4, 2], [1, 4, 2], [1, 5, 2]]
+	assert list(vocab_source) == ["<unk>", "a", "b", "c", "d"]	# the words of dropped pairs are not added
+
+	with open(os.path.join(dirname, "target.txt"), "a") as f:
+		f.write("x\n")
+	try:
+		corpus.build_corpus(dirname, files, fields)
+		assert False
+	except Exception as e:
+		assert "same number of lines" in str(e)
+
+	# a cache directory that cannot be written to builds the corpus once and reads it into memory
+	with open(os.path.join(dirname, "target.txt"), "w") as f:
+		f.write("\n".join(lines_target) + "\n")
+	build_corpus, num_builds = corpus.build_corpus, []
+	def counting_build_corpus(*args, **kwargs):
+		num_builds.append(1)
+		return build_corpus(*args, **kwargs)
+	corpus.build_corpus = counting_build_corpus
+	try:
+		fields = [corpus.Field({"<unk>": 0}, grow_vocab=True, reverse=True), corpus.Field({"<unk>": 0, "<go>": 1, "<eos>": 2}, grow_vocab=True, prefix=1, suffix=2, max_length=5)]
+		datasets = corpus.load_or_build_corpus(os.path.join(dirname, "source.txt"), "key", files, fields)	# a file, not a directory
+	finally:
+		corpus.build_corpus = build_corpus
+	assert len(num_builds) == 1
+	assert [dataset.tolist() for dataset in datasets] == [source, target]
+	print("build_corpus OK")
+
+def test_make_buckets():
+	import corpus
+	source = [[1, 2], [3, 4, 5, 6], [7], [8, 9, 10, 11, 12]]
+	target = [[1, 2, 3], [4], [5, 6, 7, 8], [9]]
+	bucket_sizes = [(2, 3), (4, 4)]
+	(buckets_source, buckets_target), (masks_source, masks_target) = corpus.make_buckets([source, target], bucket_sizes, 0, [True, False])
+	assert len(buckets_source) == 2	# the last pair does not fit
+	assert buckets_source[0].tolist() == [[1, 2]] and buckets_target[0].tolist() == [[1, 2, 3]]
+	assert buckets_source[1].tolist() == [[3, 4, 5, 6], [0, 0, 0, 7]]
+	assert buckets_target[1].tolist() == [[4, 0, 0, 0], [5, 6, 7, 8]]
+	assert masks_source[1].tolist() == [[True] * 4, [False, False, False, True]]
+	assert all(np.all(mask == (bucket != 0)) for mask, bucket in zip(masks_target, buckets_target))
+	assert buckets_source[1].dtype == np.int32 and source[2] == [7]
+	print("make_buckets OK")
+
+def test_optimize_bucket_sizes():
+	import itertools, corpus
+	def padding(lengths, sizes):
+		sizes = np.asarray(sizes).reshape((len(sizes), -1))
+		lengths = lengths.reshape((len(lengths), -1))
+		total = 0
+		for length in lengths:
+			bucket = np.nonzero(np.all(sizes >= length, axis=1))[0][0]
+			total += np.sum(sizes[bucket] - length)
+		return total
+
+	lengths = np.random.randint(1, 30, size=(60,))
+	for num_buckets in range(1, 4):
+		sizes = corpus.optimize_bucket_sizes(lengths, num_buckets)
+		best = min(padding(lengths, sorted(c) + [lengths.max()]) for c in itertools.combinations(np.unique(lengths), num_buckets - 1))
+		assert len(sizes) <= num_buckets and sizes[-1] == lengths.max() and padding(lengths, sizes) == best
+
+	pairs = np.random.randint(1, 12, size=(40, 2))
+	sizes = corpus.optimize_bucket_sizes(pairs, 3)
+	assert sizes[-1] == tuple(pairs.max(axis=0)) and sizes == sorted(sizes)
+	assert padding(pairs, sizes) <= padding(pairs, [tuple(pairs.max(axis=0))])
+	print("optimize_bucket_sizes OK")
+
+def test_make_token_batches():
+	import corpus
+	for lengths in [np.random.randint(1, 30, size=(100,)), np.random.randint(1, 30, size=(100, 2))]:
+		batches = corpus.make_token_batches(lengths, 64)
+		assert np.array_equal(np.sort(np.concatenate(batches)), np.arange(len(lengths)))
+		for indices in batches:
+			widths = np.asarray(lengths[indices]).reshape((len(indices), -1)).max(axis=0)
+			assert len(indices) == 1 or len(indices) * widths.sum() <= 64
+	assert [len(indices) for indices in corpus.make_token_batches([100, 3, 3], 10)] == [2, 1]
+
+	matrix = np.array([[0, 0, 5, 6], [0, 7, 8, 9]])
+	assert np.array_equal(corpus.trim_batch(matrix, 3, left_padding=True), matrix[:, 1:])
+	assert np.array_equal(corpus.trim_batch(matrix.T, 2), matrix.T[:, :2])
+	print("make_token_batches OK")
+
+def test_bucket_iterator():
+	import os, tempfile, corpus
+	from chainer import serializers
+	buckets = [np.arange(10)[:, None], np.arange(10, 17)[:, None]]
+	lengths = [np.random.randint(1, 9, size=(len(bucket),)) for bucket in buckets]
+	for max_tokens in [0, 12]:
+		iterator = corpus.BucketIterator([buckets], 3, lengths, max_tokens, seed=0)
+		expected = []
+		for epoch in range(2):
+			batches = [(bucket_idx, indices.tolist(), batch[:, 0].tolist()) for bucket_idx, indices, (batch,) in iterator]
+			assert sorted(sum([batch for _, _, batch in batches], [])) == list(range(17))	# every sentence once
+			assert all(batch == buckets[bucket_idx][indices, 0].tolist() for bucket_idx, indices, batch in batches)
+			expected += batches
+
+		# stop after 4 batches and resume with another seed
+		iterator = corpus.BucketIterator([buckets], 3, lengths, max_tokens, seed=0)
+		batches = []
+		for bucket_idx, indices, (batch,) in iterator:
+			batches.append((bucket_idx, indices.tolist(), batch[:, 0].tolist()))
+			if len(batches) == 4:
+				break
+		filename = os.path.join(tempfile.mkdtemp(), "iterator.npz")
+		serializers.save_npz(filename, iterator)
+		iterator = corpus.BucketIterator([buckets], 3, lengths, max_tokens, seed=1)
+		serializers.load_npz(filename, iterator)
+		while len(batches) < len(expected):
+			batches += [(bucket_idx, indices.tolist(), batch[:, 0].tolist()) for bucket_idx, indices, (batch,) in iterator]
+		assert batches == expected and iterator.epoch == 2
+	print("BucketIterator OK")
+
+def test_prefetcher():
+	import corpus
+	prefetcher = corpus.Prefetcher(iter(range(100)), 3)
+	assert list(prefetcher) == list(range(100)) and prefetcher.num_items == 100
+	prefetcher.close()
+
+	def fail():
+		yield 0
+		raise ValueError("fail")
+	try:
+		list(corpus.Prefetcher(fail(), 2))
+		assert False
+	except ValueError:
+		pass
+
+	# an exception that is not an Exception still ends the iteration instead of blocking it
+	class Interrupt(BaseException):
+		pass
+	def interrupt():
+		yield 0
+		raise Interrupt()
+	try:
+		list(corpus.Prefetcher(interrupt(), 2))
+		assert False
+	except Interrupt:
+		pass
+
+	# stopping early does not leave the thread blocked on the full queue
+	prefetcher = corpus.Prefetcher(iter(range(100)), 1)
+	assert next(iter(prefetcher)) == 0
+	prefetcher.close()
+	assert prefetcher.thread.is_alive() == False
+
+	buckets = [np.arange(20)[:, None]]
+	expected = [batch[:, 0].tolist() for _, _, (batch,) in corpus.BucketIterator([buckets], 3, seed=0)]
+	iterator = corpus.BucketIterator([buckets], 3, seed=0)
+	assert [batch[:, 0].tolist() for batch in iterator.iterate(lambda batch: batch[2][0], 2)] == expected
+	assert iterator.epoch == 1 and iterator.position == 0
+	print("Prefetcher OK")
+
+def test_data_parallel():
+	import os, tempfile, chainer, parallel
+	import chainer.functions as F
+	import chainer.links as links
+	from chainer import optimizers
+	dirname = tempfile.mkdtemp()
+	x = np.random.normal(size=(10, 5)).astype(np.float32)
+	t = np.random.randint(0, 3, size=(10,)).astype(np.int32)
+	t[:4] = -1	# the first shard has no targets
+
+	def train(communicator):
+		np.random.seed(0)
+		model = links.Linear(5, 3)
+		optimizer = optimizers.Adam()
+		optimizer.setup(model)
+		optimizer.add_hook(chainer.optimizer.GradientClipping(1))
+		rank, size = (0, 1) if communicator is None else (communicator.rank, communicator.size)
+		if communicator is not None:
+			parallel.broadcast_params(communicator, model)
+		for step in range(5):
+			rows = np.array_split(np.arange(10), size)[rank]
+			loss = F.softmax_cross_entropy(model(x[rows]), t[rows])
+			parallel.update(optimizer, loss, int((t[rows] != -1).sum()), communicator)
+		np.save(os.path.join(dirname, "{}_{}.npy".format(size, rank)), model.W.data)
+
+	parallel.run(1, train, 0)
+	parallel.run(3, train, 5 * 3 + 3 + 1)
+	W = [np.load(os.path.join(dirname, "3_{}.npy".format(rank))) for rank in range(3)]
+	assert np.array_equal(W[0], W[1]) and np.array_equal(W[0], W[2])	# bit-identical replicas
+	assert np.allclose(W[0], np.load(os.path.join(dirname, "1_0.npy")), atol=1e-5)
+
+	def fail(communicator):
+		if communicator.rank == 1:
+			raise ValueError("fail")
+		communicator.barrier()
+	try:
+		parallel.run(2, fail, 1)
+		assert False
+	except Exception:
+		pass
+	print("data parallel OK")
+
+def test_flat_optimizer():
+	import copy, chainer
+	import chainer.functions as F
+	import chainer.links as links
+	from convolution_1d import WeightnormCausalConvolution1D, weight_normalization
+	from optim import get_optimizer
+	x = np.random.normal(size=(4, 3, 6)).astype(np.float32)
+	t = np.random.randint(0, 5, size=(4,)).astype(np.int32)
+	for name in ["sgd", "msgd", "nesterov", "adam"]:
+		model = chainer.Sequential(WeightnormCausalConvolution1D(3, 8, 2), F.tanh, links.Linear(8 * 6, 5))
+		model(x)	# initializes g and b
+		models = [model, copy.deepcopy(model)]
+		optimizers = []
+		for model, flat in zip(models, [False, True]):
+			optimizer = get_optimizer(name, 0.05, 0.9, flat=flat)
+			optimizer.setup(model)
+			optimizer.add_hook(chainer.optimizer.GradientClipping(0.5))
+			optimizer.add_hook(chainer.optimizer.WeightDecay(1e-3))
+			optimizers.append(optimizer)
+		for step in range(10):
+			for model, optimizer in zip(models, optimizers):
+				loss = F.softmax_cross_entropy(model(x), t)
+				optimizer.update(lossfun=lambda: loss)
+		for (_, a), (_, b) in zip(sorted(models[0].namedparams()), sorted(models[1].namedparams())):
+			assert np.allclose(a.data, b.data, atol=1e-5)
+		assert optimizers[1].data.size == sum(param.size for param in models[1].params())
+		# the update rules are not replaced and the cached weight follows V and g
+		conv = models[1][0]
+		assert all(param.update_rule is None for param in models[1].params())
+		assert np.all(conv.W == weight_normalization(conv.V, conv.g).data)
+	print("FlatOptimizer OK")
+
+def test_sparse_embedding():
+	import copy, chainer
+	import chainer.functions as F
+	import chainer.links as links
+	from qrnn import SparseEmbedID
+	from optim import get_optimizer, decay_learning_rate
+	batches = [np.random.randint(0, 10, size=(4, 3)).astype(np.int32) for _ in range(10)]
+	for batch in batches:
+		batch[0, 0] = -1
+	t = np.random.randint(0, 5, size=(4,)).astype(np.int32)
+
+	def run(name, sparse, weight_decay, batches, eager=False):
+		np.random.seed(0)
+		model = chainer.Sequential(SparseEmbedID(20, 6, ignore_label=-1), links.Linear(18, 5))
+		optimizer = get_optimizer(name, 0.05, 0.9, flat=True, sparse_embedding=sparse)
+		optimizer.setup(model)
+		optimizer.add_hook(chainer.optimizer.GradientClipping(0.5))
+		optimizer.add_hook(chainer.optimizer.WeightDecay(weight_decay))
+		for step, x in enumerate(batches):
+			loss = F.softmax_cross_entropy(model(x), t)
+			optimizer.update(lossfun=lambda: loss)
+			if step == 4:
+				decay_learning_rate(optimizer, 0.5, 0)
+			if eager:
+				optimizer.flush()
+		optimizer.flush()
+		return model, optimizer
+
+	# sgd: the rows that no batch uses (10 - 19) decay in closed form
+	dense, _ = run("sgd", False, 1e-2, batches)
+	sparse, optimizer = run("sgd", True, 1e-2, batches)
+	assert dense[0].W.grad is not None and sparse[0].W.grad is None
+	assert optimizer.data.size == sum(param.size for param in sparse[1].params())
+	for (_, a), (_, b) in zip(sorted(dense.namedparams()), sorted(sparse.namedparams())):
+		assert np.allclose(a.data, b.data, atol=1e-5)
+
+	# adam: every row used in every step is the dense update, a row that no batch uses stays as it is
+	full = [np.tile(np.arange(10, dtype=np.int32), 6)[:12].reshape((4, 3)) for _ in range(10)]
+	dense, _ = run("adam", False, 0, full)
+	sparse, _ = run("adam", True, 0, full)
+	for (_, a), (_, b) in zip(sorted(dense.namedparams()), sorted(sparse.namedparams())):
+		assert np.allclose(a.data, b.data, atol=1e-5)
+	initial, _ = run("adam", True, 0, [])
+	assert np.all(initial[0].W.data[10:] == sparse[0].W.data[10:])
+
+	# adam: the moments of a row skipped for k steps decay by beta ** k
+	skipping = [batch.copy() for batch in full]
+	for batch in skipping[3:7]:
+		batch[batch == 9] = 8
+	_, before = run("adam", True, 0, skipping[:3])
+	_, after = run("adam", True, 0, skipping[:7])
+	for state, before_state, beta in zip(after.tables[0].states, before.tables[0].states, [0.9, 0.999]):
+		assert np.allclose(state[9], before_state[9] * beta ** 4)
+		assert not np.allclose(state[8], before_state[8] * beta ** 4)
+	assert np.all(after.tables[0].last == 7)
 
+	# the decay of the skipped steps is the same when it is applied in every step
+	for name in ["sgd", "adam"]:
+		lazy, lazy_optimizer = run(name, True, 1e-2, skipping)
+		eager, eager_optimizer = run(name, True, 1e-2, skipping, eager=True)
+		for (_, a), (_, b) in zip(sorted(lazy.namedparams()), sorted(eager.namedparams())):
+			assert np.allclose(a.data, b.data, atol=1e-5)
+		for a, b in zip(lazy_optimizer.tables[0].states, eager_optimizer.tables[0].states):
+			assert np.allclose(a, b, atol=1e-5)
+	print("SparseEmbedID OK")
 
 if __name__ == "__main__":
 	test_decoder()
-	test_attentive_decoder()
\ No newline at end of file
+	test_attentive_decoder()
+	test_time_major()
+	test_pooling_gradient()
+	test_hidden_state_buffer()
+	test_chunked_scan()
+	test_convolution_gradient()
+	test_weightnorm_cache()
+	test_dense_feature_buffer()
+	test_batched_attention()
+	test_corpus()
+	test_build_corpus()
+	test_make_buckets()
+	test_optimize_bucket_sizes()
+	test_make_token_batches()
+	test_bucket_iterator()
+	test_prefetcher()
+	test_data_parallel()
+	test_flat_optimizer()
+	test_sparse_embedding()
\ No newline at end of file
@@ -0,0 +1,533 @@
+from __future__ import division
+from __future__ import print_function
+from six.moves import xrange
+from collections import deque
+import os, json
+import numpy as np
+import h5py
+
+# graph-free inference for models saved by rnn/model.py and seq2seq/model.py
+# params.json and model.hdf5 are read without chainer and the forward pass runs on plain numpy arrays.
+# every step makes the same numpy call as the chainer forward under train=False, in the same order
+# and on arrays with the same memory layout where the layout decides the result (GEMMs and reductions),
+# so the outputs are bit-identical to the chainer models with pooling threads disabled (the default).
+# the runtime always pools with the serial scan, and the chunked scan of qrnn.set_pooling_threads(n > 1)
+# reassociates the recurrence, so a chainer model with pooling threads matches the runtime only up to rounding.
+# scratch arrays such as the im2col columns and the gate activations are reused between calls.
+
+def _get_norm(W):
+	norm = np.sqrt(np.sum(W ** 2, axis=(1, 2))) + 1e-32
+	norm = norm.reshape((-1, 1, 1))
+	return norm
+
+def _sigmoid(x, out=None):
+	half = x.dtype.type(0.5)
+	out = np.multiply(x, half, out=out)
+	np.tanh(out, out=out)
+	out *= half
+	out += half
+	return out
+
+# same as chainer.functions.softmax on the cpu
+def softmax(x, axis=1):
+	y = x - x.max(axis=axis, keepdims=True)
+	np.exp(y, out=y)
+	y /= y.sum(axis=axis, keepdims=True)
+	return y
+
+def _to_time_major(x):
+	return np.ascontiguousarray(x.transpose(2, 0, 1))
+
+def _to_batch_major(x):
+	return x.transpose(1, 2, 0)
+
+# arrays that are overwritten on every call and only reallocated when the shape changes
+class Workspace(object):
+	def __init__(self):
+		self.arrays = {}
+
+	def get(self, name, shape, dtype):
+		array = self.arrays.get(name)
+		if array is None or array.shape != shape or array.dtype != dtype:
+			array = np.empty(shape, dtype=dtype)
+			self.arrays[name] = array
+		return array
+
+class Params(object):
+	def __init__(self, filename):
+		self.file = h5py.File(filename, "r")
+
+	def get(self, name):
+		return np.asarray(self.file[name])
+
+	def has(self, name):
+		return name in self.file
+
+	# plain or weight-normalized convolution weight
+	def get_convolution(self, name):
+		if self.has(name + "/W"):
+			W = self.get(name + "/W")
+		else:
+			V = self.get(name + "/V")
+			g = self.get(name + "/g")
+			W = g * (V / _get_norm(V))
+		b = self.get(name + "/b") if self.has(name + "/b") else None
+		return W, b
+
+	def close(self):
+		self.file.close()
+
+class EmbedID(object):
+	def __init__(self, W, ignore_label=None):
+		self.W = W
+		self.ignore_label = ignore_label
+
+	def __call__(self, x):
+		if self.ignore_label is not None:
+			mask = (x == self.ignore_label)
+			return np.where(mask[..., None], 0, self.W[np.where(mask, 0, x)])
+		return self.W[x]
+
+class Linear(object):
+	def __init__(self, W, b):
+		self.W = W
+		self.b = b
+
+	def __call__(self, x):
+		if not (x.flags.c_contiguous or x.flags.f_contiguous) and 1 in x.shape:
+			x = np.ascontiguousarray(x)
+		y = np.empty((x.shape[0], self.W.shape[0]), dtype=x.dtype)
+		np.dot(x, self.W.T, out=y)
+		y += self.b
+		return y
+
+# causal convolution as one GEMM, see convolution_1d.CausalConvolution1DFunction
+class CausalConvolution1D(object):
+	def __init__(self, W, b, time_major=False, reuse_output=True):
+		out_channels, in_channels, ksize = W.shape
+		self.ksize = ksize
+		self.out_channels = out_channels
+		self.matrix = W.transpose(2, 1, 0).reshape((ksize * in_channels, out_channels))
+		self.b = b
+		self.time_major = time_major
+		self.reuse_output = reuse_output
+		self.workspace = Workspace()
+
+	# with reuse_output the result is a view of a scratch array that is overwritten by the next call
+	def __call__(self, x, pad=None):
+		if pad is None:
+			pad = self.ksize - 1
+		if self.time_major == False:
+			x = x.transpose(2, 0, 1)
+		seq_length, batchsize, in_channels = x.shape
+		out_length = seq_length + pad - self.ksize + 1
+
+		x_pad = self.workspace.get("x_pad", (seq_length + pad, batchsize, in_channels), x.dtype)
+		x_pad[:pad] = 0
+		x_pad[pad:] = x
+		col = self.workspace.get("col", (out_length, batchsize, self.ksize, in_channels), x.dtype)
+		for j in xrange(self.ksize):
+			col[:, :, j] = x_pad[j:j + out_length]
+		col = col.reshape((out_length * batchsize, self.ksize * in_channels))
+
+		shape = (out_length * batchsize, self.out_channels)
+		y = self.workspace.get("y", shape, x.dtype) if self.reuse_output else np.empty(shape, dtype=x.dtype)
+		np.dot(col, self.matrix, out=y)
+		if self.b is not None:
+			y += self.b
+		y = y.reshape((out_length, batchsize, self.out_channels))
+		if self.time_major:
+			return y
+		return y.transpose(1, 2, 0)
+
+class QRNN(object):
+	def __init__(self, W, b, pooling, time_major=False):
+		self.W = CausalConvolution1D(W, b, time_major)
+		self.num_split = len(pooling) + 1
+		self.out_channels = W.shape[0] // self.num_split
+		self.kernel_size = W.shape[2]
+		self.time_major = time_major
+		self.time_axis = 0 if time_major else 2
+		self.channel_axis = 2 if time_major else 1
+		self.workspace = Workspace()
+		self.reset_state()
+
+	def reset_state(self):
+		self.ct = None
+		self.ht = None
+		self.H = None
+		self.X = deque(maxlen=self.kernel_size - 1)
+
+	def reorder_state(self, indices):
+		batch_axis = 1 if self.time_major else 0
+		self.ct = None if self.ct is None else self.ct[indices]
+		self.ht = None if self.ht is None else self.ht[indices]
+		if self.H is not None:
+			self.H = self.H[:, indices] if batch_axis == 1 else self.H[indices]
+		X = [x[:, indices] if batch_axis == 1 else x[indices] for x in self.X]
+		self.X = deque(X, maxlen=self.kernel_size - 1)
+
+	def get_last_hidden_state(self):
+		return self.ht
+
+	def get_all_hidden_states(self):
+		return self.H
+
+	def _step(self, X, t):
+		return X[t] if self.time_major else X[..., t]
+
+	def _time_slice(self, X, start, end):
+		return X[start:end] if self.time_major else X[..., start:end]
+
+	def convolve(self, X):
+		WX = self.W(X)
+		pad = self.kernel_size - 1
+		seq_length = X.shape[self.time_axis]
+		for t in xrange(max(seq_length - pad, 0), seq_length):
+			self.X.append(self._time_slice(X, t, t + 1))
+		return WX
+
+	def convolve_one_step(self, X):
+		if X.ndim == 2:
+			X = np.expand_dims(X, self.time_axis)
+		pad = self.kernel_size - 1
+		window = list(self.X) + [X]
+		if len(self.X) < pad:
+			shape = list(X.shape)
+			shape[self.time_axis] = pad - len(self.X)
+			window.insert(0, np.zeros(shape, dtype=X.dtype))	# left paddings
+		if pad > 0:
+			self.X.append(X)
+			window = np.concatenate(window, axis=self.time_axis)
+		else:
+			window = X
+		return self.W(window, pad=0)
+
+	# gates of the convolution output as time-major arrays
+	def _activate(self, WX):
+		WX = _to_time_major(WX) if self.time_major == False else WX
+		C = self.out_channels
+		gates = []
+		for i in xrange(self.num_split):
+			gate = self.workspace.get("gate{}".format(i), WX.shape[:2] + (C,), WX.dtype)
+			if i == 0:
+				np.tanh(WX[..., :C], out=gate)
+			else:
+				_sigmoid(WX[..., i * C:(i + 1) * C], out=gate)
+			gates.append(gate)
+		return gates
+
+	# see qrnn.QRNNPooling.forward
+	def pool(self, WX, skip_mask=None):
+		gates = self._activate(WX)
+		Z, F = gates[0], gates[1]
+		O = gates[2] if self.num_split > 2 else None
+		I = gates[3] if self.num_split > 3 else None
+		X = None
+		if skip_mask is not None:
+			X = np.asarray(skip_mask, dtype=Z.dtype).T[..., None]
+
+		C = (1 - F) * Z if I is None else I * Z
+		if X is not None:
+			C *= X
+		if self.ct is None and I is not None:
+			C[0] = (1 - F[0]) * Z[0] if X is None else (1 - F[0]) * Z[0] * X[0]
+
+		if self.ct is not None:
+			C[0] += F[0] * self.ct
+		for t in xrange(1, C.shape[0]):
+			C[t] += F[t] * C[t - 1]
+
+		H = C if O is None else O * C
+		self.ct = C[-1]
+		self.ht = H[-1]
+		if self.time_major == False:
+			H = _to_batch_major(H)
+		self.H = H
+		return H
+
+	def __call__(self, X, skip_mask=None):
+		return self.pool(self.convolve(X), skip_mask)
+
+	def forward_one_step(self, X, skip_mask=None):
+		return self.pool(self.convolve_one_step(X), skip_mask)
+
+class QRNNDecoder(QRNN):
+	def __init__(self, W, b, V, pooling, time_major=False):
+		super(QRNNDecoder, self).__init__(W, b, pooling, time_major)
+		self.V = V
+
+	# see qrnn.QRNNDecoder.share_encoder_state
+	def _add_encoder_state(self, WX, ht_enc):
+		Vh = self.V(ht_enc)
+		batchsize = WX.shape[1 if self.time_major else 0]
+		if Vh.shape[0] != batchsize:
+			Vh = np.repeat(Vh, batchsize // Vh.shape[0], axis=0)
+		return WX + np.expand_dims(Vh, self.time_axis)
+
+	def __call__(self, X, ht_enc):
+		return self.pool(self._add_encoder_state(self.convolve(X), ht_enc))
+
+	def forward_one_step(self, X, ht_enc):
+		return self.pool(self._add_encoder_state(self.convolve_one_step(X), ht_enc))
+
+# see qrnn.QRNNGlobalAttentiveDecoder
+class QRNNGlobalAttentiveDecoder(QRNNDecoder):
+	def __init__(self, W, b, V, o, time_major=False):
+		super(QRNNGlobalAttentiveDecoder, self).__init__(W, b, V, "fo", time_major)
+		self.o = o
+
+	def reset_state(self):
+		super(QRNNGlobalAttentiveDecoder, self).reset_state()
+		self.context = None
+
+	def _to_attention_memory(self, H_enc):
+		if self.time_major:
+			return H_enc.swapaxes(0, 1)
+		return H_enc.swapaxes(1, 2)
+
+	def _get_attention_mask(self, skip_mask, H_enc):
+		if skip_mask is None:
+			return None, None
+		assert skip_mask.shape[1] == H_enc.shape[self.time_axis]
+		bias = (skip_mask == 0) * -1e6
+		return bias[:, None], skip_mask[:, None]
+
+	# see qrnn.QRNNGlobalAttentiveDecoder.attend
+	def attend(self, Q, H_enc, bias, mask):
+		batchsize, seq_length, channels = Q.shape
+		Q = Q.reshape((H_enc.shape[0], -1, channels))
+		alpha = np.matmul(Q, H_enc.swapaxes(-1, -2))
+		if bias is not None:
+			alpha = alpha + np.broadcast_to(bias, alpha.shape).astype(alpha.dtype)
+		alpha = softmax(alpha, axis=2)
+		if mask is not None:
+			alpha = alpha * np.broadcast_to(mask, alpha.shape).astype(alpha.dtype)
+		K = np.matmul(alpha, H_enc)
+		return K.reshape((batchsize, seq_length, channels))
+
+	def reorder_state(self, indices):
+		super(QRNNGlobalAttentiveDecoder, self).reorder_state(indices)
+		if self.context is not None:
+			self.context = self.context[indices]
+
+	def _step_context(self, z, f):
+		if self.context is None:
+			self.context = (1 - f) * z
+		else:
+			self.context = f * self.context + (1 - f) * z
+		return self.context
+
+	def __call__(self, X, ht_enc, H_enc, skip_mask=None):
+		Z, F, O = self._activate(self._add_encoder_state(self.convolve(X), ht_enc))
+		bias, mask = self._get_attention_mask(skip_mask, H_enc)
+		self.context = None
+		C = np.empty((Z.shape[1], Z.shape[0], Z.shape[2]), dtype=Z.dtype)	# (batchsize, seq_length, channels)
+		for t in xrange(Z.shape[0]):
+			C[:, t] = self._step_context(Z[t], F[t])
+		K = self.attend(C, self._to_attention_memory(H_enc), bias, mask)
+		U = np.concatenate((K, C), axis=2)
+		U = self.o(U.reshape((-1, U.shape[2]))).reshape(C.shape)
+		H = O * U.transpose(1, 0, 2)
+		self.ht = H[-1]
+		self.H = H if self.time_major else _to_batch_major(H)
+		return self.H
+
+	def forward_one_step(self, X, ht_enc, H_enc, skip_mask):
+		Z, F, O = self._activate(self._add_encoder_state(self.convolve_one_step(X), ht_enc))
+		bias, mask = self._get_attention_mask(skip_mask, H_enc)
+		ct = self._step_context(Z[0], F[0])
+		kt = self.attend(np.expand_dims(ct, 1), self._to_attention_memory(H_enc), bias, mask)
+		self.ht = O[0] * self.o(np.concatenate((kt.reshape(ct.shape), ct), axis=1))
+		return np.expand_dims(self.ht, self.time_axis)
+
+# outputs of densely connected layers written into one array, see qrnn.DenseFeatureBuffer
+class DenseFeatures(object):
+	def __init__(self, num_blocks, time_major=False):
+		self.num_blocks = num_blocks
+		self.time_major = time_major
+		self.axis = 2 if time_major else 1
+		self.data = None
+		self.length = 0
+
+	def append(self, h):
+		width = h.shape[self.axis]
+		if self.data is None:
+			shape = list(h.shape)
+			shape[self.axis] = width * self.num_blocks
+			self.data = np.empty(shape, dtype=h.dtype)
+		if self.time_major:
+			self.data[..., self.length:self.length + width] = h
+		else:
+			self.data[:, self.length:self.length + width] = h
+		self.length += width
+		return self.data[..., :self.length] if self.time_major else self.data[:, :self.length]
+
+def _forward_layers(layers, forward_layer, in_data, densely_connected, time_major):
+	if densely_connected:
+		features = DenseFeatures(len(layers), time_major)
+	for layer_index in xrange(len(layers)):
+		in_data = forward_layer(layer_index, in_data)
+		if densely_connected:
+			in_data = features.append(in_data)
+	return in_data
+
+class Model(object):
+	xp = np
+
+	def _embed(self, embed, X):
+		if self.time_major:
+			return embed(X.T)
+		return embed(X).swapaxes(1, 2)
+
+	def _output(self, out_data, vocab_size, return_last=False):
+		if return_last:
+			out_data = out_data[-1:] if self.time_major else out_data[:, :, -1, None]
+		out_data = self.fc(out_data)
+		out_data = out_data.swapaxes(0, 1) if self.time_major else out_data.swapaxes(1, 2)
+		return np.reshape(out_data, (-1, vocab_size))
+
+	def _output_one_step(self, out_data, vocab_size):
+		return np.reshape(self.fc(out_data), (-1, vocab_size))
+
+class RNNModel(Model):
+	def __init__(self, params, vocab_size, num_layers, pooling="fo", densely_connected=False, ignore_label=None, time_major=False, **kwargs):
+		self.vocab_size = vocab_size
+		self.num_layers = num_layers
+		self.densely_connected = densely_connected
+		self.time_major = time_major
+		self.embed = EmbedID(params.get("embed/W"), ignore_label)
+		self.fc = CausalConvolution1D(*params.get_convolution("fc"), time_major=time_major, reuse_output=False)	# the logits are handed to the caller
+		self.layers = []
+		for i in xrange(num_layers):
+			W, b = params.get_convolution("qrnn{}/W".format(i))
+			self.layers.append(QRNN(W, b, pooling, time_major))
+
+	def reset_state(self):
+		for layer in self.layers:
+			layer.reset_state()
+
+	def __call__(self, X, return_last=False):
+		out_data = _forward_layers(self.layers, lambda i, x: self.layers[i](x), self._embed(self.embed, X), self.densely_connected, self.time_major)
+		return self._output(out_data, self.vocab_size, return_last)
+
+	def forward_one_step(self, X):
+		if X.ndim == 2:
+			assert X.shape[1] == 1
+			X = X[:, 0]
+		out_data = _forward_layers(self.layers, lambda i, x: self.layers[i].forward_one_step(x), self.embed(X), self.densely_connected, self.time_major)
+		return self._output_one_step(out_data, self.vocab_size)
+
+class Seq2SeqModel(Model):
+	def __init__(self, params, vocab_size_enc, vocab_size_dec, num_layers, pooling="fo", densely_connected=False, time_major=False, **kwargs):
+		self.vocab_size_enc = vocab_size_enc
+		self.vocab_size_dec = vocab_size_dec
+		self.num_layers = num_layers
+		self.densely_connected = densely_connected
+		self.time_major = time_major
+		self.encoder_embed = EmbedID(params.get("encoder_embed/W"), 0)
+		self.decoder_embed = EmbedID(params.get("decoder_embed/W"), 0)
+		self.fc = CausalConvolution1D(*params.get_convolution("fc"), time_major=time_major, reuse_output=False)	# the logits are handed to the caller
+		self.encoders = []
+		self.decoders = []
+		for i in xrange(num_layers):
+			W, b = params.get_convolution("enc{}/W".format(i))
+			self.encoders.append(QRNN(W, b, pooling, time_major))
+			self.decoders.append(self._load_decoder(params, i, pooling))
+
+	def _load_decoder(self, params, i, pooling):
+		W, b = params.get_convolution("dec{}/W".format(i))
+		V = Linear(params.get("dec{}/V/W".format(i)), params.get("dec{}/V/b".format(i)))
+		return QRNNDecoder(W, b, V, pooling, self.time_major)
+
+	def reset_state(self):
+		self.reset_encoder_state()
+		self.reset_decoder_state()
+
+	def reset_encoder_state(self):
+		for layer in self.encoders:
+			layer.reset_state()
+
+	def reset_decoder_state(self):
+		for layer in self.decoders:
+			layer.reset_state()
+
+	def reorder_decoder_state(self, indices):
+		for layer in self.decoders:
+			layer.reorder_state(indices)
+
+	def _encode(self, X, skip_mask):
+		_forward_layers(self.encoders, lambda i, x: self.encoders[i](x, skip_mask), self._embed(self.encoder_embed, X), self.densely_connected, self.time_major)
+		return [layer.get_last_hidden_state() for layer in self.encoders]
+
+	def encode(self, X, skip_mask=None):
+		return self._encode(X, skip_mask)
+
+	def decode(self, X, encoder_last_hidden_states, return_last=False):
+		assert len(encoder_last_hidden_states) == self.num_layers
+		out_data = _forward_layers(self.decoders, lambda i, x: self.decoders[i](x, encoder_last_hidden_states[i]), self._embed(self.decoder_embed, X), self.densely_connected, self.time_major)
+		return self._output(out_data, self.vocab_size_dec, return_last)
+
+	def decode_one_step(self, X, encoder_last_hidden_states):
+		assert len(encoder_last_hidden_states) == self.num_layers
+		if X.ndim == 2:
+			assert X.shape[1] == 1
+			X = X[:, 0]
+		out_data = _forward_layers(self.decoders, lambda i, x: self.decoders[i].forward_one_step(x, encoder_last_hidden_states[i]), self.decoder_embed(X), self.densely_connected, self.time_major)
+		return self._output_one_step(out_data, self.vocab_size_dec)
+
+class AttentiveSeq2SeqModel(Seq2SeqModel):
+	def _load_decoder(self, params, i, pooling):
+		if i < self.num_layers - 1:
+			return super(AttentiveSeq2SeqModel, self)._load_decoder(params, i, pooling)
+		W, b = params.get_convolution("dec{}/W".format(i))
+		V = Linear(params.get("dec{}/V/W".format(i)), params.get("dec{}/V/b".format(i)))
+		o = Linear(params.get("dec{}/o/W".format(i)), params.get("dec{}/o/b".format(i)))
+		return QRNNGlobalAttentiveDecoder(W, b, V, o, self.time_major)
+
+	def encode(self, X, skip_mask=None):
+		return self._encode(X, skip_mask), self.encoders[-1].get_all_hidden_states()
+
+	def _forward_decoder_layer(self, layer_index, in_data, encoder_last_hidden_states, encoder_last_layer_outputs, encoder_skip_mask, one_step):
+		decoder = self.decoders[layer_index]
+		ht_enc = encoder_last_hidden_states[layer_index]
+		if isinstance(decoder, QRNNGlobalAttentiveDecoder):
+			if one_step:
+				return decoder.forward_one_step(in_data, ht_enc, encoder_last_layer_outputs, encoder_skip_mask)
+			return decoder(in_data, ht_enc, encoder_last_layer_outputs, encoder_skip_mask)
+		if one_step:
+			return decoder.forward_one_step(in_data, ht_enc)
+		return decoder(in_data, ht_enc)
+
+	def decode(self, X, encoder_last_hidden_states, encoder_last_layer_outputs, encoder_skip_mask=None, return_last=False):
+		assert len(encoder_last_hidden_states) == self.num_layers
+		out_data = _forward_layers(self.decoders, lambda i, x: self._forward_decoder_layer(i, x, encoder_last_hidden_states, encoder_last_layer_outputs, encoder_skip_mask, False), self._embed(self.decoder_embed, X), self.densely_connected, self.time_major)
+		return self._output(out_data, self.vocab_size_dec, return_last)
+
+	def decode_one_step(self, X, encoder_last_hidden_states, encoder_last_layer_outputs, encoder_skip_mask=None):
+		assert len(encoder_last_hidden_states) == self.num_layers
+		if X.ndim == 2:
+			assert X.shape[1] == 1
+			X = X[:, 0]
+		out_data = _forward_layers(self.decoders, lambda i, x: self._forward_decoder_layer(i, x, encoder_last_hidden_states, encoder_last_layer_outputs, encoder_skip_mask, True), self.decoder_embed(X), self.densely_connected, self.time_major)
+		return self._output_one_step(out_data, self.vocab_size_dec)
+
+# builds the model saved in dirname, or returns None if there is none
+def load_model(dirname):
+	model_filename = dirname + "/model.hdf5"
+	param_filename = dirname + "/params.json"
+	if os.path.isfile(param_filename) == False or os.path.isfile(model_filename) == False:
+		return None
+
+	with open(param_filename, "r") as f:
+		config = json.load(f)
+
+	params = Params(model_filename)
+	try:
+		if "vocab_size" in config:
+			return RNNModel(params, **config)
+		if config.get("attention", False):
+			return AttentiveSeq2SeqModel(params, **config)
+		return Seq2SeqModel(params, **config)
+	finally:
+		params.close()
@@ -0,0 +1,163 @@
+from __future__ import division
+from __future__ import print_function
+import sys, traceback, multiprocessing
+import numpy as np
+from convolution_1d import clear_weightnorm_cache
+
+# data parallel training on one host: every process holds a replica of the model and takes a shard of every batch.
+# the gradients are averaged by a Communicator before every optimizer update, so that the replicas stay bit-identical.
+
+# the collective operations of the processes, a transport over shared memory, sockets, ... implements them
+# allreduce must give bit-identical results on every rank
+class Communicator(object):
+	def __init__(self, size):
+		self.rank = 0
+		self.size = size
+
+	# sums array (float32, 1-D) over the ranks in place
+	def allreduce(self, array):
+		raise NotImplementedError()
+
+	# copies array of root to every rank in place
+	def broadcast(self, array, root=0):
+		raise NotImplementedError()
+
+	def barrier(self):
+		raise NotImplementedError()
+
+	# wakes up the ranks that are waiting on this one with an exception
+	def abort(self):
+		pass
+
+# for processes forked on one host. every rank writes its array to its row of a shared (size, buffer_size) buffer,
+# sums one chunk of the columns over the ranks (reduce-scatter) and reads back all chunks (allgather).
+# every element is summed once and in the same order, so every rank reads the same bits.
+class SharedMemoryCommunicator(Communicator):
+	def __init__(self, size, buffer_size, context=None):
+		super(SharedMemoryCommunicator, self).__init__(size)
+		context = multiprocessing if context is None else context
+		self.buffer_size = buffer_size
+		self.inputs = np.frombuffer(context.RawArray("f", size * buffer_size), dtype=np.float32).reshape((size, buffer_size))
+		self.output = np.frombuffer(context.RawArray("f", buffer_size), dtype=np.float32)
+		self._barrier = context.Barrier(size)
+
+	def allreduce(self, array):
+		n = array.size
+		assert n <= self.buffer_size
+		self.inputs[self.rank, :n] = array
+		self.barrier()
+		start = n * self.rank // self.size
+		end = n * (self.rank + 1) // self.size
+		np.sum(self.inputs[:, start:end], axis=0, out=self.output[start:end])
+		self.barrier()
+		array[...] = self.output[:n]
+
+	def broadcast(self, array, root=0):
+		n = array.size
+		assert n <= self.buffer_size
+		if self.rank == root:
+			self.output[:n] = array.ravel()
+		self.barrier()
+		if self.rank != root:
+			array[...] = self.output[:n].reshape(array.shape)
+		self.barrier()
+
+	def barrier(self):
+		self._barrier.wait()
+
+	def abort(self):
+		self._barrier.abort()
+
+def _run_rank(communicator, rank, target):
+	communicator.rank = rank
+	try:
+		target(communicator)
+	except:
+		communicator.abort()
+		traceback.print_exc()
+		sys.exit(1)
+
+# runs target(communicator) in num_processes processes, rank 0 in this one. communicator is None if num_processes <= 1.
+# the other ranks are forked, so that they start from the state of this process (data, model, optimizer, ...)
+# thread pools must be started by target, a forked process has none of the threads of its parent.
+# parameters that are initialized on the first forward pass (weightnorm) must be initialized before, see get_buffer_size
+# buffer_size: the largest array that is reduced, see get_buffer_size
+def run(num_processes, target, buffer_size):
+	if num_processes <= 1:
+		return target(None)
+	context = multiprocessing.get_context("fork")
+	communicator = SharedMemoryCommunicator(num_processes, buffer_size, context)
+	processes = [context.Process(target=_run_rank, args=(communicator, rank, target)) for rank in range(1, num_processes)]
+	for process in processes:
+		process.start()
+	try:
+		communicator.rank = 0
+		target(communicator)
+	except:
+		communicator.abort()
+		for process in processes:
+			process.terminate()
+		raise
+	finally:
+		for process in processes:
+			process.join()
+	for process in processes:
+		if process.exitcode != 0:
+			raise Exception("process {} exited with code {}".format(process.pid, process.exitcode))
+
+# the size of the parameters that have been initialized
+def get_buffer_size(model):
+	return sum(param.size for param in model.params() if param.data is not None) + 1
+
+def has_uninitialized_params(model):
+	return any(param.data is None for param in model.params())
+
+def _get_params(model):
+	return [param for _, param in sorted(model.namedparams(), key=lambda item: item[0])]
+
+# copies the parameters of rank 0 to every rank
+def broadcast_params(communicator, model):
+	for param in _get_params(model):
+		communicator.broadcast(param.data)
+	clear_weightnorm_cache(model)
+
+# average of the gradients of the ranks weighted by weight, e.g. the number of target tokens of the shard
+# a rank with an empty shard has no gradients and weight 0
+def allreduce_grads(communicator, model, weight):
+	params = _get_params(model)
+	flat = np.empty((sum(param.size for param in params) + 1,), dtype=np.float32)
+	offset = 0
+	for param in params:
+		if param.grad is None:
+			flat[offset:offset + param.size] = 0
+		else:
+			flat[offset:offset + param.size] = param.grad.ravel() * weight
+		offset += param.size
+	flat[-1] = weight
+	communicator.allreduce(flat)
+	flat[:-1] /= flat[-1]
+	offset = 0
+	for param in params:
+		param.grad = flat[offset:offset + param.size].reshape(param.shape).astype(param.dtype, copy=False)
+		offset += param.size
+
+# optimizer.update(lossfun=lambda: loss) with the gradients averaged over the ranks
+# loss is None if the shard of this rank is empty
+def update(optimizer, loss, weight, communicator=None):
+	if communicator is None:
+		optimizer.update(lossfun=lambda: loss)
+		return
+	optimizer.target.cleargrads()
+	if loss is not None:
+		loss.backward()
+	if hasattr(optimizer, "gather_grads"):
+		# optim.FlatOptimizer, the gradients are reduced in its flat buffer
+		total_weight = np.asarray([weight], dtype=np.float32)
+		communicator.allreduce(total_weight)
+		grads = optimizer.gather_grads()
+		grads *= weight
+		communicator.allreduce(grads)
+		grads /= total_weight[0]
+	else:
+		allreduce_grads(communicator, optimizer.target, weight)
+	optimizer.update()
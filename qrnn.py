@@ -1,18 +1,21 @@
 from __future__ import division
 from __future__ import print_function
 from six.moves import xrange
-import math
+from multiprocessing.pool import ThreadPool
+import os, math, time, atexit, copy, multiprocessing
+from collections import deque
 import numpy as np
 import chainer
 from chainer import cuda, Variable, function, link, functions, links, initializers
 from chainer.utils import type_check
-from chainer.links import EmbedID, Linear, BatchNormalization, ConvolutionND
-from convolution_1d import Convolution1D as WeightnormConvolution1D
+from chainer.links import EmbedID, Linear, BatchNormalization
+from convolution_1d import CausalConvolution1D, WeightnormCausalConvolution1D, fold_weightnorm
 
-def Convolution1D(in_channels, out_channels, ksize, stride=1, pad=0, initialW=None, weightnorm=False):
+# causal convolution: the input is padded only on the left with ksize - 1 zeros
+def Convolution1D(in_channels, out_channels, ksize, initialW=None, weightnorm=False, time_major=False):
 	if weightnorm:
-		return WeightnormConvolution1D(in_channels, out_channels, ksize, stride=stride, pad=pad, initialV=initialW)
-	return ConvolutionND(1, in_channels, out_channels, ksize, stride=stride, pad=pad, initialW=initialW)
+		return WeightnormCausalConvolution1D(in_channels, out_channels, ksize, initialV=initialW, time_major=time_major)
+	return CausalConvolution1D(in_channels, out_channels, ksize, initialW=initialW, time_major=time_major)
 
 class Zoneout(function.Function):
 	def __init__(self, p):
@@ -38,34 +41,517 @@ class Zoneout(function.Function):
 def zoneout(x, ratio=.5):
 	return Zoneout(ratio)(x)
 
+# the gradient of the table is not built as a dense (vocab_size, ndim) array,
+# backward appends the ids of the batch and the gradients of their rows to sparse_grads instead
+class SparseEmbedIDFunction(function.Function):
+	def __init__(self, ignore_label, sparse_grads):
+		self.ignore_label = ignore_label
+		self.sparse_grads = sparse_grads
+
+	def forward(self, inputs):
+		xp = cuda.get_array_module(*inputs)
+		x, W = inputs
+		if self.ignore_label is None:
+			return W[x],
+		mask = x == self.ignore_label
+		return xp.where(mask[..., None], 0, W[xp.where(mask, 0, x)]).astype(W.dtype, copy=False),
+
+	def backward(self, inputs, grad_outputs):
+		x, W = inputs
+		ids = x.ravel()
+		rows = grad_outputs[0].reshape((-1, W.shape[1]))
+		if self.ignore_label is not None:
+			keep = ids != self.ignore_label
+			ids, rows = ids[keep], rows[keep]
+		self.sparse_grads.append((ids, rows))
+		return None, None
+
+# EmbedID whose gradient is a list of (ids, rows) in sparse_grads if sparse is True, see optim.FlatOptimizer
+class SparseEmbedID(EmbedID):
+	def __init__(self, in_size, out_size, initialW=None, ignore_label=None):
+		super(SparseEmbedID, self).__init__(in_size, out_size, initialW=initialW, ignore_label=ignore_label)
+		self.sparse = False
+		self.sparse_grads = []
+
+	def forward(self, x):
+		if self.sparse == False:
+			return super(SparseEmbedID, self).forward(x)
+		return SparseEmbedIDFunction(self.ignore_label, self.sparse_grads)(x, self.W)
+
+# (batchsize, channels, seq_length) -> (seq_length, batchsize, channels)
+# every timestep becomes a contiguous block
+def _to_time_major(x):
+	xp = cuda.get_array_module(x)
+	return xp.ascontiguousarray(x.transpose(2, 0, 1))
+
+# (seq_length, batchsize, channels) -> (batchsize, channels, seq_length)
+def _to_batch_major(x):
+	return x.transpose(1, 2, 0)
+
+# the pooling recurrence c_t = f_t * c_{t-1} + u_t is a linear first-order recurrence.
+# for long sequences on the cpu it is computed as a chunked parallel scan:
+# every chunk is scanned independently on a thread pool and the carries are fixed up afterwards.
+# the chunked scan does about twice the work of the serial one, so it only pays off with idle cores.
+# set_pooling_threads times both once and keeps the serial scan unless the chunked one is faster.
+# (a closed form with cumprod / cumsum is not used, the product of the gates underflows within a few dozen steps)
+_scan_pool = None
+_scan_num_threads = 0
+_scan_min_chunk_length = 16
+
+def _get_num_cores():
+	try:
+		return len(os.sched_getaffinity(0))
+	except AttributeError:
+		return multiprocessing.cpu_count()
+
+# returns the number of threads used by the chunked scan, 0 if the serial scan is used
+def set_pooling_threads(num_threads, min_chunk_length=16, calibrate=True):
+	global _scan_pool, _scan_num_threads, _scan_min_chunk_length
+	if _scan_pool is not None:
+		_scan_pool.close()
+		_scan_pool.join()
+		_scan_pool = None
+	_scan_num_threads = 0
+	_scan_min_chunk_length = min_chunk_length
+	num_threads = min(num_threads, _get_num_cores())
+	if num_threads > 1:
+		pool = ThreadPool(num_threads)
+		if calibrate and _chunked_scan_is_faster(pool, num_threads) == False:
+			pool.close()
+			pool.join()
+		else:
+			_scan_pool = pool
+			_scan_num_threads = num_threads
+	return _scan_num_threads
+
+# times the serial and the chunked scan on random gates of the given (seq_length, batchsize, channels)
+def _chunked_scan_is_faster(pool, num_chunks, shape=(256, 32, 640), repeat=3):
+	random_state = np.random.RandomState(0)	# the global random state is left alone
+	X = random_state.uniform(-1, 1, shape).astype(np.float32)
+	A = random_state.uniform(0, 1, (shape[0] - 1,) + shape[1:]).astype(np.float32)
+
+	def get_time(scan):
+		best = float("inf")
+		for _ in xrange(repeat):
+			Y = X.copy()
+			start = time.time()
+			scan(Y)
+			best = min(best, time.time() - start)
+		return best
+
+	serial_time = get_time(lambda Y: _serial_scan(Y, A))
+	chunked_time = get_time(lambda Y: _chunked_scan(Y, A, None, None, num_chunks, pool))
+	return chunked_time < serial_time * 0.9
+
+atexit.register(set_pooling_threads, 0)
+
+# in-place scan along the first axis
+# X[0] += a0 * c0
+# X[t] += A[t - 1] * X[t - 1]
+def _scan(X, A, a0=None, c0=None):
+	T = X.shape[0]
+	xp = cuda.get_array_module(X)
+	num_chunks = min(_scan_num_threads, T // max(_scan_min_chunk_length, 1))
+	if xp is not np or _scan_pool is None or num_chunks < 2:
+		return _serial_scan(X, A, a0, c0)
+	return _chunked_scan(X, A, a0, c0, num_chunks, _scan_pool)
+
+def _serial_scan(X, A, a0=None, c0=None):
+	if c0 is not None:
+		X[0] += a0 * c0
+	for t in xrange(1, X.shape[0]):
+		X[t] += A[t - 1] * X[t - 1]
+	return X
+
+def _chunked_scan(X, A, a0, c0, num_chunks, pool):
+	T = X.shape[0]
+	bounds = np.linspace(0, T, num_chunks + 1).astype(int)
+	P = np.empty_like(X)	# product of the multipliers from the start of the chunk
+
+	def scan_chunk(k):
+		start, end = bounds[k], bounds[k + 1]
+		use_carry = k > 0 or c0 is not None
+		if use_carry:
+			P[start] = a0 if k == 0 else A[start - 1]
+		product = np.empty_like(X[0])
+		for t in xrange(start + 1, end):
+			np.multiply(A[t - 1], X[t - 1], out=product)
+			X[t] += product
+			if use_carry:
+				np.multiply(P[t - 1], A[t - 1], out=P[t])
+
+	def fix_chunk(args):
+		k, carry = args
+		start, end = bounds[k], bounds[k + 1]
+		np.multiply(P[start:end], carry, out=P[start:end])
+		X[start:end] += P[start:end]
+
+	pool.map(scan_chunk, range(num_chunks))
+
+	# propagate the carries between chunks
+	carries = []
+	carry = c0
+	for k in xrange(num_chunks):
+		if carry is not None:
+			carries.append((k, carry))
+		last = bounds[k + 1] - 1
+		carry = X[last] if carry is None else X[last] + P[last] * carry
+	pool.map(fix_chunk, carries)
+	return X
+
+# the recurrence always runs on time-major arrays
+# batch-major inputs (batchsize, channels, seq_length) are transposed on the way in and out,
+# time-major inputs (seq_length, batchsize, channels) are used as they are
+class QRNNPooling(function.Function):
+	def __init__(self, pooling, has_initial_state=False, skip_mask=None, time_major=False):
+		self.use_o = len(pooling) >= 2
+		self.use_i = len(pooling) == 3
+		self.has_initial_state = has_initial_state
+		self.skip_mask = skip_mask
+		self.time_major = time_major
+
+	def check_type_forward(self, in_types):
+		num_gates = 2 + int(self.use_o) + int(self.use_i)
+		type_check.expect(in_types.size() == num_gates + int(self.has_initial_state))
+		z_type = in_types[0]
+		type_check.expect(
+			z_type.dtype.kind == "f",
+			z_type.ndim == 3,
+		)
+		for i in range(1, num_gates):
+			type_check.expect(
+				in_types[i].dtype == z_type.dtype,
+				in_types[i].shape == z_type.shape,
+			)
+		if self.has_initial_state:
+			c_type = in_types[num_gates]
+			batch_axis, channel_axis = (1, 2) if self.time_major else (0, 1)
+			type_check.expect(
+				c_type.dtype == z_type.dtype,
+				c_type.ndim == 2,
+				c_type.shape[0] == z_type.shape[batch_axis],
+				c_type.shape[1] == z_type.shape[channel_axis],
+			)
+
+	def _unpack(self, inputs):
+		inputs = list(inputs)
+		Z = inputs.pop(0)
+		F = inputs.pop(0)
+		O = inputs.pop(0) if self.use_o else None
+		I = inputs.pop(0) if self.use_i else None
+		c0 = inputs.pop(0) if self.has_initial_state else None
+		return Z, F, O, I, c0
+
+	def _in(self, x):
+		return x if self.time_major else _to_time_major(x)
+
+	def _out(self, x):
+		return x if self.time_major else _to_batch_major(x)
+
+	def _get_mask(self, xp, dtype):
+		if self.skip_mask is None:
+			return None
+		return xp.asarray(self.skip_mask, dtype=dtype).T[..., None]	# (seq_length, batchsize, 1)
+
+	def forward(self, inputs):
+		xp = cuda.get_array_module(*inputs)
+		Z, F, O, I, c0 = self._unpack(inputs)
+		Z, F = self._in(Z), self._in(F)
+		X = self._get_mask(xp, Z.dtype)
+
+		# the input term does not depend on c so it is computed for all timesteps at once
+		C = (1 - F) * Z if I is None else self._in(I) * Z
+		if X is not None:
+			C *= X
+		if c0 is None and I is not None:
+			# the first cell state is computed with (1 - f) as in f-pooling
+			C[0] = (1 - F[0]) * Z[0] if X is None else (1 - F[0]) * Z[0] * X[0]
+
+		# c_t = f_t * c_{t-1} + u_t
+		self.C = _scan(C, F[1:], F[0], c0)
+
+		if O is None:
+			return self._out(C),
+		return self._out(self._in(O) * C), self._out(C)
+
+	def backward(self, inputs, grad_outputs):
+		xp = cuda.get_array_module(*inputs)
+		Z, F, O, I, c0 = self._unpack(inputs)
+		Z, F = self._in(Z), self._in(F)
+		X = self._get_mask(xp, Z.dtype)
+		C = self.C
+
+		if O is None:
+			gH, gC = None, grad_outputs[0]
+		else:
+			gH, gC = grad_outputs
+			O = self._in(O)
+
+		# total gradient w.r.t. each c_t before the recurrence is unrolled
+		# G is swept in place so it must not alias the incoming gradient
+		G = xp.empty_like(C)
+		G[...] = 0 if gC is None else (gC if self.time_major else gC.transpose(2, 0, 1))
+		if gH is not None:
+			gH = self._in(gH)
+			G += gH * O
+
+		# reverse-time sweep
+		# g_t += f_{t+1} * g_{t+1}
+		_scan(G[::-1], F[:0:-1])
+
+		C_prev = xp.empty_like(C)
+		C_prev[0] = 0 if c0 is None else c0
+		C_prev[1:] = C[:-1]
+
+		ZX = Z if X is None else Z * X
+		if I is None:
+			gF = G * (C_prev - ZX)
+			gZ = G * (1 - F)
+		else:
+			I = self._in(I)
+			gF = G * C_prev
+			gI = G * ZX
+			gZ = G * I
+			if c0 is None:
+				# the first cell state is computed with (1 - f) as in f-pooling
+				gF[0] -= G[0] * ZX[0]
+				gI[0] = 0
+				gZ[0] = G[0] * (1 - F[0])
+		if X is not None:
+			gZ *= X
+
+		grads = [self._out(gZ), self._out(gF)]
+		if O is not None:
+			grads.append(self._out(gH * C) if gH is not None else xp.zeros_like(inputs[2]))
+		if I is not None:
+			grads.append(self._out(gI))
+		if c0 is not None:
+			grads.append(F[0] * G[0])
+		return tuple(grads)
+
+def qrnn_pooling(Z, F, O=None, I=None, c0=None, skip_mask=None, time_major=False):
+	pooling = "f" if O is None else ("fo" if I is None else "ifo")
+	inputs = [Z, F] + [x for x in (O, I, c0) if x is not None]
+	outputs = QRNNPooling(pooling, c0 is not None, skip_mask, time_major)(*inputs)
+	if O is None:
+		return outputs, outputs
+	return outputs
+
+# index of the timesteps [start, end) along the time axis
+def _time_slice(start, end, time_major):
+	if time_major:
+		return slice(start, end)
+	return Ellipsis, slice(start, end)
+
+class AppendHiddenStates(function.Function):
+	def __init__(self, buffer, length, time_major=False):
+		self.buffer = buffer
+		self.length = length	# number of timesteps already stored
+		self.time_major = time_major
+
+	def forward(self, inputs):
+		H, h = inputs
+		end = self.length + (1 if h.ndim == 2 else h.shape[0 if self.time_major else 2])
+		return self.buffer[_time_slice(0, end, self.time_major)],	# view, no copy
+
+	def backward(self, inputs, grad_outputs):
+		H, h = inputs
+		gy = grad_outputs[0]
+		gH = gy[_time_slice(0, self.length, self.time_major)]
+		gh = gy[_time_slice(self.length, None, self.time_major)]
+		if h.ndim == 2:
+			gh = gh[0] if self.time_major else gh[..., 0]
+		return gH, gh
+
+# holds all hidden states of a layer in one (batchsize, channels, seq_length) array
+# or (seq_length, batchsize, channels) array if time_major
+# that grows geometrically, so appending a timestep never copies the whole history
+class HiddenStateBuffer(object):
+	def __init__(self, H=None, time_major=False):
+		self.time_major = time_major
+		self.axis = 0 if time_major else 2	# time axis
+		self.variable = H	# variable that covers all stored timesteps
+		self.data = None	# preallocated storage, allocated on the second append
+		self.length = 0 if H is None else H.shape[self.axis]
+
+	def _reserve(self, h, length, xp):
+		capacity = 0 if self.data is None else self.data.shape[self.axis]
+		if length <= capacity:
+			return
+		capacity = max(length, capacity * 2, 16)
+		shape = list(h.shape)
+		shape[self.axis] = capacity
+		data = xp.empty(shape, dtype=h.dtype)
+		stored = _time_slice(0, self.length, self.time_major)
+		if self.data is None:
+			data[stored] = self.variable.data
+		else:
+			data[stored] = self.data[stored]
+		self.data = data
+
+	# h: (batchsize, channels) or a sequence in the layout of the buffer
+	def append(self, h):
+		if self.variable is None:
+			self.variable = functions.expand_dims(h, self.axis) if h.ndim == 2 else h
+			self.length = self.variable.shape[self.axis]
+			return self.variable
+		xp = cuda.get_array_module(h.data)
+		h3 = xp.expand_dims(h.data, self.axis) if h.ndim == 2 else h.data
+		length = h3.shape[self.axis]
+		self._reserve(h3, self.length + length, xp)
+		self.data[_time_slice(self.length, self.length + length, self.time_major)] = h3
+		self.variable = AppendHiddenStates(self.data, self.length, self.time_major)(self.variable, h)
+		self.length += length
+		return self.variable
+
+# index of the channels [start, end)
+def _channel_slice(start, end, time_major):
+	if time_major:
+		return Ellipsis, slice(start, end)
+	return slice(None), slice(start, end)
+
+class ReadDenseFeatures(function.Function):
+	def __init__(self, features, end):
+		self.features = features
+		self.end = end	# number of channels visible to the next layer
+
+	def forward(self, inputs):
+		return self.features.data[_channel_slice(0, self.end, self.features.time_major)],	# view, no copy
+
+	# the gradients of all readers are accumulated in one shared buffer
+	# the reader created right after h was written runs last, so the block of h is complete by then.
+	# every later reader reads the output of an earlier one through its layer, so backward runs them
+	# from the last to the first (the last ones are skipped if their outputs are not used, e.g. by an encoder
+	# that only returns its last hidden states). a reader that runs out of this order, or after the first one,
+	# would hand out an incomplete block, so the graph of a buffer can be backpropagated once.
+	def backward(self, inputs, grad_outputs):
+		h, = inputs
+		features = self.features
+		start = self.end - h.shape[features.axis]
+		assert features.backward_end is None or self.end == features.backward_end, "the readers of a DenseFeatureBuffer must run backward from the last one to the first one"
+		G = features.get_grad_buffer()
+		if grad_outputs[0] is not None:
+			G[_channel_slice(0, self.end, features.time_major)] += grad_outputs[0]
+		gh = G[_channel_slice(start, self.end, features.time_major)].copy()
+		features.backward_end = start
+		if start == 0:
+			features.grad = None	# every block has been handed out
+		return gh,
+
+# outputs of densely connected layers are written into slices of one preallocated array
+# and every layer reads a view of the prefix, so nothing is concatenated
+# https://arxiv.org/abs/1707.06990
+class DenseFeatureBuffer(object):
+	def __init__(self, num_blocks, time_major=False):
+		self.num_blocks = num_blocks
+		self.time_major = time_major
+		self.axis = 2 if time_major else 1	# channel axis
+		self.data = None
+		self.grad = None
+		self.length = 0
+		self.backward_end = None	# end of the reader that runs backward next, None before the first backward
+
+	def get_grad_buffer(self):
+		if self.grad is None:
+			xp = cuda.get_array_module(self.data)
+			self.grad = xp.zeros_like(self.data)
+		return self.grad
+
+	# h: (batchsize, channels, seq_length) or (seq_length, batchsize, channels) if time_major
+	# returns all features written so far
+	def append(self, h):
+		width = h.shape[self.axis]
+		if self.data is None:
+			xp = cuda.get_array_module(h.data)
+			shape = list(h.shape)
+			shape[self.axis] = width * self.num_blocks
+			self.data = xp.empty(shape, dtype=h.dtype)
+		self.data[_channel_slice(self.length, self.length + width, self.time_major)] = h.data
+		self.length += width
+		return ReadDenseFeatures(self, self.length)(h)
+
+# rows of x in the given order along the batch axis
+def _take_batch(x, indices, batch_axis):
+	if x is None:
+		return None
+	if batch_axis == 0:
+		return x[indices]
+	return x[:, indices]
+
+def _copy_container(value):
+	if isinstance(value, (HiddenStateBuffer, deque, list)):
+		return copy.copy(value)
+	return value
+
+# sequences are (batchsize, channels, seq_length) by default
+# with time_major=True they are (seq_length, batchsize, channels) so every timestep is a contiguous block
 class QRNN(link.Chain):
-	def __init__(self, in_channels, out_channels, kernel_size=2, pooling="f", zoneout=0, wgain=1., weightnorm=False):
+	def __init__(self, in_channels, out_channels, kernel_size=2, pooling="f", zoneout=0, wgain=1., weightnorm=False, time_major=False):
 		self.num_split = len(pooling) + 1
 		wstd = math.sqrt(wgain / in_channels / kernel_size)
-		super(QRNN, self).__init__(W=Convolution1D(in_channels, self.num_split * out_channels, kernel_size, stride=1, pad=kernel_size - 1, weightnorm=weightnorm, initialW=initializers.Normal(wstd)))
+		super(QRNN, self).__init__(W=Convolution1D(in_channels, self.num_split * out_channels, kernel_size, weightnorm=weightnorm, initialW=initializers.Normal(wstd), time_major=time_major))
 		self._in_channels, self._out_channels, self._kernel_size, self._pooling, self._zoneout = in_channels, out_channels, kernel_size, pooling, zoneout
 		self._using_zoneout = True if self._zoneout > 0 else False
+		self._time_major = time_major
+		self._time_axis = 0 if time_major else 2
+		self._channel_axis = 2 if time_major else 1
+		self._batch_axis = 1 if time_major else 0
 		self.reset_state()
 
 	def __call__(self, X, skip_mask=None):
-		# remove right paddings
+		WX = self.convolve(X)
+		self.pool(functions.split_axis(WX, self.num_split, axis=self._channel_axis), skip_mask=skip_mask)
+		return self.get_all_hidden_states()
+
+	# X: the newest input (batchsize, in_channels) or a single timestep in the layout of the layer
+	# returns the newest hidden state (batchsize, out_channels, 1) or (1, batchsize, out_channels) if time_major
+	def forward_one_step(self, X, skip_mask=None):
+		WX = self.convolve_one_step(X)
+		return self.pool(functions.split_axis(WX, self.num_split, axis=self._channel_axis), skip_mask=skip_mask)
+
+	# X[..., t] or X[t] if time_major
+	def _step(self, X, t):
+		return X[t] if self._time_major else X[..., t]
+
+	def convolve(self, X):
+		# causal convolution
 		# e.g.
 		# kernel_size = 3
-		# pad = 2
-		# input sequence with paddings:
-		# [0, 0, x1, x2, x3, 0, 0]
+		# input sequence with left paddings:
+		# [0, 0, x1, x2, x3]
 		# |< t1 >|
 		#     |< t2 >|
 		#         |< t3 >|
-		pad = self._kernel_size - 1
-		WX = self.W(X)[..., :-pad]
-
-		return self.pool(functions.split_axis(WX, self.num_split, axis=1), skip_mask=skip_mask)
+		WX = self.W(X)
 
-	def forward_one_step(self, X, skip_mask=None):
+		# keep the last inputs so that forward_one_step can continue the sequence
+		pad = self._kernel_size - 1
+		seq_length = X.shape[self._time_axis]
+		for t in xrange(max(seq_length - pad, 0), seq_length):
+			self.X.append(X[_time_slice(t, t + 1, self._time_major)])
+
+		return WX
+
+	# the last kernel_size - 1 inputs are kept in a ring buffer
+	# so one step only needs a single kernel_size-tap product
+	def convolve_one_step(self, X):
+		if isinstance(X, Variable) == False:
+			X = Variable(X)
+		if X.ndim == 2:
+			X = functions.expand_dims(X, self._time_axis)
 		pad = self._kernel_size - 1
-		WX = self.W(X)[:, :, -pad-1, None]
-		return self.pool(functions.split_axis(WX, self.num_split, axis=1), skip_mask=skip_mask)
+		window = list(self.X) + [X]
+		if len(self.X) < pad:
+			xp = cuda.get_array_module(X.data)
+			shape = list(X.shape)
+			shape[self._time_axis] = pad - len(self.X)
+			window.insert(0, xp.zeros(shape, dtype=X.dtype))	# left paddings
+		if pad > 0:
+			self.X.append(X)
+			window = functions.concat(window, axis=self._time_axis)
+		else:
+			window = X
+		return self.W.forward_one_step(window)
 
 	def zoneout(self, U):
 		if self._using_zoneout and chainer.config.train:
@@ -102,60 +588,78 @@ class QRNN(link.Chain):
 		assert Z is not None
 		assert F is not None
 
-		T = Z.shape[2]
-		for t in xrange(T):
-			zt = Z[..., t]
-			ft = F[..., t]
-			ot = 1 if O is None else O[..., t]
-			it = 1 - ft if I is None else I[..., t]
-			xt = 1 if skip_mask is None else skip_mask[:, t, None]	# will be used for seq2seq to skip PAD
+		# run the whole recurrence in a single function
+		H, C = qrnn_pooling(Z, F, O, I, c0=self.ct, skip_mask=skip_mask, time_major=self._time_major)	# skip_mask will be used for seq2seq to skip PAD
 
-			if self.ct is None:
-				self.ct = (1 - ft) * zt * xt
-			else:
-				self.ct = ft * self.ct + it * zt * xt
-			self.ht = self.ct if O is None else ot * self.ct
-
-			if self.H is None:
-				self.H = functions.expand_dims(self.ht, 2)
-			else:
-				self.H = functions.concat((self.H, functions.expand_dims(self.ht, 2)), axis=2)
+		self.ct = self._step(C, -1)
+		self.ht = self._step(H, -1)
 
-		return self.H
+		self.H.append(H)
+		return H
 
 	def reset_state(self):
 		self.set_state(None, None, None)
+		self.reset_inputs()
+
+	def reset_inputs(self):
+		self.X = deque(maxlen=self._kernel_size - 1)	# last inputs
 
 	def set_state(self, ct, ht, H):
 		self.ct = ct	# last cell state
 		self.ht = ht	# last hidden state
-		self.H = H		# all hidden states
+		self.H = HiddenStateBuffer(H, self._time_major)		# all hidden states
+
+	_state_names = ("ct", "ht", "H", "X")
+
+	# snapshot of everything a forward pass changes
+	# variables are immutable, the containers that are appended to are copied
+	def save_state(self):
+		return dict((name, _copy_container(getattr(self, name))) for name in self._state_names)
+
+	def restore_state(self, state):
+		for name in self._state_names:
+			setattr(self, name, _copy_container(state[name]))
+
+	# keeps only the rows of the batch given by indices, in that order
+	# e.g. beam search follows the backpointers of the surviving beams
+	def reorder_state(self, indices):
+		self.ct = _take_batch(self.ct, indices, 0)
+		self.ht = _take_batch(self.ht, indices, 0)
+		self.H = HiddenStateBuffer(_take_batch(self.H.variable, indices, self._batch_axis), self._time_major)
+		X = [_take_batch(x, indices, self._batch_axis) for x in self.X]
+		self.reset_inputs()
+		self.X.extend(X)
 
 	def get_last_hidden_state(self):
 		return self.ht
 
 	def get_all_hidden_states(self):
-		return self.H
+		return self.H.variable
 
 class QRNNEncoder(QRNN):
 	pass
 
 class QRNNDecoder(QRNN):
-	def __init__(self, in_channels, out_channels, kernel_size=2, pooling="f", zoneout=False, wgain=1., weightnorm=False):
-		super(QRNNDecoder, self).__init__(in_channels, out_channels, kernel_size, pooling, zoneout, wgain, weightnorm)
+	def __init__(self, in_channels, out_channels, kernel_size=2, pooling="f", zoneout=False, wgain=1., weightnorm=False, time_major=False):
+		super(QRNNDecoder, self).__init__(in_channels, out_channels, kernel_size, pooling, zoneout, wgain, weightnorm, time_major)
 		self.num_split = len(pooling) + 1
 		wstd = math.sqrt(wgain / in_channels / kernel_size)
 
 		with self.init_scope():
 			setattr(self, "V", links.Linear(out_channels, self.num_split * out_channels, initialW=initializers.Normal(wstd)))
 
+	# Vh holds one row per sentence and the decoder batch may hold several rows per sentence (e.g. its beams)
+	def share_encoder_state(self, Vh, batchsize):
+		num_sentences, channels = Vh.shape
+		if num_sentences == batchsize:
+			return Vh
+		Vh = functions.broadcast_to(functions.expand_dims(Vh, 1), (num_sentences, batchsize // num_sentences, channels))
+		return functions.reshape(Vh, (batchsize, channels))
+
 	# ht_enc is the last encoder state
 	def __call__(self, X, ht_enc):
-		pad = self._kernel_size - 1
-		WX = self.W(X)
-		if pad > 0:
-			WX = WX[..., :-pad]
-		Vh = self.V(ht_enc)
+		WX = self.convolve(X)
+		Vh = self.share_encoder_state(self.V(ht_enc), WX.shape[self._batch_axis])
 
 		# copy Vh
 		# e.g.
@@ -172,22 +676,26 @@ class QRNNDecoder(QRNN):
 		# Vh = [[[ 	11	11	11]
 		# 		 [	12	12	12]
 		# 		 [	13	13	13]
-		Vh, WX = functions.broadcast(functions.expand_dims(Vh, axis=2), WX)
+		Vh, WX = functions.broadcast(functions.expand_dims(Vh, axis=self._time_axis), WX)
 
-		return self.pool(functions.split_axis(WX + Vh, self.num_split, axis=1))
+		self.pool(functions.split_axis(WX + Vh, self.num_split, axis=self._channel_axis))
+		return self.get_all_hidden_states()
 
 	def forward_one_step(self, X, ht_enc):
-		pad = self._kernel_size - 1
-		WX = self.W(X)[..., -pad-1, None]
-		Vh = self.V(ht_enc)
+		return self.step(X, self.V(ht_enc))
+
+	# Vh is V(ht_enc), which stays the same for the whole target sequence (see EncoderMemory)
+	def step(self, X, Vh):
+		WX = self.convolve_one_step(X)
+		Vh = self.share_encoder_state(Vh, WX.shape[self._batch_axis])
 
-		Vh, WX = functions.broadcast(functions.expand_dims(Vh, axis=2), WX)
+		Vh, WX = functions.broadcast(functions.expand_dims(Vh, axis=self._time_axis), WX)
 
-		return self.pool(functions.split_axis(WX + Vh, self.num_split, axis=1))
+		return self.pool(functions.split_axis(WX + Vh, self.num_split, axis=self._channel_axis))
 
 class QRNNGlobalAttentiveDecoder(QRNNDecoder):
-	def __init__(self, in_channels, out_channels, kernel_size=2, zoneout=False, wgain=1., weightnorm=False):
-		super(QRNNGlobalAttentiveDecoder, self).__init__(in_channels, out_channels, kernel_size, "fo", zoneout, wgain, weightnorm)
+	def __init__(self, in_channels, out_channels, kernel_size=2, zoneout=False, wgain=1., weightnorm=False, time_major=False):
+		super(QRNNGlobalAttentiveDecoder, self).__init__(in_channels, out_channels, kernel_size, "fo", zoneout, wgain, weightnorm, time_major)
 		wstd = math.sqrt(wgain / in_channels / kernel_size)
 		with self.init_scope():
 			setattr(self, "o", links.Linear(2 * out_channels, out_channels, initialW=initializers.Normal(wstd)))
@@ -196,111 +704,236 @@ class QRNNGlobalAttentiveDecoder(QRNNDecoder):
 	# ht_enc is the last encoder state
 	# H_enc is the encoder's las layer's hidden sates
 	def __call__(self, X, ht_enc, H_enc, skip_mask=None):
-		pad = self._kernel_size - 1
-		WX = self.W(X)
-		if pad > 0:
-			WX = WX[:, :, :-pad]
-		Vh = self.V(ht_enc)
-		Vh, WX = functions.broadcast(functions.expand_dims(Vh, axis=2), WX)
+		WX = self.convolve(X)
+		Vh = self.share_encoder_state(self.V(ht_enc), WX.shape[self._batch_axis])
+		Vh, WX = functions.broadcast(functions.expand_dims(Vh, axis=self._time_axis), WX)
 
 		# f-pooling
-		Z, F, O = functions.split_axis(WX + Vh, 3, axis=1)
+		Z, F, O = functions.split_axis(WX + Vh, 3, axis=self._channel_axis)
 		Z = functions.tanh(Z)
 		F = self.zoneout(F)
 		O = functions.sigmoid(O)
-		T = Z.shape[2]
-
-		# compute ungated hidden states
-		self.contexts = []
-		for t in xrange(T):
-			z = Z[..., t]
-			f = F[..., t]
-			if t == 0:
-				ct = (1 - f) * z
-				self.contexts.append(ct)
-			else:
-				ct = f * self.contexts[-1] + (1 - f) * z
-				self.contexts.append(ct)
 
-		if skip_mask is not None:
-			assert skip_mask.shape[1] == H_enc.shape[2]
-			softmax_bias = (skip_mask == 0) * -1e6
+		# compute ungated hidden states, f-pooling over the whole sequence in one pass
+		C, _ = qrnn_pooling(Z, F, time_major=self._time_major)
+		self.context = self._step(C, -1)
+		C = functions.transpose(C, (1, 0, 2) if self._time_major else (0, 2, 1))	# (batchsize, seq_length, channels)
 
 		# compute attention weights (eq.8)
-		H_enc = functions.swapaxes(H_enc, 1, 2)
-		for t in xrange(T):
-			ct = self.contexts[t]
-			bias = 0 if skip_mask is None else softmax_bias[..., None]	# to skip PAD
-			mask = 1 if skip_mask is None else skip_mask[..., None]		# to skip PAD
-			alpha = functions.batch_matmul(H_enc, ct) + bias
-			alpha = functions.softmax(alpha) * mask
-			alpha = functions.broadcast_to(alpha, H_enc.shape)	# copy
-			kt = functions.sum(alpha * H_enc, axis=1)
-			ot = O[..., t]
-			self.ht = ot * self.o(functions.concat((kt, ct), axis=1))
-
-			if t == 0:
-				self.H = functions.expand_dims(self.ht, 2)
-			else:
-				self.H = functions.concat((self.H, functions.expand_dims(self.ht, 2)), axis=2)
-
-		return self.H
+		# the attention does not feed back into the recurrence, so all timesteps are attended at once
+		bias, mask = self._get_attention_mask(skip_mask, H_enc)
+		K = self.attend(C, self._to_attention_memory(H_enc), bias, mask)
+		U = functions.concat((K, C), axis=2)
+		U = functions.reshape(self.o(functions.reshape(U, (-1, U.shape[2]))), C.shape)
+		U = functions.transpose(U, (1, 0, 2) if self._time_major else (0, 2, 1))
+
+		H = O * U
+		self.H = HiddenStateBuffer(H, self._time_major)
+		self.ht = self._step(H, -1)
+		return self.get_all_hidden_states()
 
 	def forward_one_step(self, X, ht_enc, H_enc, skip_mask):
-		pad = self._kernel_size - 1
-		WX = self.W(X)[:, :, -pad-1, None]
-		Vh = self.V(ht_enc)
+		bias, mask = self._get_attention_mask(skip_mask, H_enc)
+		return self.step(X, self.V(ht_enc), self._to_attention_memory(H_enc), bias, mask)
 
-		Vh, WX = functions.broadcast(functions.expand_dims(Vh, axis=2), WX)
+	# Vh is V(ht_enc), H_enc is the attention memory and bias, mask skip PAD (see EncoderMemory)
+	def step(self, X, Vh, H_enc, bias, mask):
+		WX = self.convolve_one_step(X)
+		Vh = self.share_encoder_state(Vh, WX.shape[self._batch_axis])
 
-		# f-pooling
-		Z, F, O = functions.split_axis(WX + Vh, 3, axis=1)
-		Z = functions.tanh(Z)
-		F = self.zoneout(F)
-		O = functions.sigmoid(O)
-		T = Z.shape[2]
-
-		# compute ungated hidden states
-		for t in xrange(T):
-			z = Z[..., t]
-			f = F[..., t]
-			if self.contexts is None:
-				ct = (1 - f) * z
-				self.contexts = [ct]
-			else:
-				ct = f * self.contexts[-1] + (1 - f) * z
-				self.contexts.append(ct)
+		Vh, WX = functions.broadcast(functions.expand_dims(Vh, axis=self._time_axis), WX)
 
-		if skip_mask is not None:
-			assert skip_mask.shape[1] == H_enc.shape[2]
-			softmax_bias = (skip_mask == 0) * -1e6
+		# f-pooling
+		Z, F, O = functions.split_axis(WX + Vh, 3, axis=self._channel_axis)
+		z = self._step(functions.tanh(Z), 0)
+		f = self._step(self.zoneout(F), 0)
+		ot = self._step(functions.sigmoid(O), 0)
+
+		# compute ungated hidden state
+		if self.context is None:
+			ct = (1 - f) * z
+		else:
+			ct = f * self.context + (1 - f) * z
+		self.context = ct
 
 		# compute attention weights (eq.8)
-		H_enc = functions.swapaxes(H_enc, 1, 2)
-		for t in xrange(T):
-			ct = self.contexts[t - T]
-			bias = 0 if skip_mask is None else softmax_bias[..., None]	# to skip PAD
-			mask = 1 if skip_mask is None else skip_mask[..., None]		# to skip PAD
-			alpha = functions.batch_matmul(H_enc, ct) + bias
-			alpha = functions.softmax(alpha) * mask
-			alpha = functions.broadcast_to(alpha, H_enc.shape)	# copy
-			kt = functions.sum(alpha * H_enc, axis=1)
-			ot = O[..., t]
-			self.ht = ot * self.o(functions.concat((kt, ct), axis=1))
-
-			if self.H is None:
-				self.H = functions.expand_dims(self.ht, 2)
-			else:
-				self.H = functions.concat((self.H, functions.expand_dims(self.ht, 2)), axis=2)
-
-		return self.H
-
+		kt = self.attend(functions.expand_dims(ct, 1), H_enc, bias, mask)
+		self.ht = ot * self.o(functions.concat((functions.reshape(kt, ct.shape), ct), axis=1))
+
+		self.H.append(self.ht)
+		return functions.expand_dims(self.ht, self._time_axis)
+
+	# softmax bias and mask that skip PAD, (batchsize, 1, seq_length)
+	def _get_attention_mask(self, skip_mask, H_enc):
+		if skip_mask is None:
+			return 0, 1
+		assert skip_mask.shape[1] == H_enc.shape[self._time_axis]
+		bias = (skip_mask == 0) * -1e6
+		return bias[:, None], skip_mask[:, None]
+
+	# Q: queries (batchsize, seq_length, channels)
+	# H_enc: (num_sentences, source_length, channels)
+	# every query is answered by two batched matmuls and one softmax, without broadcast copies.
+	# if H_enc holds fewer sentences than the decoder batch, every sentence is attended by
+	# batchsize // num_sentences consecutive rows of Q (e.g. its beams)
+	def attend(self, Q, H_enc, bias, mask):
+		batchsize, seq_length, channels = Q.shape
+		num_sentences = H_enc.shape[0]
+		Q = functions.reshape(Q, (num_sentences, -1, channels))
+		alpha = functions.batch_matmul(Q, H_enc, transb=True)	# (num_sentences, queries, source_length)
+		if isinstance(bias, int) == False:
+			xp = cuda.get_array_module(bias)
+			bias = xp.broadcast_to(bias, alpha.shape)
+			mask = xp.broadcast_to(mask, alpha.shape)
+		alpha = functions.softmax(alpha + bias, axis=2) * mask
+		K = functions.batch_matmul(alpha, H_enc)	# (num_sentences, queries, channels)
+		return functions.reshape(K, (batchsize, seq_length, channels))
+
+	# encoder hidden states -> (batchsize, seq_length, channels)
+	def _to_attention_memory(self, H_enc):
+		if self._time_major:
+			return functions.swapaxes(H_enc, 0, 1)
+		return functions.swapaxes(H_enc, 1, 2)
 
 	def reset_state(self):
 		self.set_state(None, None, None, None)
+		self.reset_inputs()
 
-	def set_state(self, ct, ht, H, contexts):
+	def set_state(self, ct, ht, H, context):
 		self.ct = ct	# last cell state
 		self.ht = ht	# last hidden state
-		self.H = H		# all hidden states
-		self.contexts = contexts
+		self.H = HiddenStateBuffer(H, self._time_major)		# all hidden states
+		self.context = context	# last ungated hidden state (batchsize, channels)
+
+	def reorder_state(self, indices):
+		super(QRNNGlobalAttentiveDecoder, self).reorder_state(indices)
+		self.context = _take_batch(self.context, indices, 0)
+
+	_state_names = QRNN._state_names + ("context",)
+
+# everything the decoders read from the encoder at every step, computed once per source batch
+# projections: V(ht_enc) of every decoder layer
+# attention_memory: hidden states of the last encoder layer (batchsize, seq_length, channels)
+# bias, mask: softmax bias and mask of the attention that skip PAD
+class EncoderMemory(object):
+	def __init__(self, decoders, last_hidden_states, last_layer_outputs=None, skip_mask=None):
+		self.last_hidden_states = list(last_hidden_states)
+		self.projections = [decoder.V(ht) for decoder, ht in zip(decoders, self.last_hidden_states)]
+		self.attention_memory = None
+		self.bias, self.mask = 0, 1
+		if last_layer_outputs is not None:
+			decoder = decoders[-1]
+			self.attention_memory = decoder._to_attention_memory(last_layer_outputs)
+			self.bias, self.mask = decoder._get_attention_mask(skip_mask, last_layer_outputs)
+
+	def __len__(self):
+		return self.last_hidden_states[0].shape[0]
+
+	# keeps the sentences given by indices, e.g. the unfinished ones
+	def take(self, indices):
+		memory = copy.copy(self)
+		memory.last_hidden_states = [_take_batch(ht, indices, 0) for ht in self.last_hidden_states]
+		memory.projections = [_take_batch(Vh, indices, 0) for Vh in self.projections]
+		memory.attention_memory = _take_batch(self.attention_memory, indices, 0)
+		if isinstance(self.bias, int) == False:
+			memory.bias = self.bias[indices]
+			memory.mask = self.mask[indices]
+		return memory
+
+# numpy's random state is saved and restored exactly
+# cupy's generator cannot be saved, so it is reseeded from numpy before the forward pass and before the replay
+class RandomState(object):
+	def __init__(self, xp):
+		self.xp = xp
+		if xp is np:
+			self.state = np.random.get_state()
+		else:
+			self.state = np.random.randint(2 ** 31)
+			xp.random.seed(self.state)
+
+	# calls func with the random numbers it saw when this object was created
+	def replay(self, func, *args):
+		if self.xp is np:
+			current_state = np.random.get_state()
+			np.random.set_state(self.state)
+			try:
+				return func(*args)
+			finally:
+				np.random.set_state(current_state)
+		self.xp.random.seed(self.state)
+		try:
+			return func(*args)
+		finally:
+			self.xp.random.seed(np.random.randint(2 ** 31))
+
+# runs forward(*xs) without keeping the intermediate arrays of the layers.
+# during backward the layers are run again from the same state and with the same random numbers,
+# so zoneout and dropout masks are reproduced exactly.
+# cudnn dropout keeps its own random state, so cudnn is disabled inside the checkpoint.
+def checkpoint(layers, forward, *xs):
+	xp = cuda.get_array_module(*[x.data if isinstance(x, Variable) else x for x in xs])
+	states = [layer.save_state() for layer in layers]
+	random_state = RandomState(xp)
+
+	def recompute(*xs):
+		with chainer.using_config("use_cudnn", "never"):
+			if chainer.config.in_recomputing == False:
+				return forward(*xs)
+			final_states = [layer.save_state() for layer in layers]
+			for layer, state in zip(layers, states):
+				layer.restore_state(state)
+			try:
+				return random_state.replay(forward, *xs)
+			finally:
+				for layer, state in zip(layers, final_states):
+					layer.restore_state(state)
+
+	return functions.forget(recompute, *xs)
+
+# runs layers[start:end] inside one checkpoint and reconnects their states to the graph
+def _forward_segment(layers, forward_layer, start, end, in_data, layer_inputs, time_major):
+	extra_inputs = [x for i in xrange(start, end) for x in layer_inputs[i]]
+
+	def forward(in_data, *extra_inputs):
+		hts = []
+		k = 0
+		for i in xrange(start, end):
+			n = len(layer_inputs[i])
+			in_data = forward_layer(i, in_data, *extra_inputs[k:k + n])
+			hts.append(layers[i].get_last_hidden_state())
+			k += n
+		return (in_data,) + tuple(hts)
+
+	outputs = checkpoint(layers[start:end], forward, in_data, *extra_inputs)
+	out_data, hts = outputs[0], outputs[1:]
+	for layer, ht in zip(layers[start:end], hts):
+		layer.ht = ht
+	layers[end - 1].H = HiddenStateBuffer(out_data, time_major)
+	return out_data
+
+# runs a stack of layers, forward_layer(index, in_data, *layer_inputs[index]) runs one of them.
+# with densely_connected every layer reads the outputs of all previous layers (https://arxiv.org/abs/1608.06993).
+# with checkpoint_interval = k > 0 only the input of every k-th layer is kept and the rest is recomputed in backward.
+# every output of a densely connected stack is kept in the feature buffer anyway, so there each layer is its own segment.
+def forward_layers(layers, forward_layer, in_data, layer_inputs=None, densely_connected=False, time_major=False, checkpoint_interval=0):
+	num_layers = len(layers)
+	if layer_inputs is None:
+		layer_inputs = [()] * num_layers
+	if chainer.config.enable_backprop == False:
+		checkpoint_interval = 0
+	if densely_connected:
+		checkpoint_interval = min(checkpoint_interval, 1)
+		features = DenseFeatureBuffer(num_layers, time_major)
+
+	start = 0
+	while start < num_layers:
+		if checkpoint_interval > 0:
+			end = min(start + checkpoint_interval, num_layers)
+			in_data = _forward_segment(layers, forward_layer, start, end, in_data, layer_inputs, time_major)
+		else:
+			end = start + 1
+			in_data = forward_layer(start, in_data, *layer_inputs[start])
+		if densely_connected:
+			in_data = features.append(in_data)
+		start = end
+	return in_data
@@ -1,3 +1,4 @@
+from __future__ import division
 import sys
 
 class stdout:
@@ -16,4 +17,15 @@ def printr(string):
 bucket_sizes = [10, 20, 40, 100, 200]
 ID_PAD = -1
 ID_BOS = 0
-ID_EOS = 1
\ No newline at end of file
+ID_EOS = 1
+
+# size, number of sentences and ratio of ID_PAD of every bucket, then of all buckets
+def print_buckets(buckets):
+	num_padded = 0
+	num_tokens = 0
+	for data in buckets:
+		padded = int((data == ID_PAD).sum())
+		print("{}	{}	{:.1f}%".format(data.shape[1], len(data), 100 * padded / data.size))
+		num_padded += padded
+		num_tokens += data.size
+	print("total	{}	{:.1f}%".format(sum(len(data) for data in buckets), 100 * num_padded / max(num_tokens, 1)))
@@ -1,65 +1,25 @@
 # coding: utf-8
-import codecs, random
+import codecs, random, sys, os
 import numpy as np
+sys.path.append(os.pardir)
+import corpus
 from common import ID_PAD, ID_BOS, ID_EOS, bucket_sizes
 
-def read_data(filename_train=None, filename_dev=None, filename_test=None, vocab=None):
+# see corpus.build_corpus; num_workers > 0 converts the lines in a process pool
+def read_data(filename_train=None, filename_dev=None, filename_test=None, vocab=None, cache_dir=None, num_workers=0):
 	if vocab is None:
 		vocab = {
 			"<bos>": ID_BOS,
 			"<eos>": ID_EOS,
 		}
-	dataset_train = []
-	dataset_dev = []
-	dataset_test = []
 
-	if filename_train is not None:
-		with codecs.open(filename_train, "r", "utf-8") as f:
-			for sentence in f:
-				sentence = sentence.strip()
-				if len(sentence) == 0:
-					continue
-				word_ids = [ID_BOS]
-				words = sentence.split(" ")
-				for word in words:
-					if word not in vocab:
-						vocab[word] = len(vocab)
-					word_id = vocab[word]
-					word_ids.append(word_id)
-				word_ids.append(ID_EOS)
-				dataset_train.append(word_ids)
+	fields = [corpus.Field(vocab, grow_vocab=True, prefix=ID_BOS, suffix=ID_EOS)]
+	files = [((filename_train,), ("train",)), ((filename_dev,), ("dev",)), ((filename_test,), ("test",))]
 
-	if filename_dev is not None:
-		with codecs.open(filename_dev, "r", "utf-8") as f:
-			for sentence in f:
-				sentence = sentence.strip()
-				if len(sentence) == 0:
-					continue
-				word_ids = [ID_BOS]
-				words = sentence.split(" ")
-				for word in words:
-					if word not in vocab:
-						vocab[word] = len(vocab)
-					word_id = vocab[word]
-					word_ids.append(word_id)
-				word_ids.append(ID_EOS)
-				dataset_dev.append(word_ids)
-
-	if filename_test is not None:
-		with codecs.open(filename_test, "r", "utf-8") as f:
-			for sentence in f:
-				sentence = sentence.strip()
-				if len(sentence) == 0:
-					continue
-				word_ids = [ID_BOS]
-				words = sentence.split(" ")
-				for word in words:
-					if word not in vocab:
-						vocab[word] = len(vocab)
-					word_id = vocab[word]
-					word_ids.append(word_id)
-				word_ids.append(ID_EOS)
-				dataset_test.append(word_ids)
+	# the key is computed before the new words are added to vocab
+	key = None if cache_dir is None else corpus.get_cache_key((filename_train, filename_dev, filename_test), (vocab,), {"reader": "rnn", "fields": [field.get_options() for field in fields]})
+	datasets = corpus.load_or_build_corpus(cache_dir, key, files, fields, num_workers)
+	dataset_train, dataset_dev, dataset_test = datasets
 
 	vocab_inv = {}
 	for word, word_id in vocab.items():
@@ -73,31 +33,22 @@ def read_data(filename_train=None, filename_dev=None, filename_test=None, vocab=
 # output:
 # [[0, a, b, c,  1]
 #  [0, d, e, 1, -1]]
-def make_buckets(dataset):
-	max_length = 0
-	for word_ids in dataset:
-		if len(word_ids) > max_length:
-			max_length = len(word_ids)
-	bucket_sizes.append(max_length)
-	buckets_list = [[] for _ in range(len(bucket_sizes))]
-	for word_ids in dataset:
-		length = len(word_ids)
-		bucket_index = 0
-		for size in bucket_sizes:
-			if length <= size:
-				if size - length > 0:
-					for _ in range(size - length):
-						word_ids.append(ID_PAD)
-				break
-			bucket_index += 1
-		buckets_list[bucket_index].append(word_ids)
-	buckets = []
-	for bucket in buckets_list:
-		if len(bucket) == 0:
-			continue
-		buckets.append(np.asarray(bucket).astype(np.int32))
+# sizes defaults to bucket_sizes
+# a last bucket as long as the longest sentence is added if it does not fit into sizes
+def make_buckets(dataset, sizes=None):
+	dataset = corpus.as_corpus(dataset)
+	sizes = list(bucket_sizes if sizes is None else sizes)
+	max_length = int(dataset.lengths().max()) if len(dataset) > 0 else 0
+	if max_length > sizes[-1]:
+		sizes.append(max_length)
+	(buckets,), _ = corpus.make_buckets([dataset], sizes, ID_PAD, [False])
 	return buckets
 
+# bucket sizes that minimize the padding of the datasets, see corpus.optimize_bucket_sizes
+def get_bucket_sizes(datasets, num_buckets):
+	lengths = np.concatenate([corpus.as_corpus(dataset).lengths() for dataset in datasets if len(dataset) > 0])
+	return corpus.optimize_bucket_sizes(lengths, num_buckets)
+
 def sample_batch_from_bucket(bucket, num_samples):
 	num_samples = num_samples if len(bucket) >= num_samples else len(bucket)
 	indices = np.random.choice(np.arange(len(bucket), dtype=np.int32), size=num_samples, replace=False)
@@ -2,11 +2,11 @@
 from __future__ import division
 from __future__ import print_function
 import numpy as np
-import chainer, sys
+import chainer, sys, tempfile
 import chainer.links as L
 import chainer.functions as F
 from chainer import Variable, Chain, cuda
-from model import RNNModel
+from model import RNNModel, save_model
 from dataset import make_source_target_pair
 
 def test_rnn():
@@ -27,11 +27,59 @@ def test_rnn():
 		model.reset_state()
 		np.random.seed(0)
 		for t in range(source.shape[1]):
-			y = model.forward_one_step(source[:, :t+1]).data
+			y = model.forward_one_step(source[:, t]).data
 			target = np.swapaxes(np.reshape(Y, (batchsize, -1, vocab_size)), 1, 2)
 			target = np.reshape(np.swapaxes(target[:, :, t, None], 1, 2), (batchsize, -1))
-			assert np.sum((y - target) ** 2) == 0
+			np.testing.assert_allclose(y, target, atol=1e-6)
 			print("t = {} OK".format(t))
 
+def test_inference():
+	import inference
+	np.random.seed(0)
+	batchsize = 3
+	seq_length = 20
+	vocab_size = 10
+	data = np.random.randint(0, vocab_size, size=(batchsize, seq_length), dtype=np.int32)
+	for time_major in [False, True]:
+		for weightnorm in [False, True]:
+			model = RNNModel(vocab_size, ndim_embedding=8, num_layers=3, ndim_h=5, kernel_size=3, pooling="fo", weightnorm=weightnorm, densely_connected=True, time_major=time_major)
+			with chainer.using_config("train", False), chainer.no_backprop_mode():
+				model(data)	# initialize weight normalization
+				dirname = tempfile.mkdtemp()
+				save_model(dirname, model)
+				runtime = inference.load_model(dirname)
+
+				model.reset_state()
+				assert np.all(model(data).data == runtime(data))
+				model.reset_state()
+				runtime.reset_state()
+				for t in range(seq_length):
+					assert np.all(model.forward_one_step(data[:, t]).data == runtime.forward_one_step(data[:, t]))
+			print("time_major = {}, weightnorm = {} OK".format(time_major, weightnorm))
+
+def test_checkpoint():
+	np.random.seed(0)
+	batchsize, seq_length, vocab_size = 3, 12, 7
+	data = np.random.randint(0, vocab_size, size=(batchsize, seq_length), dtype=np.int32)
+	source, target = make_source_target_pair(data)
+	for densely_connected in [False, True]:
+		model = RNNModel(vocab_size, ndim_embedding=6, num_layers=4, ndim_h=5, kernel_size=3, pooling="fo", zoneout=0.3, dropout=0.3, densely_connected=densely_connected)
+		results = []
+		for checkpoint_interval in [0, 1, 2]:
+			model.checkpoint_interval = checkpoint_interval
+			model.cleargrads()
+			model.reset_state()
+			np.random.seed(1)	# the same dropout and zoneout masks in every run
+			with chainer.using_config("train", True):
+				loss = F.softmax_cross_entropy(model(source), target)
+				loss.backward()
+			results.append([loss.data] + [param.grad for _, param in sorted(model.namedparams())])
+		for result in results[1:]:
+			for a, b in zip(results[0], result):
+				assert np.allclose(a, b, atol=1e-6)
+		print("densely_connected = {} OK".format(densely_connected))
+
 if __name__ == "__main__":
 	test_rnn()
+	test_inference()
+	test_checkpoint()
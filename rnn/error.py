@@ -8,9 +8,11 @@ import chainer.functions as F
 from chainer import cuda, function
 from chainer.utils import type_check
 from chainer.functions.activation import log_softmax
-from dataset import sample_batch_from_bucket, make_source_target_pair, read_data, make_buckets
-from common import ID_PAD, ID_BOS, ID_EOS, stdout, printr, printb, bucket_sizes
-from model import load_model, load_vocab
+from dataset import sample_batch_from_bucket, make_source_target_pair, read_data, make_buckets, get_bucket_sizes
+from corpus import fingerprint
+from common import ID_PAD, ID_BOS, ID_EOS, stdout, printr, printb, print_buckets
+from model import load_model, load_vocab, load_bucket_sizes
+from qrnn import set_pooling_threads, fold_weightnorm
 
 def _broadcast_to(array, shape):
 	if hasattr(numpy, "broadcast_to"):
@@ -105,47 +107,50 @@ def compute_random_perplexity(model, buckets, batchsize=100):
 def main():
 	# load textfile
 	vocab, vocab_inv = load_vocab(args.model_dir)
-	dataset_train, dataset_dev, dataset_test, _, _ = read_data(args.train_filename, args.dev_filename, args.test_filename, vocab=vocab)
+	dataset_train, dataset_dev, dataset_test, _, _ = read_data(args.train_filename, args.dev_filename, args.test_filename, vocab=vocab, cache_dir=args.cache_dir, num_workers=args.tokenize_workers)
 	vocab_size = len(vocab)
 	printb("data	#	hash")
-	print("train	{}	{}".format(len(dataset_train), hash(str(dataset_train))))
+	print("train	{}	{}".format(len(dataset_train), fingerprint(dataset_train)))
 	if len(dataset_dev) > 0:
-		print("dev	{}	{}".format(len(dataset_dev), hash(str(dataset_dev))))
+		print("dev	{}	{}".format(len(dataset_dev), fingerprint(dataset_dev)))
 	if len(dataset_test) > 0:
-		print("test	{}	{}".format(len(dataset_test), hash(str(dataset_test))))
+		print("test	{}	{}".format(len(dataset_test), fingerprint(dataset_test)))
 	print("vocab	{}".format(vocab_size))
 
-	# split into buckets
+	# split into buckets, the sizes saved by train.py take precedence over --num-buckets
+	sizes = load_bucket_sizes(args.model_dir)
+	if sizes is None and args.num_buckets > 0:
+		sizes = get_bucket_sizes([dataset_train, dataset_dev, dataset_test], args.num_buckets)
+	if sizes is not None:
+		print("bucket sizes	{}".format(sizes))
 	buckets_train = None
 	if len(dataset_train) > 0:
-		printb("buckets	#data	(train)")
-		buckets_train = make_buckets(dataset_train)
+		printb("buckets	#data	padding	(train)")
+		buckets_train = make_buckets(dataset_train, sizes)
 		if args.buckets_slice is not None:
 			buckets_train = buckets_train[:args.buckets_slice + 1]
-		for size, data in zip(bucket_sizes, buckets_train):
-			print("{}	{}".format(size, len(data)))
+		print_buckets(buckets_train)
 
 	buckets_dev = None
 	if len(dataset_dev) > 0:
-		printb("buckets	#data	(dev)")
-		buckets_dev = make_buckets(dataset_dev)
+		printb("buckets	#data	padding	(dev)")
+		buckets_dev = make_buckets(dataset_dev, sizes)
 		if args.buckets_slice is not None:
 			buckets_dev = buckets_dev[:args.buckets_slice + 1]
-		for size, data in zip(bucket_sizes, buckets_dev):
-			print("{}	{}".format(size, len(data)))
+		print_buckets(buckets_dev)
 
 	buckets_test = None
 	if len(dataset_test) > 0:
-		printb("buckets	#data	(test)")
-		buckets_test = make_buckets(dataset_test)
+		printb("buckets	#data	padding	(test)")
+		buckets_test = make_buckets(dataset_test, sizes)
 		if args.buckets_slice is not None:
 			buckets_test = buckets_test[:args.buckets_slice + 1]
-		for size, data in zip(bucket_sizes, buckets_test):
-			print("{}	{}".format(size, len(data)))
+		print_buckets(buckets_test)
 
 	# init
 	model = load_model(args.model_dir)
 	assert model is not None
+	fold_weightnorm(model)
 	if args.gpu_device >= 0:
 		chainer.cuda.get_device(args.gpu_device).use()
 		model.to_gpu()
@@ -182,6 +187,13 @@ if __name__ == "__main__":
 	parser.add_argument("--train-filename", "-train", default=None)
 	parser.add_argument("--dev-filename", "-dev", default=None)
 	parser.add_argument("--test-filename", "-test", default=None)
+	parser.add_argument("--cache-dir", type=str, default=None)
+	parser.add_argument("--tokenize-workers", type=int, default=0)
+	parser.add_argument("--num-buckets", type=int, default=0)	# > 0: bucket sizes that minimize padding instead of bucket_sizes
 	parser.add_argument("--model-dir", "-m", type=str, default="model")
+	parser.add_argument("--pooling-threads", type=int, default=0)
 	args = parser.parse_args()
+	num_pooling_threads = set_pooling_threads(args.pooling_threads)
+	if args.pooling_threads > 1 and num_pooling_threads < args.pooling_threads:
+		print("pooling threads	{} (limited by the number of cores and a timing of the chunked scan)".format(num_pooling_threads))
 	main()
\ No newline at end of file
@@ -0,0 +1,26 @@
+# coding: utf-8
+from __future__ import division
+from __future__ import print_function
+import argparse
+from model import load_model, load_vocab, save_model, save_vocab
+from qrnn import fold_weightnorm
+
+# writes a copy of the model whose weight-normalized convolutions are replaced by plain ones
+def main():
+	model = load_model(args.model_dir)
+	assert model is not None
+
+	vocab, vocab_inv = load_vocab(args.model_dir)
+	assert vocab is not None
+	assert vocab_inv is not None
+
+	fold_weightnorm(model)
+	save_model(args.output_dir, model)
+	save_vocab(args.output_dir, vocab, vocab_inv)
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--model-dir", "-m", type=str, default="model")
+	parser.add_argument("--output-dir", "-o", type=str, default="model_folded")
+	args = parser.parse_args()
+	main()
@@ -6,10 +6,17 @@ import argparse, sys, os
 import numpy as np
 import chainer.functions as F
 from model import load_model, load_vocab
+from qrnn import fold_weightnorm
 from train import ID_BOS, ID_EOS
+import inference
 
 def main():
-	model = load_model(args.model_dir)
+	if args.numpy:
+		model = inference.load_model(args.model_dir)	# graph-free runtime, same outputs
+	else:
+		model = load_model(args.model_dir)
+		assert model is not None
+		fold_weightnorm(model)
 	assert model is not None
 
 	vocab, vocab_inv = load_vocab(args.model_dir)
@@ -22,16 +29,16 @@ def main():
 		for n in range(args.num_generate):
 			word_ids = np.arange(0, vocab_size, dtype=np.int32)
 			token = ID_BOS
-			x = np.asarray([[token]]).astype(np.int32)
+			tokens = [token]
 			model.reset_state()
-			while token != ID_EOS and x.shape[1] < args.max_sentence_length:
-				u = model.forward_one_step(x)
-				p = F.softmax(u).data[-1]
-				token = np.random.choice(word_ids, size=1, p=p)
-				x = np.append(x, np.asarray([token]).astype(np.int32), axis=1)
+			while token != ID_EOS and len(tokens) < args.max_sentence_length:
+				u = model.forward_one_step(np.asarray([token], dtype=np.int32))
+				p = F.softmax(u).data[0]
+				token = int(np.random.choice(word_ids, p=p))
+				tokens.append(token)
 
 			sentence = []
-			for token in x[0]:
+			for token in tokens:
 				word = vocab_inv[token]
 				sentence.append(word)
 			print(" ".join(sentence))
@@ -42,5 +49,6 @@ if __name__ == "__main__":
 	parser.add_argument("--num-generate", "-n", type=int, default=50)
 	parser.add_argument("--max-sentence-length", "-max", type=int, default=50)
 	parser.add_argument("--model-dir", "-m", type=str, default="model")
+	parser.add_argument("--numpy", dest="numpy", default=False, action="store_true")
 	args = parser.parse_args()
 	main()
\ No newline at end of file
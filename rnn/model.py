@@ -55,6 +55,7 @@ def save_model(dirname, qrnn):
 		"wgain": qrnn.wgain,
 		"densely_connected": qrnn.densely_connected,
 		"ignore_label": qrnn.ignore_label,
+		"time_major": qrnn.time_major,
 	}
 	with open(param_filename, "w") as f:
 		json.dump(params, f, indent=4, sort_keys=True, separators=(',', ': '))
@@ -81,11 +82,40 @@ def load_model(dirname):
 	else:
 		return None
 
+# the bucket sizes of the training, so that error.py splits the data into the same buckets
+def save_bucket_sizes(dirname, sizes):
+	filename = dirname + "/buckets.json"
+	with open(filename, "w") as f:
+		json.dump(sizes, f)
+
+def load_bucket_sizes(dirname):
+	filename = dirname + "/buckets.json"
+	if os.path.isfile(filename):
+		print("loading {} ...".format(filename))
+		with open(filename, "r") as f:
+			return [int(size) for size in json.load(f)]
+	return None
+
+# the position of the training iterator, see corpus.BucketIterator
+def save_iterator(dirname, iterator):
+	filename = dirname + "/iterator.npz"
+	tmp_filename = filename + ".tmp"
+	serializers.save_npz(tmp_filename, iterator, compression=False)
+	os.rename(tmp_filename, filename)
+
+def load_iterator(dirname, iterator):
+	filename = dirname + "/iterator.npz"
+	if os.path.isfile(filename):
+		print("loading {} ...".format(filename))
+		serializers.load_npz(filename, iterator)
+		return True
+	return False
+
 class RNNModel(Chain):
-	def __init__(self, vocab_size, ndim_embedding, num_layers, ndim_h, kernel_size=4, pooling="fo", zoneout=0, dropout=0, weightnorm=False, wgain=1, densely_connected=False, ignore_label=None):
+	def __init__(self, vocab_size, ndim_embedding, num_layers, ndim_h, kernel_size=4, pooling="fo", zoneout=0, dropout=0, weightnorm=False, wgain=1, densely_connected=False, ignore_label=None, time_major=False):
 		super(RNNModel, self).__init__(
-			embed=L.EmbedID(vocab_size, ndim_embedding, ignore_label=ignore_label),
-			fc=L.Convolution1D(ndim_h * num_layers if densely_connected else ndim_h, vocab_size, ksize=1, stride=1, pad=0, weightnorm=weightnorm, initialW=initializers.Normal(math.sqrt(wgain / ndim_h)))
+			embed=L.SparseEmbedID(vocab_size, ndim_embedding, ignore_label=ignore_label),
+			fc=L.Convolution1D(ndim_h * num_layers if densely_connected else ndim_h, vocab_size, ksize=1, weightnorm=weightnorm, initialW=initializers.Normal(math.sqrt(wgain / ndim_h)), time_major=time_major)
 		)
 		assert num_layers > 0
 		self.vocab_size = vocab_size
@@ -101,11 +131,13 @@ class RNNModel(Chain):
 		self.wgain = wgain
 		self.ignore_label = ignore_label
 		self.densely_connected = densely_connected
+		self.time_major = time_major	# activations are (seq_length, batchsize, channels) instead of (batchsize, channels, seq_length)
+		self.checkpoint_interval = 0	# recompute the layers in backward, keeping the input of every k-th layer
 
 		with self.init_scope():
-			setattr(self, "qrnn0", L.QRNN(ndim_embedding, ndim_h, kernel_size=kernel_size, pooling=pooling, zoneout=zoneout, weightnorm=weightnorm, wgain=wgain))
+			setattr(self, "qrnn0", L.QRNN(ndim_embedding, ndim_h, kernel_size=kernel_size, pooling=pooling, zoneout=zoneout, weightnorm=weightnorm, wgain=wgain, time_major=time_major))
 			for i in range(1, num_layers):
-				setattr(self, "qrnn{}".format(i), L.QRNN(ndim_h * i if densely_connected else ndim_h, ndim_h, kernel_size=kernel_size, pooling=pooling, zoneout=zoneout, weightnorm=weightnorm, wgain=wgain))
+				setattr(self, "qrnn{}".format(i), L.QRNN(ndim_h * i if densely_connected else ndim_h, ndim_h, kernel_size=kernel_size, pooling=pooling, zoneout=zoneout, weightnorm=weightnorm, wgain=wgain, time_major=time_major))
 
 	def get_rnn_layer(self, index):
 		return getattr(self, "qrnn{}".format(index))
@@ -114,6 +146,13 @@ class RNNModel(Chain):
 		for i in range(self.num_layers):
 			self.get_rnn_layer(i).reset_state()
 
+	# we use "dense convolution"
+	# https://arxiv.org/abs/1608.06993
+	# the outputs of all layers share one preallocated buffer instead of being concatenated
+	def _forward_layers(self, forward_layer, in_data, layer_inputs=None, checkpoint_interval=0):
+		layers = [self.get_rnn_layer(i) for i in range(self.num_layers)]
+		return L.forward_layers(layers, forward_layer, in_data, layer_inputs, self.densely_connected, self.time_major, checkpoint_interval)
+
 	def _forward_layer(self, layer_index, in_data):
 		if self.using_dropout:
 			in_data = F.dropout(in_data, ratio=self.dropout)
@@ -121,31 +160,24 @@ class RNNModel(Chain):
 		out_data = layer(in_data)
 		return out_data
 
-	# we use "dense convolution"
-	# https://arxiv.org/abs/1608.06993
 	def __call__(self, X, return_last=False):
 		batchsize = X.shape[0]
 		seq_length = X.shape[1]
-		enmbedding = self.embed(X)
-		enmbedding = F.swapaxes(enmbedding, 1, 2)
-
-		out_data = self._forward_layer(0, enmbedding)
-		in_data = [out_data]
-
-		for layer_index in range(1, self.num_layers):
-			out_data = self._forward_layer(layer_index, F.concat(in_data) if self.densely_connected else in_data[-1])	# dense conv
-			in_data.append(out_data)
+		if self.time_major:
+			enmbedding = self.embed(X.T)	# transpose the token ids instead of the embeddings
+		else:
+			enmbedding = F.swapaxes(self.embed(X), 1, 2)
 
-		out_data = F.concat(in_data) if self.densely_connected else out_data	# dense conv
+		out_data = self._forward_layers(self._forward_layer, enmbedding, checkpoint_interval=self.checkpoint_interval)
 
 		if return_last:
-			out_data = out_data[:, :, -1, None]
+			out_data = out_data[-1:] if self.time_major else out_data[:, :, -1, None]
 
 		if self.using_dropout:
 			out_data = F.dropout(out_data, ratio=self.dropout)
 
 		out_data = self.fc(out_data)
-		out_data = F.reshape(F.swapaxes(out_data, 1, 2), (-1, self.vocab_size))
+		out_data = F.reshape(F.swapaxes(out_data, 0, 1) if self.time_major else F.swapaxes(out_data, 1, 2), (-1, self.vocab_size))
 
 		return out_data
 
@@ -156,33 +188,19 @@ class RNNModel(Chain):
 		out_data = rnn.forward_one_step(in_data)
 		return out_data
 
+	# X: the newest tokens (batchsize,) or (batchsize, 1)
 	def forward_one_step(self, X):
-		batchsize = X.shape[0]
-		seq_length = X.shape[1]
-		ksize = self.kernel_size
-
-		if seq_length < ksize:
-			self.reset_state()
-			return self.__call__(X, return_last=True)
-
-		xt = X[:, -ksize:]
-		enmbedding = self.embed(xt)
-		enmbedding = F.swapaxes(enmbedding, 1, 2)
-
-		out_data = self._forward_layer_one_step(0, enmbedding)[:, :, -ksize:]
-		in_data = [out_data]
-		
-		for layer_index in range(1, self.num_layers):
-			out_data = self._forward_layer_one_step(layer_index, F.concat(in_data) if self.densely_connected else in_data[-1])[:, :, -ksize:]	# dense conv
-			in_data.append(out_data)
+		if X.ndim == 2:
+			assert X.shape[1] == 1
+			X = X[:, 0]
+		enmbedding = self.embed(X)
 
-		out_data = F.concat(in_data) if self.densely_connected else out_data	# dense conv
+		out_data = self._forward_layers(self._forward_layer_one_step, enmbedding)
 
 		if self.using_dropout:
 			out_data = F.dropout(out_data, ratio=self.dropout)
 			
-		out_data = out_data[..., -1, None]
 		out_data = self.fc(out_data)
-		out_data = F.reshape(F.swapaxes(out_data, 1, 2), (-1, self.vocab_size))
+		out_data = F.reshape(out_data, (-1, self.vocab_size))
 
 		return out_data
@@ -6,128 +6,184 @@ import numpy as np
 import chainer
 import chainer.functions as F
 from chainer import Variable, optimizers, cuda
-from model import RNNModel, load_model, save_model, save_vocab
-from common import ID_PAD, ID_BOS, ID_EOS, bucket_sizes, printb, printr
-from dataset import read_data, make_buckets, sample_batch_from_bucket, make_source_target_pair
+from model import RNNModel, load_model, save_model, save_vocab, load_iterator, save_iterator, save_bucket_sizes, load_bucket_sizes
+from qrnn import set_pooling_threads
+from common import ID_PAD, ID_BOS, ID_EOS, printb, printr, print_buckets
+from dataset import read_data, make_buckets, get_bucket_sizes, sample_batch_from_bucket, make_source_target_pair
+from corpus import fingerprint, BucketIterator, trim_batch
 from error import compute_accuracy, compute_random_accuracy, compute_perplexity, compute_random_perplexity
-from optim import get_current_learning_rate, get_optimizer, decay_learning_rate
+from optim import get_current_learning_rate, get_optimizer, decay_learning_rate, flush_optimizer
+import parallel
 
 def dump_dataset(dataset_train, dataset_dev, train_buckets, dev_buckets, vocab_size):
 	printb("data	#	hash")
-	print("train	{}	{}".format(len(dataset_train), hash(str(dataset_train))))
+	print("train	{}	{}".format(len(dataset_train), fingerprint(dataset_train)))
 	if len(dataset_dev) > 0:
-		print("dev	{}	{}".format(len(dataset_dev), hash(str(dataset_dev))))
+		print("dev	{}	{}".format(len(dataset_dev), fingerprint(dataset_dev)))
 	print("vocab	{}".format(vocab_size))
 
-	printb("buckets	#data	(train)")
-	for size, data in zip(bucket_sizes, train_buckets):
-		print("{}	{}".format(size, len(data)))
+	printb("buckets	#data	padding	(train)")
+	print_buckets(train_buckets)
 
 	if len(dev_buckets) > 0:
-		printb("buckets	#data	(dev)")
-		for size, data in zip(bucket_sizes, dev_buckets):
-			print("{}	{}".format(size, len(data)))
+		printb("buckets	#data	padding	(dev)")
+		print_buckets(dev_buckets)
 
 def main():
+	if args.seed is not None:
+		np.random.seed(args.seed)
+
 	# load textfile
-	dataset_train, dataset_dev, _, vocab, vocab_inv = read_data(args.train_filename, args.dev_filename)
+	dataset_train, dataset_dev, _, vocab, vocab_inv = read_data(args.train_filename, args.dev_filename, cache_dir=args.cache_dir, num_workers=args.tokenize_workers)
 	vocab_size = len(vocab)
 
 	save_vocab(args.model_dir, vocab, vocab_inv)
 
-	# split into buckets
-	train_buckets = make_buckets(dataset_train)
+	# split into buckets, the sizes of a saved model are kept so that the saved iterator stays valid
+	sizes = load_bucket_sizes(args.model_dir)
+	if sizes is None and args.num_buckets > 0:
+		sizes = get_bucket_sizes([dataset_train, dataset_dev], args.num_buckets)
+		save_bucket_sizes(args.model_dir, sizes)
+	if sizes is not None:
+		print("bucket sizes	{}".format(sizes))
+	train_buckets = make_buckets(dataset_train, sizes)
 
 	if args.buckets_slice is not None:
 		train_buckets = train_buckets[:args.buckets_slice + 1]
 
 	dev_buckets = None
 	if len(dataset_dev) > 0:
-		dev_buckets = make_buckets(dataset_dev)
+		dev_buckets = make_buckets(dataset_dev, sizes)
 		if args.buckets_slice is not None:
 			dev_buckets = dev_buckets[:args.buckets_slice + 1]
 
 	# print
 	dump_dataset(dataset_train, dataset_dev, train_buckets, dev_buckets, vocab_size)
 
-	# to maintain equilibrium
-	required_interations = []
-	for data in train_buckets:
-		itr = math.ceil(len(data) / args.batchsize)
-		required_interations.append(itr)
-	total_iterations = sum(required_interations)
-	buckets_distribution = np.asarray(required_interations, dtype=float) / total_iterations
+	# every sentence once per epoch, batches of at most max_tokens tokens instead of batchsize sentences if max_tokens > 0
+	lengths_train = [(data != ID_PAD).sum(axis=1) for data in train_buckets]
+	iterator = BucketIterator([train_buckets], args.batchsize, lengths_train, args.max_tokens)
+	if load_iterator(args.model_dir, iterator):
+		print("resuming epoch {} at iteration {}".format(iterator.epoch + 1, iterator.position))
 
 	# init
 	model = load_model(args.model_dir)
 	if model is None:
-		model = RNNModel(vocab_size, args.ndim_embedding, args.num_layers, ndim_h=args.ndim_h, kernel_size=args.kernel_size, pooling=args.pooling, zoneout=args.zoneout, dropout=args.dropout, weightnorm=args.weightnorm, wgain=args.wgain, densely_connected=args.densely_connected, ignore_label=ID_PAD)
+		model = RNNModel(vocab_size, args.ndim_embedding, args.num_layers, ndim_h=args.ndim_h, kernel_size=args.kernel_size, pooling=args.pooling, zoneout=args.zoneout, dropout=args.dropout, weightnorm=args.weightnorm, wgain=args.wgain, densely_connected=args.densely_connected, ignore_label=ID_PAD, time_major=args.time_major)
+	model.checkpoint_interval = args.checkpoint_interval	# trade compute for activation memory
 
 	if args.gpu_device >= 0:
 		chainer.cuda.get_device(args.gpu_device).use()
 		model.to_gpu()
 
 	# setup an optimizer
-	optimizer = get_optimizer(args.optimizer, args.learning_rate, args.momentum)
+	optimizer = get_optimizer(args.optimizer, args.learning_rate, args.momentum, flat=args.flat_optimizer, sparse_embedding=args.sparse_embedding)
 	optimizer.setup(model)
 	optimizer.add_hook(chainer.optimizer.GradientClipping(args.grad_clip))
 	optimizer.add_hook(chainer.optimizer.WeightDecay(args.weight_decay))
 	final_learning_rate = 1e-4
-	total_time = 0
 
 	def mean(l):
 		return sum(l) / len(l)
 
-	# training
-	for epoch in range(1, args.epoch + 1):
-		print("Epoch", epoch)
-		start_time = time.time()
-
-		with chainer.using_config("train", True):
-			for itr in range(total_iterations):
-				bucket_idx = int(np.random.choice(np.arange(len(train_buckets)), size=1, p=buckets_distribution))
-				dataset = train_buckets[bucket_idx]
-				np.random.shuffle(dataset)
-				data_batch = dataset[:args.batchsize]
-
-				source_batch, target_batch = make_source_target_pair(data_batch)
+	# runs in the prefetch thread
+	def prepare(batch):
+		bucket_idx, indices, (data_batch,) = batch
+		if args.max_tokens > 0:
+			data_batch = trim_batch(data_batch, int(lengths_train[bucket_idx][indices].max()))
 
-				if args.gpu_device >= 0:
-					source_batch = cuda.to_gpu(source_batch)
-					target_batch = cuda.to_gpu(target_batch)
+		source_batch, target_batch = make_source_target_pair(data_batch)
+		num_targets = int((target_batch != ID_PAD).sum())
 
-				# update params
-				model.reset_state()
-				y_batch = model(source_batch)
-				loss = F.softmax_cross_entropy(y_batch, target_batch, ignore_label=ID_PAD)
-				optimizer.update(lossfun=lambda: loss)
+		if args.gpu_device >= 0:
+			source_batch = cuda.to_gpu(source_batch, device=args.gpu_device)
+			target_batch = cuda.to_gpu(target_batch, device=args.gpu_device)
+		return source_batch, target_batch, num_targets
 
-				# show log
-				printr("iteration {}/{}".format(itr + 1, total_iterations))
+	def compute_loss(source_batch, target_batch):
+		model.reset_state()
+		y_batch = model(source_batch)
+		return F.softmax_cross_entropy(y_batch, target_batch, ignore_label=ID_PAD)
 
-		save_model(args.model_dir, model)
-
-		# clear console
-		printr("")
-
-		# compute perplexity
-		with chainer.using_config("train", False):
-			if dev_buckets is not None:
-				printb("	ppl (dev)")
-				ppl_dev = compute_perplexity(model, dev_buckets, args.batchsize)
-				print("	", mean(ppl_dev), ppl_dev)
-
-		# show log
-		elapsed_time = (time.time() - start_time) / 60.
-		total_time += elapsed_time
-		print("	done in {} min, lr = {}, total {} min".format(int(elapsed_time), get_current_learning_rate(optimizer), int(total_time)))
+	# weightnorm initializes some parameters on the first forward pass, every process must start from the same ones
+	if args.num_processes > 1 and parallel.has_uninitialized_params(model) and iterator.peek() is not None:
+		with chainer.using_config("train", True):
+			source_batch, target_batch, _ = prepare(iterator.peek())
+			compute_loss(source_batch, target_batch)
+
+	# runs in every process, see parallel.run. rank 0 prints, evaluates and saves
+	def train(communicator):
+		rank = 0 if communicator is None else communicator.rank
+		shard = None if communicator is None else (communicator.rank, communicator.size)
+		num_pooling_threads = set_pooling_threads(args.pooling_threads)
+		if args.pooling_threads > 1 and num_pooling_threads < args.pooling_threads and rank == 0:
+			print("pooling threads	{} (limited by the number of cores and a timing of the chunked scan)".format(num_pooling_threads))
+		if communicator is not None:
+			np.random.seed(np.random.randint(2 ** 31) + rank)	# different dropout masks on every rank
+			parallel.broadcast_params(communicator, model)
+		total_time = 0
+
+		for epoch in range(iterator.epoch + 1, args.epoch + 1):
+			if rank == 0:
+				print("Epoch", epoch)
+			start_time = time.time()
+			total_iterations = len(iterator)
+
+			with chainer.using_config("train", True):
+				for batch in iterator.iterate(prepare, args.prefetch, shard):
+					# update params
+					loss, num_targets = None, 0
+					if batch is not None:
+						source_batch, target_batch, num_targets = batch
+						loss = compute_loss(source_batch, target_batch)
+					parallel.update(optimizer, loss, num_targets, communicator)
+
+					if rank != 0:
+						continue
+
+					# show log
+					printr("iteration {}/{}".format(iterator.position, total_iterations))
+
+					if args.save_interval > 0 and iterator.position % args.save_interval == 0 and iterator.position < total_iterations:
+						flush_optimizer(optimizer)
+						save_model(args.model_dir, model)
+						save_iterator(args.model_dir, iterator)
+
+			# decay learning rate
+			learning_rate = get_current_learning_rate(optimizer)
+			decay_learning_rate(optimizer, args.lr_decay_factor, final_learning_rate)
+
+			if rank != 0:
+				continue
+
+			flush_optimizer(optimizer)
+			save_model(args.model_dir, model)
+			save_iterator(args.model_dir, iterator)
+
+			# clear console
+			printr("")
+			if iterator.prefetcher is not None:
+				print("	waited for data {}/{} times, {:.2f} sec".format(iterator.prefetcher.num_waits, iterator.prefetcher.num_items, iterator.prefetcher.wait_time))
+
+			# compute perplexity
+			with chainer.using_config("train", False):
+				if dev_buckets is not None:
+					printb("	ppl (dev)")
+					ppl_dev = compute_perplexity(model, dev_buckets, args.batchsize)
+					print("	", mean(ppl_dev), ppl_dev)
+
+			# show log
+			elapsed_time = (time.time() - start_time) / 60.
+			total_time += elapsed_time
+			print("	done in {} min, lr = {}, total {} min".format(int(elapsed_time), learning_rate, int(total_time)))
 
-		# decay learning rate
-		decay_learning_rate(optimizer, args.lr_decay_factor, final_learning_rate)
+	# training
+	parallel.run(args.num_processes, train, parallel.get_buffer_size(model))
 
 if __name__ == "__main__":
 	parser = argparse.ArgumentParser()
 	parser.add_argument("--batchsize", "-b", type=int, default=96)
+	parser.add_argument("--max-tokens", type=int, default=0)	# > 0: batches of at most max-tokens tokens, sorted by length and trimmed, instead of batchsize sentences
 	parser.add_argument("--epoch", "-e", type=int, default=1000)
 	parser.add_argument("--grad-clip", "-gc", type=float, default=1) 
 	parser.add_argument("--weight-decay", "-wd", type=float, default=1e-5) 
@@ -135,6 +191,8 @@ if __name__ == "__main__":
 	parser.add_argument("--lr-decay-factor", "-decay", type=float, default=0.95)
 	parser.add_argument("--momentum", "-mo", type=float, default=0.99)
 	parser.add_argument("--optimizer", "-opt", type=str, default="adam")
+	parser.add_argument("--flat-optimizer", default=False, action="store_true")	# parameters in one buffer, updated in one pass, see optim.FlatOptimizer
+	parser.add_argument("--sparse-embedding", default=False, action="store_true")	# only the embedding rows used by a batch are updated (sgd, adam), implies --flat-optimizer
 	
 	parser.add_argument("--kernel-size", "-ksize", type=int, default=4)
 	parser.add_argument("--ndim-h", "-nh", type=int, default=640)
@@ -147,12 +205,26 @@ if __name__ == "__main__":
 	parser.add_argument("--zoneout", "-zoneout", type=float, default=0)
 	parser.add_argument("--dropout", "-dropout", type=float, default=0)
 	parser.add_argument("--weightnorm", "-weightnorm", default=False, action="store_true")
+	parser.add_argument("--time-major", "-time-major", default=False, action="store_true")
+	parser.add_argument("--checkpoint-interval", "-checkpoint", type=int, default=0)
 	
 	parser.add_argument("--gpu-device", "-g", type=int, default=0) 
 	parser.add_argument("--interval", type=int, default=100)
+	parser.add_argument("--prefetch", type=int, default=2)	# number of batches prepared in a background thread, 0 prepares them in the training loop
+	parser.add_argument("--seed", type=int, default=None)
+	parser.add_argument("--save-interval", type=int, default=0)	# > 0: the model and the position in the epoch are saved every save-interval iterations
 	parser.add_argument("--buckets-slice", type=int, default=None)
 	parser.add_argument("--model-dir", "-m", type=str, default="model")
 	parser.add_argument("--train-filename", "-train", default=None)
 	parser.add_argument("--dev-filename", "-dev", default=None)
+	parser.add_argument("--cache-dir", type=str, default=None)
+	parser.add_argument("--tokenize-workers", type=int, default=0)
+	parser.add_argument("--num-buckets", type=int, default=0)	# > 0: bucket sizes that minimize padding instead of bucket_sizes
+	parser.add_argument("--pooling-threads", type=int, default=0)
+	parser.add_argument("--num-processes", type=int, default=1)	# > 1: data parallel training, every process takes a shard of every batch
 	args = parser.parse_args()
+	if args.num_processes > 1 and args.gpu_device >= 0:
+		parser.error("--num-processes > 1 runs on the CPU, pass --gpu-device -1")
+	if args.num_processes > 1 and args.sparse_embedding:
+		parser.error("--sparse-embedding cannot be used with --num-processes > 1, the sparse gradients of the embeddings are not reduced over the processes")
 	main()
\ No newline at end of file
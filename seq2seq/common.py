@@ -1,3 +1,4 @@
+from __future__ import division
 import sys
 
 class stdout:
@@ -17,4 +18,20 @@ bucket_sizes = [(5, 10), (10, 15), (20, 25), (40, 50), (100, 110), (200, 210)]
 ID_PAD = 0
 ID_UNK = 1
 ID_EOS = 2
-ID_GO = 3
\ No newline at end of file
+ID_GO = 3
+
+# size, number of pairs and ratio of ID_PAD of every bucket, then of all buckets
+def print_buckets(source_buckets, target_buckets=None):
+	if target_buckets is None:
+		target_buckets = [None] * len(source_buckets)
+	num_padded = 0
+	num_tokens = 0
+	for source, target in zip(source_buckets, target_buckets):
+		arrays = [source] if target is None else [source, target]
+		size = source.shape[1] if target is None else (source.shape[1], target.shape[1])
+		padded = sum(int((data == ID_PAD).sum()) for data in arrays)
+		tokens = sum(data.size for data in arrays)
+		print("{} 	{}	{:.1f}%".format(size, len(source), 100 * padded / tokens))
+		num_padded += padded
+		num_tokens += tokens
+	print("total 	{}	{:.1f}%".format(sum(len(source) for source in source_buckets), 100 * num_padded / max(num_tokens, 1)))
@@ -2,11 +2,11 @@
 from __future__ import division
 from __future__ import print_function
 import numpy as np
-import chainer
+import chainer, tempfile
 import chainer.links as L
 import chainer.functions as F
 from chainer import Variable, Chain
-from model import AttentiveSeq2SeqModel, Seq2SeqModel
+from model import AttentiveSeq2SeqModel, Seq2SeqModel, save_model
 
 def test_seq2seq():
 	num_layers = 13
@@ -30,10 +30,10 @@ def test_seq2seq():
 
 	model.reset_decoder_state()
 	for t in range(dec_seq_length):
-		y = model.decode_one_step(dec_data[:, :t+1], ht).data
+		y = model.decode_one_step(dec_data[:, t], ht).data
 		target = np.swapaxes(np.reshape(Y.data, (batchsize, -1, dec_vocab_size)), 1, 2)
 		target = np.reshape(np.swapaxes(target[:, :, t, None], 1, 2), (batchsize, -1))
-		assert np.sum((y - target) ** 2) == 0
+		np.testing.assert_allclose(y, target, atol=1e-6)
 		print("t = {} OK".format(t))
 
 def test_attentive_seq2seq():
@@ -58,12 +58,135 @@ def test_attentive_seq2seq():
 
 	model.reset_decoder_state()
 	for t in range(dec_seq_length):
-		y = model.decode_one_step(dec_data[:, :t+1], ht, H, skip_mask).data
+		y = model.decode_one_step(dec_data[:, t], ht, H, skip_mask).data
 		target = np.swapaxes(np.reshape(Y.data, (batchsize, -1, dec_vocab_size)), 1, 2)
 		target = np.reshape(np.swapaxes(target[:, :, t, None], 1, 2), (batchsize, -1))
-		assert np.sum((y - target) ** 2) == 0
+		np.testing.assert_allclose(y, target, atol=1e-6)
 		print("t = {} OK".format(t))
 
+def test_inference():
+	import inference
+	num_layers = 3
+	batchsize = 3
+	enc_vocab_size = 6
+	dec_vocab_size = 5
+	enc_data = np.random.randint(1, enc_vocab_size, size=(batchsize, 8), dtype=np.int32)
+	dec_data = np.random.randint(1, dec_vocab_size, size=(batchsize, 7), dtype=np.int32)
+	skip_mask = np.ones_like(enc_data).astype(np.float32)
+	skip_mask[1, :3] = 0
+	enc_data[1, :3] = 0
+
+	for time_major in [False, True]:
+		model = AttentiveSeq2SeqModel(enc_vocab_size, dec_vocab_size, ndim_embedding=8, num_layers=num_layers, ndim_h=5, pooling="fo", densely_connected=True, time_major=time_major)
+		dirname = tempfile.mkdtemp()
+		save_model(dirname, model)
+		runtime = inference.load_model(dirname)
+
+		with chainer.using_config("train", False), chainer.no_backprop_mode():
+			ht, H = model.encode(enc_data, skip_mask)
+			ht_runtime, H_runtime = runtime.encode(enc_data, skip_mask)
+			assert np.all(H.data == H_runtime)
+			assert np.all(model.decode(dec_data, ht, H, skip_mask).data == runtime.decode(dec_data, ht_runtime, H_runtime, skip_mask))
+
+			model.reset_decoder_state()
+			runtime.reset_decoder_state()
+			for t in range(dec_data.shape[1]):
+				y = model.decode_one_step(dec_data[:, t], ht, H, skip_mask).data
+				assert np.all(y == runtime.decode_one_step(dec_data[:, t], ht_runtime, H_runtime, skip_mask))
+		print("time_major = {} OK".format(time_major))
+
+def test_reorder_decoder_state():
+	batchsize = 4
+	enc_data = np.random.randint(1, 6, size=(batchsize, 8), dtype=np.int32)
+	dec_data = np.random.randint(1, 5, size=(batchsize, 7), dtype=np.int32)
+	skip_mask = np.ones_like(enc_data).astype(np.float32)
+	indices = np.asarray([2, 2, 0, 1], dtype=np.int32)
+
+	for time_major in [False, True]:
+		model = AttentiveSeq2SeqModel(6, 5, ndim_embedding=8, num_layers=3, ndim_h=5, pooling="fo", time_major=time_major)
+		with chainer.using_config("train", False), chainer.no_backprop_mode():
+			ht, H = model.encode(enc_data, skip_mask)
+			for t in range(3):
+				model.decode_one_step(dec_data[:, t], ht, H, skip_mask)
+			model.reorder_decoder_state(indices)
+			ht = [h.data[indices] for h in ht]
+			H = H.data[:, indices] if time_major else H.data[indices]
+			y = model.decode_one_step(dec_data[indices, 3], ht, H, skip_mask[indices]).data
+
+			model.reset_decoder_state()
+			for t in range(4):
+				target = model.decode_one_step(dec_data[indices, t], ht, H, skip_mask[indices]).data
+			assert np.all(y == target)
+		print("time_major = {} OK".format(time_major))
+
+def test_beam_search_batch():
+	from translate import translate_beam_search, translate_beam_search_batch
+	num_sentences = 6
+	source_batch = np.random.randint(1, 20, size=(num_sentences, 10), dtype=np.int32)
+	source_batch[1, :4] = 0
+	source_batch[3, :2] = 0
+
+	for time_major in [False, True]:
+		model = AttentiveSeq2SeqModel(20, 8, ndim_embedding=8, num_layers=2, ndim_h=5, pooling="fo", time_major=time_major)
+		with chainer.using_config("train", False), chainer.no_backprop_mode():
+			translations_batch = translate_beam_search_batch(model, source_batch, 15, 8, beam_width=3, return_all_candidates=True)
+			for source, translations in zip(source_batch, translations_batch):
+				target = translate_beam_search(model, source, 15, 8, beam_width=3, return_all_candidates=True)
+				assert [list(t) for t in translations] == [list(t) for t in target]
+
+			# more beams than (beam, token) pairs in the first two steps
+			small = AttentiveSeq2SeqModel(20, 4, ndim_embedding=8, num_layers=2, ndim_h=5, pooling="fo", time_major=time_major)
+			translations_batch = translate_beam_search_batch(small, source_batch, 15, 4, beam_width=20, return_all_candidates=True)
+			for translations in translations_batch:
+				assert 0 < len(translations) <= 20
+				assert len(set(tuple(t) for t in translations)) == len(translations)	# a padded beam never becomes a candidate
+		print("time_major = {} OK".format(time_major))
+
+def test_translate_greedy():
+	from translate import translate_greedy
+	from common import ID_PAD
+	source_batch = np.random.randint(1, 20, size=(6, 10), dtype=np.int32)
+	source_batch[2, :5] = 0
+
+	for time_major in [False, True]:
+		model = AttentiveSeq2SeqModel(20, 8, ndim_embedding=8, num_layers=2, ndim_h=5, pooling="fo", time_major=time_major)
+		with chainer.using_config("train", False), chainer.no_backprop_mode():
+			x = translate_greedy(model, source_batch, 15, 8)
+			for source, translation in zip(source_batch, x):
+				target = translate_greedy(model, source[None, :], 15, 8)[0]
+				assert np.all(translation[:target.size] == target)
+				assert np.all(translation[target.size:] == ID_PAD)
+		print("time_major = {} OK".format(time_major))
+
+def test_encoder_memory():
+	batchsize = 4
+	enc_data = np.random.randint(1, 6, size=(batchsize, 8), dtype=np.int32)
+	dec_data = np.random.randint(1, 5, size=(batchsize, 4), dtype=np.int32)
+	skip_mask = np.ones_like(enc_data).astype(np.float32)
+	skip_mask[1, :3] = 0
+	indices = np.asarray([3, 1, 1, 0], dtype=np.int32)
+
+	for time_major in [False, True]:
+		model = AttentiveSeq2SeqModel(6, 5, ndim_embedding=8, num_layers=3, ndim_h=5, pooling="fo", time_major=time_major)
+		with chainer.using_config("train", False), chainer.no_backprop_mode():
+			ht, H = model.encode(enc_data, skip_mask)
+			model.reset_state()
+			memory = model.encode(enc_data, skip_mask, return_memory=True).take(indices)
+			ht = [h.data[indices] for h in ht]
+			H = H.data[:, indices] if time_major else H.data[indices]
+			for t in range(4):
+				y = model.decode_one_step(dec_data[:, t], memory).data
+			model.reset_decoder_state()
+			for t in range(4):
+				target = model.decode_one_step(dec_data[:, t], ht, H, skip_mask[indices]).data
+			assert np.all(y == target)
+		print("time_major = {} OK".format(time_major))
+
 if __name__ == "__main__":
 	test_seq2seq()
 	test_attentive_seq2seq()
+	test_inference()
+	test_reorder_decoder_state()
+	test_beam_search_batch()
+	test_translate_greedy()
+	test_encoder_memory()
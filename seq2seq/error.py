@@ -8,10 +8,11 @@ import chainer
 from chainer import cuda, functions
 from chainer.utils import type_check
 from chainer.functions.activation import log_softmax
-from model import load_model, load_vocab
-from common import ID_UNK, ID_PAD, ID_GO, ID_EOS, bucket_sizes, stdout, printb
-from dataset import read_data, make_buckets, sample_batch_from_bucket
-from translate import translate_beam_search, translate_greedy
+from model import load_model, load_vocab, load_bucket_sizes
+from qrnn import fold_weightnorm
+from common import ID_UNK, ID_PAD, ID_GO, ID_EOS, bucket_sizes, stdout, printb, print_buckets
+from dataset import read_data, make_buckets, get_bucket_sizes, sample_batch_from_bucket
+from translate import translate_beam_search_batch, translate_greedy
 
 def _broadcast_to(array, shape):
 	if hasattr(numpy, "broadcast_to"):
@@ -241,11 +242,14 @@ def compute_error_rate_target_prediction(r, h):
 				d[i][j] = min(substitute, insert, delete)
 	return float(d[len(r)][len(h)]) / len(r)
 
-def compute_error_rate_source_batch(model, source_batch, target_batch, target_vocab_size):
+def compute_error_rate_source_batch(model, source_batch, target_batch, target_vocab_size, beam_width=1, normalization_alpha=0):
 	xp = model.xp
 	sum_wer = 0
 	batchsize = source_batch.shape[0]
-	x = translate_greedy(model, source_batch, target_batch.shape[1] * 2, target_vocab_size)
+	if beam_width == 1:
+		x = translate_greedy(model, source_batch, target_batch.shape[1] * 2, target_vocab_size)
+	else:
+		x = translate_beam_search_batch(model, source_batch, target_batch.shape[1] * 2, target_vocab_size, beam_width, normalization_alpha)
 
 	for n in range(batchsize):
 		target_tokens = []
@@ -271,64 +275,35 @@ def compute_error_rate_source_batch(model, source_batch, target_batch, target_vo
 
 	return sum_wer / batchsize
 
-def compute_error_rate_source_sequence(model, source, target, target_vocab_size, beam_width=8, normalization_alpha=0):
-	xp = model.xp
-	x = translate_beam_search(model, source, target.size * 2, target_vocab_size, beam_width, normalization_alpha)
-
-	target_tokens = []
-	for token in target:
-		token = int(token)	# to cpu
-		if token == ID_GO:
-			continue
-		target_tokens.append(token)
-		if token == ID_EOS:
-			break
-		assert len(target_tokens) > 0
-
-	predict_tokens = []
-	for token in x:
-		token = int(token)	# to cpu
-		predict_tokens.append(token)
-		if token == ID_EOS:
-			break
-		assert len(predict_tokens) > 0
-
-	return compute_error_rate_target_prediction(target_tokens, predict_tokens)
-
 def compute_error_rate_buckets(model, source_buckets, target_buckets, target_vocab_size, beam_width=8, normalization_alpha=0):
 	result = []
 	for bucket_index, (source_bucket, target_bucket) in enumerate(zip(source_buckets, target_buckets)):
 		sum_wer = 0
+		batchsize = 24
+
+		if len(source_bucket) > batchsize:
+			num_sections = len(source_bucket) // batchsize - 1
+			if len(source_bucket) % batchsize > 0:
+				num_sections += 1
+			indices = [(i + 1) * batchsize for i in range(num_sections)]
+			source_sections = np.split(source_bucket, indices, axis=0)
+			target_sections = np.split(target_bucket, indices, axis=0)
+		else:
+			source_sections = [source_bucket]
+			target_sections = [target_bucket]
 
-		if beam_width == 1:	# greedy
-			batchsize = 24
-
-			if len(source_bucket) > batchsize:
-				num_sections = len(source_bucket) // batchsize - 1
-				if len(source_bucket) % batchsize > 0:
-					num_sections += 1
-				indices = [(i + 1) * batchsize for i in range(num_sections)]
-				source_sections = np.split(source_bucket, indices, axis=0)
-				target_sections = np.split(target_bucket, indices, axis=0)
-			else:
-				source_sections = [source_bucket]
-				target_sections = [target_bucket]
-
-			for batch_index, (source_batch, target_batch) in enumerate(zip(source_sections, target_sections)):
-				sys.stdout.write("\rcomputing WER ... bucket {}/{} (batch {}/{})".format(bucket_index + 1, len(source_buckets), batch_index + 1, len(source_sections)))
-				sys.stdout.flush()
-				mean_wer = compute_error_rate_source_batch(model, source_batch, target_batch, target_vocab_size)
+		for batch_index, (source_batch, target_batch) in enumerate(zip(source_sections, target_sections)):
+			sys.stdout.write("\rcomputing WER ... bucket {}/{} (batch {}/{})".format(bucket_index + 1, len(source_buckets), batch_index + 1, len(source_sections)))
+			sys.stdout.flush()
+			mean_wer = compute_error_rate_source_batch(model, source_batch, target_batch, target_vocab_size, beam_width, normalization_alpha)
+			if beam_width == 1:	# greedy
 				sum_wer += mean_wer
-			result.append(sum_wer / len(source_sections) * 100)
+			else:	# beam search
+				sum_wer += mean_wer * len(source_batch)
 
-		else:	# beam search
-			for index in range(len(source_bucket)):
-				sys.stdout.write("\rcomputing WER ... bucket {}/{} (sequence {}/{})".format(bucket_index + 1, len(source_buckets), index + 1, len(source_bucket)))
-				sys.stdout.flush()
-				source = source_bucket[index]
-				target = target_bucket[index]
-				wer = compute_error_rate_source_sequence(model, source, target, target_vocab_size, beam_width, normalization_alpha)
-				sum_wer += wer
+		if beam_width == 1:
+			result.append(sum_wer / len(source_sections) * 100)
+		else:
 			result.append(sum_wer / len(source_bucket) * 100)
 		
 		sys.stdout.write("\r" + stdout.CLEAR)
@@ -341,24 +316,7 @@ def compute_random_error_rate_buckets(model, source_buckets, target_buckets, tar
 	result = []
 	for bucket_index, (source_bucket, target_bucket) in enumerate(zip(source_buckets, target_buckets)):
 		source_batch, target_batch = sample_batch_from_bucket(source_bucket, target_bucket, sample_size)
-		
-		if beam_width == 1:	# greedy
-			mean_wer = compute_error_rate_source_batch(model, source_batch, target_batch, target_vocab_size)
-
-		else:	# beam search
-			sum_wer = 0
-			for index in range(sample_size):
-				sys.stdout.write("\rcomputing WER ... bucket {}/{} (sequence {}/{})".format(bucket_index + 1, len(source_buckets), index + 1, sample_size))
-				sys.stdout.flush()
-				source = source_batch[index]
-				target = target_batch[index]
-				wer = compute_error_rate_source_sequence(model, source, target, target_vocab_size, beam_width, normalization_alpha)
-				sum_wer += wer
-			mean_wer = sum_wer / len(source_batch)
-
-			sys.stdout.write("\r" + stdout.CLEAR)
-			sys.stdout.flush()
-
+		mean_wer = compute_error_rate_source_batch(model, source_batch, target_batch, target_vocab_size, beam_width, normalization_alpha)
 		result.append(mean_wer * 100)
 
 	return result
@@ -368,7 +326,7 @@ def main(args):
 	vocab_source, vocab_target = vocab
 	vocab_inv_source, vocab_inv_target = vocab_inv
 
-	source_dataset, target_dataset = read_data(vocab_source, vocab_target, args.source_train, args.target_train, args.source_dev, args.target_dev, args.source_test, args.target_test, reverse_source=True)
+	source_dataset, target_dataset = read_data(vocab_source, vocab_target, args.source_train, args.target_train, args.source_dev, args.target_dev, args.source_test, args.target_test, reverse_source=True, cache_dir=args.cache_dir, num_workers=args.tokenize_workers)
 
 	source_dataset_train, source_dataset_dev, source_dataset_test = source_dataset
 	target_dataset_train, target_dataset_dev, target_dataset_test = target_dataset
@@ -384,40 +342,43 @@ def main(args):
 	print("vocab	{}	(source)".format(len(vocab_source)))
 	print("vocab	{}	(target)".format(len(vocab_target)))
 
-	# split into buckets
+	# split into buckets, the sizes saved by train.py take precedence over --num-buckets
+	sizes = load_bucket_sizes(args.model_dir)
+	if sizes is None and args.num_buckets > 0:
+		sizes = get_bucket_sizes(source_dataset, target_dataset, args.num_buckets)
+	if sizes is not None:
+		print("bucket sizes	{}".format(sizes))
 	source_buckets_train = None
 	if len(source_dataset_train) > 0:
-		printb("buckets 	#data	(train)")
-		source_buckets_train, target_buckets_train = make_buckets(source_dataset_train, target_dataset_train)
+		printb("buckets 	#data	padding	(train)")
+		source_buckets_train, target_buckets_train = make_buckets(source_dataset_train, target_dataset_train, sizes=sizes)
 		if args.buckets_slice is not None:
 			source_buckets_train = source_buckets_train[:args.buckets_slice + 1]
 			target_buckets_train = target_buckets_train[:args.buckets_slice + 1]
-		for size, data in zip(bucket_sizes, source_buckets_train):
-			print("{} 	{}".format(size, len(data)))
+		print_buckets(source_buckets_train, target_buckets_train)
 
 	source_buckets_dev = None
 	if len(source_dataset_dev) > 0:
-		printb("buckets 	#data	(dev)")
-		source_buckets_dev, target_buckets_dev = make_buckets(source_dataset_dev, target_dataset_dev)
+		printb("buckets 	#data	padding	(dev)")
+		source_buckets_dev, target_buckets_dev = make_buckets(source_dataset_dev, target_dataset_dev, sizes=sizes)
 		if args.buckets_slice is not None:
 			source_buckets_dev = source_buckets_dev[:args.buckets_slice + 1]
 			target_buckets_dev = target_buckets_dev[:args.buckets_slice + 1]
-		for size, data in zip(bucket_sizes, source_buckets_dev):
-			print("{} 	{}".format(size, len(data)))
+		print_buckets(source_buckets_dev, target_buckets_dev)
 
 	source_buckets_test = None
 	if len(source_dataset_test) > 0:
-		printb("buckets		#data	(test)")
-		source_buckets_test, target_buckets_test = make_buckets(source_dataset_test, target_dataset_test)
+		printb("buckets		#data	padding	(test)")
+		source_buckets_test, target_buckets_test = make_buckets(source_dataset_test, target_dataset_test, sizes=sizes)
 		if args.buckets_slice is not None:
 			source_buckets_test = source_buckets_test[:args.buckets_slice + 1]
 			target_buckets_test = target_buckets_test[:args.buckets_slice + 1]
-		for size, data in zip(bucket_sizes, source_buckets_test):
-			print("{} 	{}".format(size, len(data)))
+		print_buckets(source_buckets_test, target_buckets_test)
 
 
 	model = load_model(args.model_dir)
 	assert model is not None
+	fold_weightnorm(model)
 	if args.gpu_device >= 0:
 		cuda.get_device(args.gpu_device).use()
 		model.to_gpu()
@@ -449,6 +410,9 @@ if __name__ == "__main__":
 	parser.add_argument("--target-train", type=str, default=None)
 	parser.add_argument("--target-dev", type=str, default=None)
 	parser.add_argument("--target-test", type=str, default=None)
+	parser.add_argument("--cache-dir", type=str, default=None)
+	parser.add_argument("--tokenize-workers", type=int, default=0)
+	parser.add_argument("--num-buckets", type=int, default=0)	# > 0: bucket sizes that minimize padding instead of bucket_sizes
 	parser.add_argument("--gpu-device", "-g", type=int, default=0) 
 	parser.add_argument("--buckets-slice", type=int, default=None)
 	parser.add_argument("--model-dir", "-m", type=str, default="model")
@@ -61,6 +61,7 @@ def save_model(dirname, model):
 		"weightnorm": model.weightnorm,
 		"wgain": model.wgain,
 		"attention": isinstance(model, AttentiveSeq2SeqModel),
+		"time_major": model.time_major,
 	}
 	with open(param_filename, "w") as f:
 		json.dump(params, f, indent=4, sort_keys=True, separators=(',', ': '))
@@ -87,17 +88,46 @@ def load_model(dirname):
 	else:
 		return None
 
+# the (source, target) bucket sizes of the training, so that error.py and translate.py split the data into the same buckets
+def save_bucket_sizes(dirname, sizes):
+	filename = dirname + "/buckets.json"
+	with open(filename, "w") as f:
+		json.dump(sizes, f)
+
+def load_bucket_sizes(dirname):
+	filename = dirname + "/buckets.json"
+	if os.path.isfile(filename):
+		print("loading {} ...".format(filename))
+		with open(filename, "r") as f:
+			return [(int(source), int(target)) for source, target in json.load(f)]
+	return None
+
+# the position of the training iterator, see corpus.BucketIterator
+def save_iterator(dirname, iterator):
+	filename = dirname + "/iterator.npz"
+	tmp_filename = filename + ".tmp"
+	serializers.save_npz(tmp_filename, iterator, compression=False)
+	os.rename(tmp_filename, filename)
+
+def load_iterator(dirname, iterator):
+	filename = dirname + "/iterator.npz"
+	if os.path.isfile(filename):
+		print("loading {} ...".format(filename))
+		serializers.load_npz(filename, iterator)
+		return True
+	return False
+
 def seq2seq(*args, **kwargs):
 	if kwargs.pop("attention", None):
 		return AttentiveSeq2SeqModel(*args, **kwargs)
 	return Seq2SeqModel(*args, **kwargs)
 
 class Seq2SeqModel(Chain):
-	def __init__(self, vocab_size_enc, vocab_size_dec, ndim_embedding, ndim_h, num_layers, pooling="fo", dropout=False, zoneout=False, weightnorm=False, wgain=1, densely_connected=False):
+	def __init__(self, vocab_size_enc, vocab_size_dec, ndim_embedding, ndim_h, num_layers, pooling="fo", dropout=False, zoneout=False, weightnorm=False, wgain=1, densely_connected=False, time_major=False):
 		super(Seq2SeqModel, self).__init__(
-			encoder_embed=L.EmbedID(vocab_size_enc, ndim_embedding, ignore_label=0),
-			decoder_embed=L.EmbedID(vocab_size_dec, ndim_embedding, ignore_label=0),
-			fc=L.Convolution1D(ndim_h * num_layers if densely_connected else ndim_h, vocab_size_dec, ksize=1, stride=1, pad=0, weightnorm=weightnorm, initialW=initializers.Normal(math.sqrt(wgain / ndim_h)))
+			encoder_embed=L.SparseEmbedID(vocab_size_enc, ndim_embedding, ignore_label=0),
+			decoder_embed=L.SparseEmbedID(vocab_size_dec, ndim_embedding, ignore_label=0),
+			fc=L.Convolution1D(ndim_h * num_layers if densely_connected else ndim_h, vocab_size_dec, ksize=1, weightnorm=weightnorm, initialW=initializers.Normal(math.sqrt(wgain / ndim_h)), time_major=time_major)
 		)
 		assert num_layers > 0
 		self.vocab_size_enc = vocab_size_enc
@@ -115,15 +145,17 @@ class Seq2SeqModel(Chain):
 		self.weightnorm = weightnorm
 		self.densely_connected = densely_connected
 		self.wgain = wgain
+		self.time_major = time_major	# activations are (seq_length, batchsize, channels) instead of (batchsize, channels, seq_length)
+		self.checkpoint_interval = 0	# recompute the layers in backward, keeping the input of every k-th layer
 
 		with self.init_scope():
-			setattr(self, "enc0", L.QRNNEncoder(ndim_embedding, ndim_h, kernel_size=self.encoder_kernel_size_first, pooling=pooling, zoneout=zoneout, wgain=wgain, weightnorm=weightnorm))
+			setattr(self, "enc0", L.QRNNEncoder(ndim_embedding, ndim_h, kernel_size=self.encoder_kernel_size_first, pooling=pooling, zoneout=zoneout, wgain=wgain, weightnorm=weightnorm, time_major=time_major))
 			for i in range(1, num_layers):
-				setattr(self, "enc{}".format(i), L.QRNNEncoder(ndim_h * i if densely_connected else ndim_h, ndim_h, kernel_size=self.encoder_kernel_size_other, pooling=pooling, zoneout=zoneout, wgain=wgain, weightnorm=weightnorm))
+				setattr(self, "enc{}".format(i), L.QRNNEncoder(ndim_h * i if densely_connected else ndim_h, ndim_h, kernel_size=self.encoder_kernel_size_other, pooling=pooling, zoneout=zoneout, wgain=wgain, weightnorm=weightnorm, time_major=time_major))
 
-			setattr(self, "dec0", L.QRNNDecoder(ndim_embedding, ndim_h, kernel_size=self.decoder_kernel_size, pooling=pooling, zoneout=zoneout, wgain=wgain, weightnorm=weightnorm))
+			setattr(self, "dec0", L.QRNNDecoder(ndim_embedding, ndim_h, kernel_size=self.decoder_kernel_size, pooling=pooling, zoneout=zoneout, wgain=wgain, weightnorm=weightnorm, time_major=time_major))
 			for i in range(1, num_layers):
-				setattr(self, "dec{}".format(i), L.QRNNDecoder(ndim_h * i if densely_connected else ndim_h, ndim_h, kernel_size=self.decoder_kernel_size, pooling=pooling, zoneout=zoneout, wgain=wgain, weightnorm=weightnorm))
+				setattr(self, "dec{}".format(i), L.QRNNDecoder(ndim_h * i if densely_connected else ndim_h, ndim_h, kernel_size=self.decoder_kernel_size, pooling=pooling, zoneout=zoneout, wgain=wgain, weightnorm=weightnorm, time_major=time_major))
 
 	def get_encoder(self, index):
 		return getattr(self, "enc{}".format(index))
@@ -144,6 +176,18 @@ class Seq2SeqModel(Chain):
 		for i in range(self.num_layers):
 			self.get_decoder(i).reset_state()
 
+	# indices: rows of the decoder batch to keep, e.g. the backpointers of beam search
+	def reorder_decoder_state(self, indices):
+		for i in range(self.num_layers):
+			self.get_decoder(i).reorder_state(indices)
+
+	# we use "dense convolution"
+	# https://arxiv.org/abs/1608.06993
+	# the outputs of all layers share one preallocated buffer instead of being concatenated
+	def _forward_layers(self, get_layer, forward_layer, in_data, layer_inputs=None, checkpoint_interval=0):
+		layers = [get_layer(i) for i in range(self.num_layers)]
+		return L.forward_layers(layers, forward_layer, in_data, layer_inputs, self.densely_connected, self.time_major, checkpoint_interval)
+
 	def _forward_encoder_layer(self, layer_index, in_data, skip_mask=None):
 		if self.using_dropout:
 			in_data = F.dropout(in_data, ratio=self.dropout)
@@ -158,20 +202,16 @@ class Seq2SeqModel(Chain):
 		out_data = decoder(in_data, encoder_last_hidden_states)
 		return out_data
 
-	def encode(self, X, skip_mask=None):
+	# with return_memory an EncoderMemory for decode_one_step is returned
+	def encode(self, X, skip_mask=None, return_memory=False):
 		batchsize = X.shape[0]
 		seq_length = X.shape[1]
-		enmbedding = self.encoder_embed(X)
-		enmbedding = F.swapaxes(enmbedding, 1, 2)
-
-		out_data = self._forward_encoder_layer(0, enmbedding, skip_mask=skip_mask)
-		in_data = [out_data]
-
-		for layer_index in range(1, self.num_layers):
-			out_data = self._forward_encoder_layer(layer_index, F.concat(in_data) if self.densely_connected else in_data[-1], skip_mask=skip_mask)
-			in_data.append(out_data)
+		if self.time_major:
+			enmbedding = self.encoder_embed(X.T)	# transpose the token ids instead of the embeddings
+		else:
+			enmbedding = F.swapaxes(self.encoder_embed(X), 1, 2)
 
-		out_data = F.concat(in_data) if self.densely_connected else in_data[-1]	# dense conv
+		out_data = self._forward_layers(self.get_encoder, lambda layer_index, in_data: self._forward_encoder_layer(layer_index, in_data, skip_mask=skip_mask), enmbedding, checkpoint_interval=self.checkpoint_interval)
 
 		if self.using_dropout:
 			out_data = F.dropout(out_data, ratio=self.dropout)
@@ -181,81 +221,72 @@ class Seq2SeqModel(Chain):
 			encoder = self.get_encoder(layer_index)
 			last_hidden_states.append(encoder.get_last_hidden_state())
 
+		if return_memory:
+			return self._get_encoder_memory(last_hidden_states, None, skip_mask)
 		return last_hidden_states
 
 	def decode(self, X, encoder_last_hidden_states, return_last=False):
 		assert len(encoder_last_hidden_states) == self.num_layers
 		batchsize = X.shape[0]
 		seq_length = X.shape[1]
-		enmbedding = self.decoder_embed(X)
-		enmbedding = F.swapaxes(enmbedding, 1, 2)
-
-
-		out_data = self._forward_decoder_layer(0, enmbedding, encoder_last_hidden_states[0])
-		in_data = [out_data]
-
-		for layer_index in range(1, self.num_layers):
-			out_data = self._forward_decoder_layer(layer_index, F.concat(in_data) if self.densely_connected else in_data[-1], encoder_last_hidden_states[layer_index])
-			in_data.append(out_data)
+		if self.time_major:
+			enmbedding = self.decoder_embed(X.T)	# transpose the token ids instead of the embeddings
+		else:
+			enmbedding = F.swapaxes(self.decoder_embed(X), 1, 2)
 
-		out_data = F.concat(in_data) if self.densely_connected else in_data[-1]	# dense conv
+		out_data = self._forward_layers(self.get_decoder, self._forward_decoder_layer, enmbedding, [(h,) for h in encoder_last_hidden_states], self.checkpoint_interval)
 
 		if return_last:
-			out_data = out_data[:, :, -1, None]
+			out_data = out_data[-1:] if self.time_major else out_data[:, :, -1, None]
 
 		if self.using_dropout:
 			out_data = F.dropout(out_data, ratio=self.dropout)
 
 		out_data = self.fc(out_data)
-		out_data = F.reshape(F.swapaxes(out_data, 1, 2), (-1, self.vocab_size_dec))
+		out_data = F.reshape(F.swapaxes(out_data, 0, 1) if self.time_major else F.swapaxes(out_data, 1, 2), (-1, self.vocab_size_dec))
 
 		return out_data
 
-	def _forward_decoder_layer_one_step(self, layer_index, in_data, encoder_last_hidden_states):
+	# the last encoder states are turned into an EncoderMemory unless they already are one
+	def _get_encoder_memory(self, encoder_last_hidden_states, encoder_last_layer_outputs=None, encoder_skip_mask=None):
+		if isinstance(encoder_last_hidden_states, L.EncoderMemory):
+			return encoder_last_hidden_states
+		assert len(encoder_last_hidden_states) == self.num_layers
+		decoders = [self.get_decoder(i) for i in range(self.num_layers)]
+		return L.EncoderMemory(decoders, encoder_last_hidden_states, encoder_last_layer_outputs, encoder_skip_mask)
+
+	def _forward_decoder_layer_one_step(self, layer_index, in_data, encoder_projection):
 		if self.using_dropout:
 			in_data = F.dropout(in_data, ratio=self.dropout)
 		decoder = self.get_decoder(layer_index)
-		out_data = decoder.forward_one_step(in_data, encoder_last_hidden_states)
+		out_data = decoder.step(in_data, encoder_projection)
 		return out_data
 
+	# X: the newest tokens (batchsize,) or (batchsize, 1)
+	# encoder_last_hidden_states: the last encoder states or an EncoderMemory
 	def decode_one_step(self, X, encoder_last_hidden_states):
-		assert len(encoder_last_hidden_states) == self.num_layers
-		batchsize = X.shape[0]
-		seq_length = X.shape[1]
-		ksize = self.decoder_kernel_size
-
-		if seq_length < ksize:
-			self.reset_state()
-			return self.decode(X, encoder_last_hidden_states, return_last=True)
-
-		xt = X[:, -ksize:]
-		enmbedding = self.decoder_embed(xt)
-		enmbedding = F.swapaxes(enmbedding, 1, 2)
-
-		out_data = self._forward_decoder_layer_one_step(0, enmbedding, encoder_last_hidden_states[0])
-		in_data = [out_data]
-
-		for layer_index in range(1, self.num_layers):
-			out_data = self._forward_decoder_layer_one_step(layer_index, F.concat(in_data) if self.densely_connected else in_data[-1], encoder_last_hidden_states[layer_index])
-			in_data.append(out_data)
+		memory = self._get_encoder_memory(encoder_last_hidden_states)
+		if X.ndim == 2:
+			assert X.shape[1] == 1
+			X = X[:, 0]
+		enmbedding = self.decoder_embed(X)
 
-		out_data = F.concat(in_data) if self.densely_connected else in_data[-1]	# dense conv
-		out_data = out_data[:, :, -1, None]
+		out_data = self._forward_layers(self.get_decoder, self._forward_decoder_layer_one_step, enmbedding, [(Vh,) for Vh in memory.projections])
 
 		if self.using_dropout:
 			out_data = F.dropout(out_data, ratio=self.dropout)
 
 		out_data = self.fc(out_data)
-		out_data = F.reshape(F.swapaxes(out_data, 1, 2), (-1, self.vocab_size_dec))
+		out_data = F.reshape(out_data, (-1, self.vocab_size_dec))
 
 		return out_data
 
 class AttentiveSeq2SeqModel(Chain):
-	def __init__(self, vocab_size_enc, vocab_size_dec, ndim_embedding, ndim_h, num_layers, pooling="fo", dropout=False, zoneout=False, weightnorm=False, wgain=1, densely_connected=False):
+	def __init__(self, vocab_size_enc, vocab_size_dec, ndim_embedding, ndim_h, num_layers, pooling="fo", dropout=False, zoneout=False, weightnorm=False, wgain=1, densely_connected=False, time_major=False):
 		super(AttentiveSeq2SeqModel, self).__init__(
-			encoder_embed=L.EmbedID(vocab_size_enc, ndim_embedding, ignore_label=0),
-			decoder_embed=L.EmbedID(vocab_size_dec, ndim_embedding, ignore_label=0),
-			fc=L.Convolution1D(ndim_h * num_layers if densely_connected else ndim_h, vocab_size_dec, ksize=1, stride=1, pad=0, weightnorm=weightnorm, initialW=initializers.Normal(math.sqrt(wgain / ndim_h)))
+			encoder_embed=L.SparseEmbedID(vocab_size_enc, ndim_embedding, ignore_label=0),
+			decoder_embed=L.SparseEmbedID(vocab_size_dec, ndim_embedding, ignore_label=0),
+			fc=L.Convolution1D(ndim_h * num_layers if densely_connected else ndim_h, vocab_size_dec, ksize=1, weightnorm=weightnorm, initialW=initializers.Normal(math.sqrt(wgain / ndim_h)), time_major=time_major)
 		)
 		assert num_layers > 0
 		self.vocab_size_enc = vocab_size_enc
@@ -273,19 +304,21 @@ class AttentiveSeq2SeqModel(Chain):
 		self.using_dropout = True if dropout > 0 else False
 		self.weightnorm = weightnorm
 		self.wgain = wgain
+		self.time_major = time_major	# activations are (seq_length, batchsize, channels) instead of (batchsize, channels, seq_length)
+		self.checkpoint_interval = 0	# recompute the layers in backward, keeping the input of every k-th layer
 
 		with self.init_scope():
-			setattr(self, "enc0", L.QRNNEncoder(ndim_embedding, ndim_h, kernel_size=self.encoder_kernel_size_first, pooling=pooling, zoneout=zoneout, weightnorm=weightnorm, wgain=wgain))
+			setattr(self, "enc0", L.QRNNEncoder(ndim_embedding, ndim_h, kernel_size=self.encoder_kernel_size_first, pooling=pooling, zoneout=zoneout, weightnorm=weightnorm, wgain=wgain, time_major=time_major))
 			for i in range(1, num_layers):
-				setattr(self, "enc{}".format(i), L.QRNNEncoder(ndim_h * i if densely_connected else ndim_h, ndim_h, kernel_size=self.encoder_kernel_size_other, pooling=pooling, zoneout=zoneout, weightnorm=weightnorm, wgain=wgain))
+				setattr(self, "enc{}".format(i), L.QRNNEncoder(ndim_h * i if densely_connected else ndim_h, ndim_h, kernel_size=self.encoder_kernel_size_other, pooling=pooling, zoneout=zoneout, weightnorm=weightnorm, wgain=wgain, time_major=time_major))
 
 			if num_layers == 1:
-				setattr(self, "dec0", L.QRNNGlobalAttentiveDecoder(ndim_embedding, ndim_h, kernel_size=self.decoder_kernel_size, zoneout=zoneout, weightnorm=weightnorm, wgain=wgain))
+				setattr(self, "dec0", L.QRNNGlobalAttentiveDecoder(ndim_embedding, ndim_h, kernel_size=self.decoder_kernel_size, zoneout=zoneout, weightnorm=weightnorm, wgain=wgain, time_major=time_major))
 			else:
-				setattr(self, "dec0", L.QRNNDecoder(ndim_embedding, ndim_h, kernel_size=self.decoder_kernel_size, pooling=pooling, zoneout=zoneout, weightnorm=weightnorm, wgain=wgain))
+				setattr(self, "dec0", L.QRNNDecoder(ndim_embedding, ndim_h, kernel_size=self.decoder_kernel_size, pooling=pooling, zoneout=zoneout, weightnorm=weightnorm, wgain=wgain, time_major=time_major))
 				for i in range(1, num_layers - 1):
-					setattr(self, "dec{}".format(i), L.QRNNDecoder(ndim_h * i if densely_connected else ndim_h, ndim_h, kernel_size=self.decoder_kernel_size, pooling=pooling, zoneout=zoneout, weightnorm=weightnorm, wgain=wgain))
-				setattr(self, "dec{}".format(num_layers - 1), L.QRNNGlobalAttentiveDecoder(ndim_h * (num_layers - 1) if densely_connected else ndim_h, ndim_h, kernel_size=self.decoder_kernel_size, zoneout=zoneout, weightnorm=weightnorm, wgain=wgain))
+					setattr(self, "dec{}".format(i), L.QRNNDecoder(ndim_h * i if densely_connected else ndim_h, ndim_h, kernel_size=self.decoder_kernel_size, pooling=pooling, zoneout=zoneout, weightnorm=weightnorm, wgain=wgain, time_major=time_major))
+				setattr(self, "dec{}".format(num_layers - 1), L.QRNNGlobalAttentiveDecoder(ndim_h * (num_layers - 1) if densely_connected else ndim_h, ndim_h, kernel_size=self.decoder_kernel_size, zoneout=zoneout, weightnorm=weightnorm, wgain=wgain, time_major=time_major))
 
 	def get_encoder(self, index):
 		return getattr(self, "enc{}".format(index))
@@ -306,6 +339,18 @@ class AttentiveSeq2SeqModel(Chain):
 		for i in range(self.num_layers):
 			self.get_decoder(i).reset_state()
 
+	# indices: rows of the decoder batch to keep, e.g. the backpointers of beam search
+	def reorder_decoder_state(self, indices):
+		for i in range(self.num_layers):
+			self.get_decoder(i).reorder_state(indices)
+
+	# we use "dense convolution"
+	# https://arxiv.org/abs/1608.06993
+	# the outputs of all layers share one preallocated buffer instead of being concatenated
+	def _forward_layers(self, get_layer, forward_layer, in_data, layer_inputs=None, checkpoint_interval=0):
+		layers = [get_layer(i) for i in range(self.num_layers)]
+		return L.forward_layers(layers, forward_layer, in_data, layer_inputs, self.densely_connected, self.time_major, checkpoint_interval)
+
 	def _forward_encoder_layer(self, layer_index, in_data, skip_mask=None):
 		if self.using_dropout:
 			in_data = F.dropout(in_data, ratio=self.dropout)
@@ -313,20 +358,16 @@ class AttentiveSeq2SeqModel(Chain):
 		out_data = encoder(in_data, skip_mask=skip_mask)
 		return out_data
 
-	def encode(self, X, skip_mask=None):
+	# with return_memory an EncoderMemory for decode_one_step is returned
+	def encode(self, X, skip_mask=None, return_memory=False):
 		batchsize = X.shape[0]
 		seq_length = X.shape[1]
-		enmbedding = self.encoder_embed(X)
-		enmbedding = F.swapaxes(enmbedding, 1, 2)
-
-		out_data = self._forward_encoder_layer(0, enmbedding, skip_mask=skip_mask)
-		in_data = [out_data]
-
-		for layer_index in range(1, self.num_layers):
-			out_data = self._forward_encoder_layer(layer_index, F.concat(in_data) if self.densely_connected else in_data[-1], skip_mask=skip_mask)
-			in_data.append(out_data)
+		if self.time_major:
+			enmbedding = self.encoder_embed(X.T)	# transpose the token ids instead of the embeddings
+		else:
+			enmbedding = F.swapaxes(self.encoder_embed(X), 1, 2)
 
-		out_data = F.concat(in_data) if self.densely_connected else in_data[-1]	# dense conv
+		out_data = self._forward_layers(self.get_encoder, lambda layer_index, in_data: self._forward_encoder_layer(layer_index, in_data, skip_mask=skip_mask), enmbedding, checkpoint_interval=self.checkpoint_interval)
 
 		if self.using_dropout:
 			out_data = F.dropout(out_data, ratio=self.dropout)
@@ -338,6 +379,8 @@ class AttentiveSeq2SeqModel(Chain):
 			last_hidden_states.append(encoder.get_last_hidden_state())
 			last_layer_outputs = encoder.get_all_hidden_states()
 
+		if return_memory:
+			return self._get_encoder_memory(last_hidden_states, last_layer_outputs, skip_mask)
 		return last_hidden_states, last_layer_outputs
 
 	def _forward_decoder_layer(self, layer_index, in_data, encoder_last_hidden_states, encoder_last_layer_outputs, encoder_skip_mask=None):
@@ -357,71 +400,61 @@ class AttentiveSeq2SeqModel(Chain):
 		assert len(encoder_last_hidden_states) == self.num_layers
 		batchsize = X.shape[0]
 		seq_length = X.shape[1]
-		enmbedding = self.decoder_embed(X)
-		enmbedding = F.swapaxes(enmbedding, 1, 2)
-
-		out_data = self._forward_decoder_layer(0, enmbedding, encoder_last_hidden_states[0], encoder_last_layer_outputs, encoder_skip_mask)
-		in_data = [out_data]
-
-		for layer_index in range(1, self.num_layers):
-			out_data = self._forward_decoder_layer(layer_index, F.concat(in_data) if self.densely_connected else in_data[-1], encoder_last_hidden_states[layer_index], encoder_last_layer_outputs, encoder_skip_mask)
-			in_data.append(out_data)
+		if self.time_major:
+			enmbedding = self.decoder_embed(X.T)	# transpose the token ids instead of the embeddings
+		else:
+			enmbedding = F.swapaxes(self.decoder_embed(X), 1, 2)
 
-		out_data = F.concat(in_data) if self.densely_connected else in_data[-1]	# dense conv
+		out_data = self._forward_layers(self.get_decoder, lambda layer_index, in_data, ht_enc, H_enc: self._forward_decoder_layer(layer_index, in_data, ht_enc, H_enc, encoder_skip_mask), enmbedding, [(h, encoder_last_layer_outputs) for h in encoder_last_hidden_states], self.checkpoint_interval)
 
 		if return_last:
-			out_data = out_data[:, :, -1, None]
+			out_data = out_data[-1:] if self.time_major else out_data[:, :, -1, None]
 
 		if self.using_dropout:
 			out_data = F.dropout(out_data, ratio=self.dropout)
 
 		out_data = self.fc(out_data)
-		out_data = F.reshape(F.swapaxes(out_data, 1, 2), (-1, self.vocab_size_dec))
+		out_data = F.reshape(F.swapaxes(out_data, 0, 1) if self.time_major else F.swapaxes(out_data, 1, 2), (-1, self.vocab_size_dec))
 
 		return out_data
 
-	def _forward_decoder_layer_one_step(self, layer_index, in_data, encoder_last_hidden_states, encoder_last_layer_outputs, encoder_skip_mask=None):
+	# the last encoder states are turned into an EncoderMemory unless they already are one
+	def _get_encoder_memory(self, encoder_last_hidden_states, encoder_last_layer_outputs=None, encoder_skip_mask=None):
+		if isinstance(encoder_last_hidden_states, L.EncoderMemory):
+			return encoder_last_hidden_states
+		assert len(encoder_last_hidden_states) == self.num_layers
+		decoders = [self.get_decoder(i) for i in range(self.num_layers)]
+		return L.EncoderMemory(decoders, encoder_last_hidden_states, encoder_last_layer_outputs, encoder_skip_mask)
+
+	def _forward_decoder_layer_one_step(self, layer_index, in_data, encoder_projection, memory):
 		if self.using_dropout:
 			in_data = F.dropout(in_data, ratio=self.dropout)
 
 		decoder = self.get_decoder(layer_index)
 		if isinstance(decoder, L.QRNNGlobalAttentiveDecoder):
-			out_data = decoder.forward_one_step(in_data, encoder_last_hidden_states, encoder_last_layer_outputs, encoder_skip_mask)
+			out_data = decoder.step(in_data, encoder_projection, memory.attention_memory, memory.bias, memory.mask)
 		elif isinstance(decoder, L.QRNNDecoder):
-			out_data = decoder.forward_one_step(in_data, encoder_last_hidden_states)
+			out_data = decoder.step(in_data, encoder_projection)
 		else:
 			raise Exception()
 
 		return out_data
 
-	def decode_one_step(self, X, encoder_last_hidden_states, encoder_last_layer_outputs, encoder_skip_mask=None):
-		assert len(encoder_last_hidden_states) == self.num_layers
-		batchsize = X.shape[0]
-		seq_length = X.shape[1]
-		ksize = self.decoder_kernel_size
-
-		if seq_length < ksize:
-			self.reset_state()
-			return self.decode(X, encoder_last_hidden_states, encoder_last_layer_outputs, encoder_skip_mask, return_last=True)
-
-		xt = X[:, -ksize:]
-		enmbedding = self.decoder_embed(xt)
-		enmbedding = F.swapaxes(enmbedding, 1, 2)
-
-		out_data = self._forward_decoder_layer_one_step(0, enmbedding, encoder_last_hidden_states[0], encoder_last_layer_outputs, encoder_skip_mask)
-		in_data = [out_data]
-		
-		for layer_index in range(1, self.num_layers):
-			out_data = self._forward_decoder_layer_one_step(layer_index, F.concat(in_data) if self.densely_connected else in_data[-1], encoder_last_hidden_states[layer_index], encoder_last_layer_outputs, encoder_skip_mask)
-			in_data.append(out_data)
-
-		out_data = F.concat(in_data) if self.densely_connected else in_data[-1]	# dense conv
-		out_data = out_data[:, :, -1, None]
-			
+	# X: the newest tokens (batchsize,) or (batchsize, 1)
+	# encoder_last_hidden_states: the last encoder states or an EncoderMemory, which already holds the other encoder outputs
+	def decode_one_step(self, X, encoder_last_hidden_states, encoder_last_layer_outputs=None, encoder_skip_mask=None):
+		memory = self._get_encoder_memory(encoder_last_hidden_states, encoder_last_layer_outputs, encoder_skip_mask)
+		if X.ndim == 2:
+			assert X.shape[1] == 1
+			X = X[:, 0]
+		enmbedding = self.decoder_embed(X)
+
+		out_data = self._forward_layers(self.get_decoder, lambda layer_index, in_data, Vh: self._forward_decoder_layer_one_step(layer_index, in_data, Vh, memory), enmbedding, [(Vh,) for Vh in memory.projections])
+
 		if self.using_dropout:
 			out_data = F.dropout(out_data, ratio=self.dropout)
 
 		out_data = self.fc(out_data)
-		out_data = F.reshape(F.swapaxes(out_data, 1, 2), (-1, self.vocab_size_dec))
+		out_data = F.reshape(out_data, (-1, self.vocab_size_dec))
 
 		return out_data
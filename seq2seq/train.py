@@ -7,20 +7,23 @@ import chainer
 import chainer.functions as F
 from chainer import training, Variable, optimizers, cuda
 from chainer.training import extensions
-from common import ID_UNK, ID_PAD, ID_GO, ID_EOS, bucket_sizes, printb, printr
-from dataset import read_data_and_vocab, make_buckets, make_source_target_pair, sample_batch_from_bucket
-from model import seq2seq, load_model, save_model, save_vocab
+from common import ID_UNK, ID_PAD, ID_GO, ID_EOS, bucket_sizes, printb, printr, print_buckets
+from dataset import read_data_and_vocab, make_buckets, get_bucket_sizes, make_source_target_pair, sample_batch_from_bucket
+from model import seq2seq, load_model, save_model, save_vocab, load_iterator, save_iterator, save_bucket_sizes, load_bucket_sizes
 from error import compute_error_rate_buckets, compute_random_error_rate_buckets, softmax_cross_entropy
 from translate import dump_random_source_target_translation
-from optim import get_current_learning_rate, get_optimizer, decay_learning_rate
+from corpus import BucketIterator, trim_batch
+from optim import get_current_learning_rate, get_optimizer, decay_learning_rate, flush_optimizer
+import parallel
 
 # reference
 # https://www.tensorflow.org/tutorials/seq2seq
 
-def dump_dataset(source_dataset, vocab, source_bucket):
+def dump_dataset(source_dataset, vocab, source_bucket, target_bucket):
 	source_dataset_train, source_dataset_dev, source_dataset_test = source_dataset
 	vocab_source, vocab_target = vocab
 	source_buckets_train, source_buckets_dev, source_buckets_test = source_bucket
+	target_buckets_train, target_buckets_dev, target_buckets_test = target_bucket
 
 	printb("data	#")
 	print("train	{}".format(len(source_dataset_train)))
@@ -33,22 +36,22 @@ def dump_dataset(source_dataset, vocab, source_bucket):
 	print("vocab	{}	(target)".format(len(vocab_target)))
 
 
-	printb("buckets 	#data	(train)")
-	for size, data in zip(bucket_sizes, source_buckets_train):
-		print("{} 	{}".format(size, len(data)))
+	printb("buckets 	#data	padding	(train)")
+	print_buckets(source_buckets_train, target_buckets_train)
 
 	if source_buckets_dev:
-		printb("buckets 	#data	(dev)")
-		for size, data in zip(bucket_sizes, source_buckets_dev):
-			print("{} 	{}".format(size, len(data)))
+		printb("buckets 	#data	padding	(dev)")
+		print_buckets(source_buckets_dev, target_buckets_dev)
 
 	if source_buckets_test:
-		printb("buckets		#data	(test)")
-		for size, data in zip(bucket_sizes, source_buckets_test):
-			print("{} 	{}".format(size, len(data)))
+		printb("buckets		#data	padding	(test)")
+		print_buckets(source_buckets_test, target_buckets_test)
 
 def main(args):
-	source_dataset, target_dataset, vocab, vocab_inv = read_data_and_vocab(args.source_train, args.target_train, args.source_dev, args.target_dev, args.source_test, args.target_test, reverse_source=True)
+	if args.seed is not None:
+		np.random.seed(args.seed)
+
+	source_dataset, target_dataset, vocab, vocab_inv = read_data_and_vocab(args.source_train, args.target_train, args.source_dev, args.target_dev, args.source_test, args.target_test, reverse_source=True, cache_dir=args.cache_dir, num_workers=args.tokenize_workers)
 
 	save_vocab(args.model_dir, vocab, vocab_inv)
 
@@ -58,143 +61,180 @@ def main(args):
 	vocab_source, vocab_target = vocab
 	vocab_inv_source, vocab_inv_target = vocab_inv
 
-	# split into buckets
-	source_buckets_train, target_buckets_train = make_buckets(source_dataset_train, target_dataset_train)
+	# split into buckets, the sizes of a saved model are kept so that the saved iterator stays valid
+	sizes = load_bucket_sizes(args.model_dir)
+	if sizes is None and args.num_buckets > 0:
+		sizes = get_bucket_sizes(source_dataset, target_dataset, args.num_buckets)
+		save_bucket_sizes(args.model_dir, sizes)
+	if sizes is not None:
+		print("bucket sizes	{}".format(sizes))
+	source_buckets_train, target_buckets_train, skip_mask_buckets_train = make_buckets(source_dataset_train, target_dataset_train, return_skip_mask=True, sizes=sizes)
 	if args.buckets_slice is not None:
 		source_buckets_train = source_buckets_train[:args.buckets_slice + 1]
 		target_buckets_train = target_buckets_train[:args.buckets_slice + 1]
+		skip_mask_buckets_train = skip_mask_buckets_train[:args.buckets_slice + 1]
 
 	# development dataset
 	source_buckets_dev = None
+	target_buckets_dev = None
 	if len(source_dataset_dev) > 0:
-		source_buckets_dev, target_buckets_dev = make_buckets(source_dataset_dev, target_dataset_dev)
+		source_buckets_dev, target_buckets_dev = make_buckets(source_dataset_dev, target_dataset_dev, sizes=sizes)
 		if args.buckets_slice is not None:
 			source_buckets_dev = source_buckets_dev[:args.buckets_slice + 1]
 			target_buckets_dev = target_buckets_dev[:args.buckets_slice + 1]
 
 	# test dataset
 	source_buckets_test = None
+	target_buckets_test = None
 	if len(source_dataset_test) > 0:
-		source_buckets_test, target_buckets_test = make_buckets(source_dataset_test, target_dataset_test)
+		source_buckets_test, target_buckets_test = make_buckets(source_dataset_test, target_dataset_test, sizes=sizes)
 		if args.buckets_slice is not None:
 			source_buckets_test = source_buckets_test[:args.buckets_slice + 1]
 			target_buckets_test = target_buckets_test[:args.buckets_slice + 1]
 
 	# show log
-	dump_dataset(source_dataset, vocab, (source_buckets_train, source_buckets_dev, source_buckets_test))
+	dump_dataset(source_dataset, vocab, (source_buckets_train, source_buckets_dev, source_buckets_test), (target_buckets_train, target_buckets_dev, target_buckets_test))
 
-	# to maintain equilibrium
-	required_interations = []
-	for data in source_buckets_train:
-		itr = len(data) // args.batchsize + 1
-		required_interations.append(itr)
-	total_iterations = sum(required_interations)
-	buckets_distribution = np.asarray(required_interations, dtype=float) / total_iterations
+	# every pair once per epoch, batches of at most max_tokens tokens instead of batchsize pairs if max_tokens > 0
+	source_lengths_train = [mask.sum(axis=1) for mask in skip_mask_buckets_train]
+	target_lengths_train = [(bucket != ID_PAD).sum(axis=1) for bucket in target_buckets_train]
+	lengths_train = [np.stack(lengths, axis=1) for lengths in zip(source_lengths_train, target_lengths_train)]
+	iterator = BucketIterator([source_buckets_train, target_buckets_train, skip_mask_buckets_train], args.batchsize, lengths_train, args.max_tokens)
+	if load_iterator(args.model_dir, iterator):
+		print("resuming epoch {} at iteration {}".format(iterator.epoch + 1, iterator.position))
 
 	# init
 	model = load_model(args.model_dir)
 	if model is None:
-		model = seq2seq(len(vocab_source), len(vocab_target), args.ndim_embedding, args.ndim_h, args.num_layers, pooling=args.pooling, dropout=args.dropout, zoneout=args.zoneout, weightnorm=args.weightnorm, wgain=args.wgain, densely_connected=args.densely_connected, attention=args.attention)
+		model = seq2seq(len(vocab_source), len(vocab_target), args.ndim_embedding, args.ndim_h, args.num_layers, pooling=args.pooling, dropout=args.dropout, zoneout=args.zoneout, weightnorm=args.weightnorm, wgain=args.wgain, densely_connected=args.densely_connected, attention=args.attention, time_major=args.time_major)
+	model.checkpoint_interval = args.checkpoint_interval	# trade compute for activation memory
 
 	if args.gpu_device >= 0:
 		cuda.get_device(args.gpu_device).use()
 		model.to_gpu()
 
 	# setup an optimizer
-	optimizer = get_optimizer(args.optimizer, args.learning_rate, args.momentum)
+	optimizer = get_optimizer(args.optimizer, args.learning_rate, args.momentum, flat=args.flat_optimizer, sparse_embedding=args.sparse_embedding)
 	optimizer.setup(model)
 	optimizer.add_hook(chainer.optimizer.GradientClipping(args.grad_clip))
 	optimizer.add_hook(chainer.optimizer.WeightDecay(args.weight_decay))
 	final_learning_rate = 1e-5
-	total_time = 0
-
-	indices_train = []
-	for bucket_idx, bucket in enumerate(source_buckets_train):
-		indices = np.arange(len(bucket))
-		np.random.shuffle(indices)
-		indices_train.append(indices)
 
 	def mean(l):
 		return sum(l) / len(l)
 
-	# training
-	for epoch in range(1, args.epoch + 1):
-		print("Epoch", epoch)
-		start_time = time.time()
-
+	# runs in the prefetch thread
+	def prepare(batch):
+		bucket_idx, indices, (source_batch, target_batch, skip_mask) = batch
+		if args.max_tokens > 0:
+			# trimmed to the longest source (left padded) and target (right padded) of the batch
+			source_width = int(source_lengths_train[bucket_idx][indices].max())
+			target_width = int(target_lengths_train[bucket_idx][indices].max())
+			source_batch = trim_batch(source_batch, source_width, left_padding=True)
+			target_batch = trim_batch(target_batch, target_width)
+			skip_mask = trim_batch(skip_mask, source_width, left_padding=True)
+		target_batch_input, target_batch_output = make_source_target_pair(target_batch)
+		num_targets = int((target_batch_output != ID_PAD).sum())
+
+		# to gpu
+		if args.gpu_device >= 0:
+			skip_mask = cuda.to_gpu(skip_mask, device=args.gpu_device)
+			source_batch = cuda.to_gpu(source_batch, device=args.gpu_device)
+			target_batch_input = cuda.to_gpu(target_batch_input, device=args.gpu_device)
+			target_batch_output = cuda.to_gpu(target_batch_output, device=args.gpu_device)
+		return source_batch, target_batch_input, target_batch_output, skip_mask, num_targets
+
+	def compute_loss(source_batch, target_batch_input, target_batch_output, skip_mask):
+		model.reset_state()
+		if args.attention:
+			last_hidden_states, last_layer_outputs = model.encode(source_batch, skip_mask)
+			y_batch = model.decode(target_batch_input, last_hidden_states, last_layer_outputs, skip_mask)
+		else:
+			last_hidden_states = model.encode(source_batch, skip_mask)
+			y_batch = model.decode(target_batch_input, last_hidden_states)
+		return softmax_cross_entropy(y_batch, target_batch_output, ignore_label=ID_PAD)
+
+	# weightnorm initializes some parameters on the first forward pass, every process must start from the same ones
+	if args.num_processes > 1 and parallel.has_uninitialized_params(model) and iterator.peek() is not None:
 		with chainer.using_config("train", True):
+			compute_loss(*prepare(iterator.peek())[:4])
+
+	# runs in every process, see parallel.run. rank 0 prints, evaluates and saves
+	def train(communicator):
+		rank = 0 if communicator is None else communicator.rank
+		shard = None if communicator is None else (communicator.rank, communicator.size)
+		if communicator is not None:
+			np.random.seed(np.random.randint(2 ** 31) + rank)	# different dropout masks on every rank
+			parallel.broadcast_params(communicator, model)
+		total_time = 0
+
+		for epoch in range(iterator.epoch + 1, args.epoch + 1):
+			if rank == 0:
+				print("Epoch", epoch)
+			start_time = time.time()
+			total_iterations = len(iterator)
+
+			with chainer.using_config("train", True):
+
+				for batch in iterator.iterate(prepare, args.prefetch, shard):
+					# compute loss
+					loss, num_targets = None, 0
+					if batch is not None:
+						source_batch, target_batch_input, target_batch_output, skip_mask, num_targets = batch
+						loss = compute_loss(source_batch, target_batch_input, target_batch_output, skip_mask)
+
+					# update parameters
+					parallel.update(optimizer, loss, num_targets, communicator)
+
+					if rank != 0:
+						continue
+
+					# show log
+					printr("iteration {}/{}".format(iterator.position, total_iterations))
+
+					if args.save_interval > 0 and iterator.position % args.save_interval == 0 and iterator.position < total_iterations:
+						flush_optimizer(optimizer)
+						save_model(args.model_dir, model)
+						save_iterator(args.model_dir, iterator)
+
+			# decay learning rate
+			learning_rate = get_current_learning_rate(optimizer)
+			decay_learning_rate(optimizer, args.lr_decay_factor, final_learning_rate)
+
+			if rank != 0:
+				continue
+
+			# serialize
+			flush_optimizer(optimizer)
+			save_model(args.model_dir, model)
+			save_iterator(args.model_dir, iterator)
+
+			# clear console
+			printr("")
+			if iterator.prefetcher is not None:
+				print("waited for data {}/{} times, {:.2f} sec".format(iterator.prefetcher.num_waits, iterator.prefetcher.num_items, iterator.prefetcher.wait_time))
+
+			# show log
+			with chainer.using_config("train", False):
+				if epoch % args.interval == 0:
+					printb("translate (train)")
+					dump_random_source_target_translation(model, source_buckets_train, target_buckets_train, vocab_inv_source, vocab_inv_target, num_translate=5, beam_width=1)
+
+					if source_buckets_dev is not None:
+						printb("translate (dev)")
+						dump_random_source_target_translation(model, source_buckets_dev, target_buckets_dev, vocab_inv_source, vocab_inv_target, num_translate=5, beam_width=1)
+
+					if source_buckets_dev is not None:
+						printb("WER (dev)")
+						wer_dev = compute_error_rate_buckets(model, source_buckets_dev, target_buckets_dev, len(vocab_inv_target), beam_width=1)
+						print(mean(wer_dev), wer_dev)
+
+			elapsed_time = (time.time() - start_time) / 60.
+			total_time += elapsed_time
+			print("done in {} min, lr = {:.4f}, total {} min".format(int(elapsed_time), learning_rate, int(total_time)))
 
-			for itr in range(total_iterations):
-				bucket_idx = int(np.random.choice(np.arange(len(source_buckets_train)), size=1, p=buckets_distribution))
-				source_bucket = source_buckets_train[bucket_idx]
-				target_bucket = target_buckets_train[bucket_idx]
-
-				# sample minibatch
-				source_batch = source_bucket[:args.batchsize]
-				target_batch = target_bucket[:args.batchsize]
-				skip_mask = source_batch != ID_PAD
-				target_batch_input, target_batch_output = make_source_target_pair(target_batch)
-
-				# to gpu
-				if args.gpu_device >= 0:
-					skip_mask = cuda.to_gpu(skip_mask)
-					source_batch = cuda.to_gpu(source_batch)
-					target_batch_input = cuda.to_gpu(target_batch_input)
-					target_batch_output = cuda.to_gpu(target_batch_output)
-
-				# compute loss
-				model.reset_state()
-				if args.attention:
-					last_hidden_states, last_layer_outputs = model.encode(source_batch, skip_mask)
-					y_batch = model.decode(target_batch_input, last_hidden_states, last_layer_outputs, skip_mask)
-				else:
-					last_hidden_states = model.encode(source_batch, skip_mask)
-					y_batch = model.decode(target_batch_input, last_hidden_states)
-				loss = softmax_cross_entropy(y_batch, target_batch_output, ignore_label=ID_PAD)
-
-				# update parameters
-				optimizer.update(lossfun=lambda: loss)
-
-				# show log
-				printr("iteration {}/{}".format(itr + 1, total_iterations))
-
-				source_buckets_train[bucket_idx] = np.roll(source_bucket, -args.batchsize, axis=0)	# shift
-				target_buckets_train[bucket_idx] = np.roll(target_bucket, -args.batchsize, axis=0)	# shift
-
-			# shuffle
-			for bucket_idx in range(len(source_buckets_train)):
-				indices = indices_train[bucket_idx]
-				np.random.shuffle(indices)
-				source_buckets_train[bucket_idx] = source_buckets_train[bucket_idx][indices]
-				target_buckets_train[bucket_idx] = target_buckets_train[bucket_idx][indices]
-
-		# serialize
-		save_model(args.model_dir, model)
-
-		# clear console
-		printr("")
-
-		# show log
-		with chainer.using_config("train", False):
-			if epoch % args.interval == 0:
-				printb("translate (train)")
-				dump_random_source_target_translation(model, source_buckets_train, target_buckets_train, vocab_inv_source, vocab_inv_target, num_translate=5, beam_width=1)
-
-				if source_buckets_dev is not None:
-					printb("translate (dev)")
-					dump_random_source_target_translation(model, source_buckets_dev, target_buckets_dev, vocab_inv_source, vocab_inv_target, num_translate=5, beam_width=1)
-
-				if source_buckets_dev is not None:
-					printb("WER (dev)")
-					wer_dev = compute_error_rate_buckets(model, source_buckets_dev, target_buckets_dev, len(vocab_inv_target), beam_width=1)
-					print(mean(wer_dev), wer_dev)
-
-		elapsed_time = (time.time() - start_time) / 60.
-		total_time += elapsed_time
-		print("done in {} min, lr = {:.4f}, total {} min".format(int(elapsed_time), get_current_learning_rate(optimizer), int(total_time)))
-
-		# decay learning rate
-		decay_learning_rate(optimizer, args.lr_decay_factor, final_learning_rate)
+	# training
+	parallel.run(args.num_processes, train, parallel.get_buffer_size(model))
 
 if __name__ == "__main__":
 	parser = argparse.ArgumentParser()
@@ -204,10 +244,18 @@ if __name__ == "__main__":
 	parser.add_argument("--target-train", type=str, default=None)
 	parser.add_argument("--target-dev", type=str, default=None)
 	parser.add_argument("--target-test", type=str, default=None)
+	parser.add_argument("--cache-dir", type=str, default=None)
+	parser.add_argument("--tokenize-workers", type=int, default=0)
+	parser.add_argument("--num-buckets", type=int, default=0)	# > 0: bucket sizes that minimize padding instead of bucket_sizes
 
 	parser.add_argument("--batchsize", "-b", type=int, default=64)
+	parser.add_argument("--max-tokens", type=int, default=0)	# > 0: batches of at most max-tokens tokens, sorted by length and trimmed, instead of batchsize pairs
 	parser.add_argument("--epoch", "-e", type=int, default=1000)
 	parser.add_argument("--interval", type=int, default=10)
+	parser.add_argument("--prefetch", type=int, default=2)	# number of batches prepared in a background thread, 0 prepares them in the training loop
+	parser.add_argument("--seed", type=int, default=None)
+	parser.add_argument("--num-processes", type=int, default=1)	# > 1: data parallel training, every process takes a shard of every batch
+	parser.add_argument("--save-interval", type=int, default=0)	# > 0: the model and the position in the epoch are saved every save-interval iterations
 	parser.add_argument("--gpu-device", "-g", type=int, default=0) 
 	parser.add_argument("--grad-clip", "-gc", type=float, default=0.1) 
 	parser.add_argument("--weight-decay", "-wd", type=float, default=2e-4) 
@@ -215,6 +263,8 @@ if __name__ == "__main__":
 	parser.add_argument("--lr-decay-factor", "-decay", type=float, default=0.98)
 	parser.add_argument("--momentum", "-mo", type=float, default=0.99)
 	parser.add_argument("--optimizer", "-opt", type=str, default="nesterov")
+	parser.add_argument("--flat-optimizer", default=False, action="store_true")	# parameters in one buffer, updated in one pass, see optim.FlatOptimizer
+	parser.add_argument("--sparse-embedding", default=False, action="store_true")	# only the embedding rows used by a batch are updated (sgd, adam), implies --flat-optimizer
 
 	parser.add_argument("--ndim-h", "-nh", type=int, default=320)
 	parser.add_argument("--ndim-embedding", "-ne", type=int, default=320)
@@ -225,9 +275,15 @@ if __name__ == "__main__":
 	parser.add_argument("--dropout", "-dropout", type=float, default=0)
 	parser.add_argument("--densely-connected", "-dense", default=False, action="store_true")
 	parser.add_argument("--weightnorm", "-weightnorm", default=False, action="store_true")
+	parser.add_argument("--time-major", "-time-major", default=False, action="store_true")
+	parser.add_argument("--checkpoint-interval", "-checkpoint", type=int, default=0)
 	parser.add_argument("--attention", "-attention", default=False, action="store_true")
 	
 	parser.add_argument("--buckets-slice", type=int, default=None)
 	parser.add_argument("--model-dir", "-m", type=str, default="model")
 	args = parser.parse_args()
+	if args.num_processes > 1 and args.gpu_device >= 0:
+		parser.error("--num-processes > 1 runs on the CPU, pass --gpu-device -1")
+	if args.num_processes > 1 and args.sparse_embedding:
+		parser.error("--sparse-embedding cannot be used with --num-processes > 1, the sparse gradients of the embeddings are not reduced over the processes")
 	main(args)
\ No newline at end of file
@@ -8,37 +8,20 @@ import chainer.functions as F
 from chainer import training, Variable, optimizers, cuda
 from chainer.training import extensions
 sys.path.append(os.pardir)
-from model import load_model, load_vocab, Seq2SeqModel, AttentiveSeq2SeqModel
-from common import ID_UNK, ID_PAD, ID_GO, ID_EOS, bucket_sizes, printb
+from model import load_model, load_vocab, load_bucket_sizes, Seq2SeqModel, AttentiveSeq2SeqModel
+from qrnn import fold_weightnorm
+import corpus
+from common import ID_UNK, ID_PAD, ID_GO, ID_EOS, bucket_sizes, printb, print_buckets
 from dataset import sample_batch_from_bucket, read_data
 
-def make_buckets(dataset):
-	buckets_list = [[] for _ in range(len(bucket_sizes))]
-	for word_ids in dataset:
-		length = len(word_ids)
-		bucket_index = 0
-		for size in bucket_sizes:
-			if length <= size[0]:
-				break
-			bucket_index += 1
-		if bucket_index >= len(bucket_sizes):
-			continue	# ignore long sequence
-
-		required_length, _ = bucket_sizes[bucket_index]
-		
-		for _ in range(max(required_length - length, 0)):
-			word_ids.insert(0, ID_PAD)	# prepend
-		assert len(word_ids) == required_length
-
-		buckets_list[bucket_index].append(word_ids)
-
-	buckets = []
-	for bucket_source in buckets_list:
-		if len(bucket_source) == 0:
-			continue
-		buckets.append(np.asarray(bucket_source).astype(np.int32))
+# the sources are padded on the left and the ones that do not fit into the largest bucket are ignored
+# sizes defaults to the source sizes of bucket_sizes
+def make_buckets(dataset, sizes=None):
+	(buckets,), _ = corpus.make_buckets([dataset], [size[0] for size in bucket_sizes] if sizes is None else sizes, ID_PAD, [True])
 	return buckets
 
+# rows that emit <eos> leave the working batch together with their decoder and encoder states
+# and decoding stops as soon as every row has finished
 def translate_greedy(model, source_batch, max_predict_length, vocab_size, source_reversed=True):
 	xp = model.xp
 	skip_mask = source_batch != ID_PAD
@@ -49,170 +32,146 @@ def translate_greedy(model, source_batch, max_predict_length, vocab_size, source
 		source_batch = cuda.to_gpu(source_batch)
 		skip_mask = cuda.to_gpu(skip_mask)
 
-	word_ids = xp.arange(0, vocab_size, dtype=xp.int32)
-
 	model.reset_state()
-	token = ID_GO
-	x = xp.asarray([[token]]).astype(xp.int32)
-	x = xp.broadcast_to(x, (batchsize, 1))
-
-	# get encoder's last hidden states
-	if isinstance(model, AttentiveSeq2SeqModel):
-		encoder_last_hidden_states, encoder_last_layer_outputs = model.encode(source_batch, skip_mask)
-	else:
-		encoder_last_hidden_states = model.encode(source_batch, skip_mask)
-
-	while x.shape[1] < max_predict_length:
-		if isinstance(model, AttentiveSeq2SeqModel):
-			u = model.decode_one_step(x, encoder_last_hidden_states, encoder_last_layer_outputs, skip_mask)
-		else:
-			u = model.decode_one_step(x, encoder_last_hidden_states)
-		p = F.softmax(u)	# convert to probability
 
-		# concatenate
-		if xp is np:
-			x = xp.append(x, xp.zeros((batchsize, 1), dtype=xp.int32), axis=1)
-		else:
-			x = xp.concatenate((x, xp.zeros((batchsize, 1), dtype=xp.int32)), axis=1)
+	# everything the decoders read from the encoder, computed once
+	encoder_memory = model.encode(source_batch, skip_mask, return_memory=True)
 
-		for n in range(batchsize):
-			pn = p.data[n]
+	x = xp.full((batchsize, max_predict_length), ID_PAD, dtype=xp.int32)
+	x[:, 0] = ID_GO
+	rows = xp.arange(batchsize)	# rows of x that are still decoding
+	token = x[:, 0]
+	length = 1
 
-			# argmax or sampling
-			token = xp.argmax(pn)
+	for t in range(1, max_predict_length):
+		u = model.decode_one_step(token, encoder_memory)
+		token = xp.argmax(u.data, axis=1).astype(xp.int32)
+		x[rows, t] = token
+		length = t + 1
 
-			x[n, -1] = token
+		# remove finished rows
+		active = token != ID_EOS
+		if active.all():
+			continue
+		if active.any() == False:
+			break
+		indices = xp.flatnonzero(active)
+		rows = rows[indices]
+		token = token[indices]
+		model.reorder_decoder_state(indices)
+		encoder_memory = encoder_memory.take(indices)
 
-	return x
+	return x[:, :length]
 
 # http://opennmt.net/OpenNMT/translation/beam_search/
 def translate_beam_search(model, source, max_predict_length, vocab_size, beam_width=8, normalization_alpha=0, source_reversed=True, return_all_candidates=False):
-	xp = model.xp
 	if source.ndim == 1:
-		source = xp.reshape(source, (1, -1))
-	skip_mask = source != ID_PAD
-	batchsize = source.shape[0]
+		source = source.reshape((1, -1))
+	return translate_beam_search_batch(model, source, max_predict_length, vocab_size, beam_width, normalization_alpha, return_all_candidates)[0]
+
+# decodes num_sentences x beam_width beams as one batch
+# the decoders advance one token per step and their states follow the backpointers of the beams.
+# every sentence keeps beam_width rows, the rows of its finished beams are masked with -inf,
+# and the sentence leaves the batch when all of its beams have finished.
+# the encoder states keep one row per sentence and are shared by its beams.
+def translate_beam_search_batch(model, source_batch, max_predict_length, vocab_size, beam_width=8, normalization_alpha=0, return_all_candidates=False):
+	xp = model.xp
+	skip_mask = source_batch != ID_PAD
+	num_sentences = source_batch.shape[0]
 
 	# to gpu
 	if xp is cuda.cupy:
-		source = cuda.to_gpu(source)
+		source_batch = cuda.to_gpu(source_batch)
 		skip_mask = cuda.to_gpu(skip_mask)
 
-	word_ids = xp.arange(0, vocab_size, dtype=xp.int32)
-
 	model.reset_state()
-	x = xp.full((beam_width, 1), ID_GO, dtype=xp.int32)
-
-	# get encoder's last hidden states
-	if isinstance(model, AttentiveSeq2SeqModel):
-		encoder_last_hidden_states, encoder_last_layer_outputs = model.encode(source, skip_mask)
-	else:
-		encoder_last_hidden_states, encoder_last_layer_outputs = model.encode(source, skip_mask), None
-
-	# copy beam_width times
-	for i, state in enumerate(encoder_last_hidden_states):
-		encoder_last_hidden_states[i] = xp.repeat(state.data, beam_width, axis=0)
-	if encoder_last_layer_outputs is not None:
-		encoder_last_layer_outputs = xp.repeat(encoder_last_layer_outputs.data, beam_width, axis=0)
-
-	sum_log_p = xp.zeros((beam_width, 1), dtype=xp.float32)
-	skip_mask = xp.repeat(skip_mask, beam_width, axis=0)
-
-	def argmax_k(array, k):
-		if xp is np:
-			return array.argsort()[-k:][::-1]
-		else:
-			result = []
-			min_value = xp.amin(array)
-			for n in range(k):
-				result.append(xp.argmax(array))
-				array[result[-1]] = min_value
-			return result
 
-	current_beam_width = beam_width
-	candidates = []
-	log_likelihood = []
+	# everything the decoders read from the encoder, computed once
+	encoder_memory = model.encode(source_batch, skip_mask, return_memory=True)
 
-	for t in range(max_predict_length):
-		model.reset_decoder_state()
-		if isinstance(model, AttentiveSeq2SeqModel):
-			u_t = model.decode(x, encoder_last_hidden_states, encoder_last_layer_outputs, skip_mask, return_last=True)
-		else:
-			u_t = model.decode(x, encoder_last_hidden_states, return_last=True)
-		p_t = F.softmax(u_t)	# convert to probability
-		log_p_t = F.log(p_t).data
-
-		# compute scores
-		if t == 0:
-			score = log_p_t[0]	# <go>
-			top_indices = argmax_k(score, current_beam_width)
-		else:
-			score = log_p_t + xp.repeat(sum_log_p, vocab_size, axis=1)
-			score = score.reshape((-1,))
-			top_indices = argmax_k(score, current_beam_width)
-
-		backward_table = [-1] * current_beam_width
-		token_table = [-1] * current_beam_width
-		stopped_beams = []
-		for beam, index in enumerate(top_indices):
-			index = int(index)
-			token = index % vocab_size
-			backward = index // vocab_size
-			backward_table[beam] = backward
-			token_table[beam] = token
-			sum_log_p[beam] += log_p_t[backward, token]
-			if token == ID_EOS:
-				stopped_beams.append(beam)
-				log_likelihood.append(float(sum_log_p[beam]))
+	# a single beam per sentence until the first token has been chosen
+	x = xp.full((num_sentences, 1), ID_GO, dtype=xp.int32)
+	sum_log_p = xp.zeros((num_sentences, 1), dtype=xp.float32)	# (sentences, beams)
+	num_alive = np.full((num_sentences,), beam_width, dtype=np.int32)
+	sentence_ids = np.arange(num_sentences)
+	ranks = xp.arange(beam_width)
+	candidates = [[] for _ in range(num_sentences)]
+	log_likelihood = [[] for _ in range(num_sentences)]
 
-		# concatenate
-		if xp is np:
-			x = xp.append(x, xp.full((current_beam_width, 1), ID_PAD, dtype=xp.int32), axis=1)
-		else:
-			x = xp.concatenate((x, xp.full((current_beam_width, 1), ID_PAD, dtype=xp.int32)), axis=1)
-		new_x = xp.copy(x)
+	for t in range(max_predict_length):
+		u_t = model.decode_one_step(x[:, -1], encoder_memory)
+		log_p_t = F.log_softmax(u_t).data
+
+		# best beam_width (beam, token) pairs of every sentence
+		num_active, width = sum_log_p.shape
+		score = (log_p_t.reshape((num_active, width, vocab_size)) + sum_log_p[..., None]).reshape((num_active, -1))
+		k = min(beam_width, score.shape[1])
+		top_indices = xp.argpartition(-score, k - 1, axis=1)[:, :k]
+		top_score = xp.take_along_axis(score, top_indices, axis=1)
+		if k < beam_width:
+			# the first step has only vocab_size pairs, the missing beams get -inf and are replaced in the next step
+			top_indices = xp.concatenate((top_indices, xp.zeros((num_active, beam_width - k), dtype=top_indices.dtype)), axis=1)
+			top_score = xp.concatenate((top_score, xp.full((num_active, beam_width - k), -xp.inf, dtype=top_score.dtype)), axis=1)
+		order = xp.argsort(-top_score, axis=1)
+		top_indices = xp.take_along_axis(top_indices, order, axis=1)
+		top_score = xp.take_along_axis(top_score, order, axis=1)
+		backward = top_indices // vocab_size + xp.arange(num_active)[:, None] * width
+		token = (top_indices % vocab_size).astype(xp.int32)
 
 		# reconstruct input sequense
-		new_sum_log_p = xp.empty_like(sum_log_p)
-		for beam in range(current_beam_width):
-			new_x[beam, -1] = token_table[beam]
-			backward = backward_table[beam]
-			new_x[beam, :-1] = x[backward, :-1]
-			new_sum_log_p[beam] = sum_log_p[backward]
-		x = new_x
-		sum_log_p = new_sum_log_p
-
-		# remove stopped beam
-		if len(stopped_beams) > 0:
-			flag = xp.ones((current_beam_width,), dtype=bool)
-			flag[stopped_beams] = False
-			new_x = x[flag]
-			sum_log_p = sum_log_p[flag]
-			stopped_x = x[xp.invert(flag)]
-			for n in range(len(stopped_x)):
-				candidates.append(stopped_x[n])
-			x = new_x
-
-			# slice
-			num_to_remove = len(stopped_beams)
-			for i, state in enumerate(encoder_last_hidden_states):
-				encoder_last_hidden_states[i] = encoder_last_hidden_states[i][num_to_remove:]
-			if encoder_last_layer_outputs is not None:
-				encoder_last_layer_outputs = encoder_last_layer_outputs[num_to_remove:]
-			skip_mask = skip_mask[num_to_remove:]
-			current_beam_width -= len(stopped_beams)
-
-		if current_beam_width <= 0:
+		x = xp.concatenate((x[backward.reshape((-1,))], token.reshape((-1, 1))), axis=1)
+
+		# finished beams
+		alive = ranks[None, :] < xp.asarray(num_alive)[:, None]
+		stopped = xp.logical_and(alive, token == ID_EOS)
+		stopped = xp.logical_and(stopped, top_score > -xp.inf)	# a beam without a hypothesis does not finish
+		for n, beam in zip(*np.nonzero(cuda.to_cpu(stopped))):
+			candidates[sentence_ids[n]].append(x[n * beam_width + beam])
+			log_likelihood[sentence_ids[n]].append(float(top_score[n, beam]))
+		alive = xp.logical_and(alive, xp.invert(stopped))
+		num_alive = cuda.to_cpu(alive.sum(axis=1)).astype(np.int32)
+
+		# surviving beams move to the front of their sentence
+		order = xp.argsort(xp.invert(alive) * beam_width + ranks, axis=1)
+		alive = xp.take_along_axis(alive, order, axis=1)
+		sum_log_p = xp.where(alive, xp.take_along_axis(top_score, order, axis=1), -xp.inf).astype(xp.float32)
+		backward = xp.take_along_axis(backward, order, axis=1)
+		x = x[(xp.arange(num_active)[:, None] * beam_width + order).reshape((-1,))]
+
+		# remove finished sentences
+		active = num_alive > 0
+		if active.any() == False:
 			break
-
+		if active.all() == False:
+			keep = xp.asarray(np.flatnonzero(active))
+			x = x.reshape((num_active, beam_width, -1))[keep].reshape((-1, x.shape[1]))
+			sum_log_p = sum_log_p[keep]
+			backward = backward[keep]
+			num_alive = num_alive[active]
+			sentence_ids = sentence_ids[active]
+			encoder_memory = encoder_memory.take(keep)
+
+		# gather the decoder states of the surviving beams
+		model.reorder_decoder_state(backward.reshape((-1,)))
+
+	# the best unfinished beam is used if a sentence has no finished beam
+	unfinished = [None] * num_sentences
+	for n, sentence_id in enumerate(sentence_ids):
+		unfinished[sentence_id] = x[n * beam_width]
+
+	return [select_candidates(candidates[n], log_likelihood[n], unfinished[n], normalization_alpha, return_all_candidates) for n in range(num_sentences)]
+
+def select_candidates(candidates, log_likelihood, unfinished, normalization_alpha=0, return_all_candidates=False):
 	assert len(candidates) == len(log_likelihood)
 	num_sampled = len(candidates)
 
 	# if empty
 	if num_sampled == 0:
 		result = []
-		for token in (x[0]):
+		for token in (unfinished):
 			result.append(token)
+		if return_all_candidates == True:
+			return [result]
 		return result
 
 	# compute score
@@ -327,28 +286,29 @@ def dump_all_translation(vocab_inv_source, vocab_inv_target, source, translation
 
 def dump_source_translation(model, source_buckets, vocab_inv_source, vocab_inv_target, beam_width=8, normalization_alpha=0):
 	for source_bucket in source_buckets:
-		if beam_width == 1:	# greedy
-			batchsize = 24
-			if len(source_bucket) > batchsize:
-				num_sections = len(source_bucket) // batchsize - 1
-				if len(source_bucket) % batchsize > 0:
-					num_sections += 1
-				indices = [(i + 1) * batchsize for i in range(num_sections)]
-				source_sections = np.split(source_bucket, indices, axis=0)
-			else:
-				source_sections = [source_bucket]
+		batchsize = 24
+		if len(source_bucket) > batchsize:
+			num_sections = len(source_bucket) // batchsize - 1
+			if len(source_bucket) % batchsize > 0:
+				num_sections += 1
+			indices = [(i + 1) * batchsize for i in range(num_sections)]
+			source_sections = np.split(source_bucket, indices, axis=0)
+		else:
+			source_sections = [source_bucket]
 
-			for source_batch in source_sections:
+		for source_batch in source_sections:
+			if beam_width == 1:	# greedy
 				translation_batch = translate_greedy(model, source_batch, source_batch.shape[1] * 2, len(vocab_inv_target), beam_width)
 				for index in range(len(translation_batch)):
 					source = source_batch[index]
 					translation = translation_batch[index]
 					dump_translation(vocab_inv_source, vocab_inv_target, source, translation)
-		else:	# beam search
-			for index in range(len(source_bucket)):
-				source = source_bucket[index]
-				translations = translate_beam_search(model, source, source.size * 2, len(vocab_inv_target), beam_width, normalization_alpha, return_all_candidates=True)
-				dump_all_translation(vocab_inv_source, vocab_inv_target, source, translations)
+			else:	# beam search
+				translations_batch = translate_beam_search_batch(model, source_batch, source_batch.shape[1] * 2, len(vocab_inv_target), beam_width, normalization_alpha, return_all_candidates=True)
+				for index in range(len(translations_batch)):
+					source = source_batch[index]
+					translations = translations_batch[index]
+					dump_all_translation(vocab_inv_source, vocab_inv_target, source, translations)
 
 def dump_random_source_target_translation(model, source_buckets, target_buckets, vocab_inv_source, vocab_inv_target, num_translate=3, beam_width=8):
 	xp = model.xp
@@ -364,18 +324,19 @@ def dump_random_source_target_translation(model, source_buckets, target_buckets,
 				dump_translation(vocab_inv_source, vocab_inv_target, source, translation, target)
 
 		else:	# beam search
-			for index in range(len(source_batch)):
+			translation_batch = translate_beam_search_batch(model, source_batch, target_batch.shape[1] * 2, len(vocab_inv_target), beam_width)
+			for index in range(len(translation_batch)):
 				source = source_batch[index]
+				translation = translation_batch[index]
 				target = target_batch[index]
-				translation_batch = translate_beam_search(model, source, target.size * 2, len(vocab_inv_target), beam_width)
-				dump_translation(vocab_inv_source, vocab_inv_target, source, translation_batch, target)
+				dump_translation(vocab_inv_source, vocab_inv_target, source, translation, target)
 
 def main(args):
 	vocab, vocab_inv = load_vocab(args.model_dir)
 	vocab_source, vocab_target = vocab
 	vocab_inv_source, vocab_inv_target = vocab_inv
 
-	source_dataset, target_dataset = read_data(vocab_source, vocab_target, args.source_train, None, args.source_dev, None, args.source_test, None, reverse_source=True)
+	source_dataset, target_dataset = read_data(vocab_source, vocab_target, args.source_train, None, args.source_dev, None, args.source_test, None, reverse_source=True, cache_dir=args.cache_dir, num_workers=args.tokenize_workers)
 
 	source_dataset_train, source_dataset_dev, source_dataset_test = source_dataset
 	target_dataset_train, target_dataset_dev, target_dataset_test = target_dataset
@@ -388,37 +349,42 @@ def main(args):
 		print("test	{}".format(len(source_dataset_test)))
 
 	
-	# split into buckets
+	# split into buckets, the source side of the sizes saved by train.py takes precedence over --num-buckets
+	sizes = load_bucket_sizes(args.model_dir)
+	if sizes is not None:
+		sizes = sorted(set(source for source, _ in sizes))
+	elif args.num_buckets > 0:
+		sizes = corpus.optimize_bucket_sizes(np.concatenate([dataset.lengths() for dataset in source_dataset if len(dataset) > 0]), args.num_buckets)
+	if sizes is not None:
+		print("bucket sizes	{}".format(sizes))
 	source_buckets_train = None
 	if len(source_dataset_train) > 0:
-		printb("buckets 	#data	(train)")
-		source_buckets_train = make_buckets(source_dataset_train)
+		printb("buckets 	#data	padding	(train)")
+		source_buckets_train = make_buckets(source_dataset_train, sizes)
 		if args.buckets_slice is not None:
 			source_buckets_train = source_buckets_train[:args.buckets_slice + 1]
-		for size, data in zip(bucket_sizes, source_buckets_train):
-			print("{} 	{}".format(size, len(data)))
+		print_buckets(source_buckets_train)
 
 	source_buckets_dev = None
 	if len(source_dataset_dev) > 0:
-		printb("buckets 	#data	(dev)")
-		source_buckets_dev = make_buckets(source_dataset_dev)
+		printb("buckets 	#data	padding	(dev)")
+		source_buckets_dev = make_buckets(source_dataset_dev, sizes)
 		if args.buckets_slice is not None:
 			source_buckets_dev = source_buckets_dev[:args.buckets_slice + 1]
-		for size, data in zip(bucket_sizes, source_buckets_dev):
-			print("{} 	{}".format(size, len(data)))
+		print_buckets(source_buckets_dev)
 
 	source_buckets_test = None
 	if len(source_dataset_test) > 0:
-		printb("buckets		#data	(test)")
-		source_buckets_test = make_buckets(source_dataset_test)
+		printb("buckets		#data	padding	(test)")
+		source_buckets_test = make_buckets(source_dataset_test, sizes)
 		if args.buckets_slice is not None:
 			source_buckets_test = source_buckets_test[:args.buckets_slice + 1]
-		for size, data in zip(bucket_sizes, source_buckets_test):
-			print("{} 	{}".format(size, len(data)))
+		print_buckets(source_buckets_test)
 
 	# init
 	model = load_model(args.model_dir)
 	assert model is not None
+	fold_weightnorm(model)
 	if args.gpu_device >= 0:
 		cuda.get_device(args.gpu_device).use()
 		model.to_gpu()
@@ -437,6 +403,9 @@ if __name__ == "__main__":
 	parser.add_argument("--source-train", type=str, default=None)
 	parser.add_argument("--source-dev", type=str, default=None)
 	parser.add_argument("--source-test", type=str, default=None)
+	parser.add_argument("--cache-dir", type=str, default=None)
+	parser.add_argument("--tokenize-workers", type=int, default=0)
+	parser.add_argument("--num-buckets", type=int, default=0)	# > 0: bucket sizes that minimize padding instead of bucket_sizes
 	parser.add_argument("--gpu-device", "-g", type=int, default=0) 
 	parser.add_argument("--buckets-slice", type=int, default=None)
 	parser.add_argument("--model-dir", "-m", type=str, default="model")